@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+
+from activity_db import activity_db_path, connect, connect_readonly, read_activities
+
+
+class ActivityCatalog:
+    """
+    All activities, loaded once and shared by every stage of a pipeline run.
+
+    The activity database is read a single time, dates are parsed once and the values
+    shown on the map, in the runs list and in the statistics are derived for all rows
+    together.
+    Activities are indexed by id, so joining them with the tracks is one index lookup
+    instead of a scan per track.
+
+    Derived columns:
+    distance_km, pace_seconds (per km, 0 without distance), end_time, date_str
+    ('dd.mm.yyyy'), pace_str ('m:ss'), time_str (start - end and moving time)
+    """
+
+    def __init__(self, path=activity_db_path):
+        self.path = path
+        # Pages only read, so they do not wait for the write lock of a running update
+        conn = connect_readonly(path)
+        if conn is None:
+            # Create and seed the database the first time
+            connect(path).close()
+            conn = connect_readonly(path)
+        try:
+            df = read_activities(conn)
+        finally:
+            conn.close()
+        df['start_date_local'] = pd.to_datetime(df['start_date_local'])
+
+        df['distance_km'] = df['distance'] / 1000
+        df['pace_seconds'] = np.where(df['distance_km'] > 0,
+                                      df['moving_time'] / df['distance_km'].where(df['distance_km'] > 0), 0)
+        df['end_time'] = df['start_date_local'] + pd.to_timedelta(df['moving_time'], unit='s')
+
+        # Display strings, formatted the same way the pages always showed them
+        pace_minutes = (df['pace_seconds'] // 60).astype(int)
+        pace_seconds = (df['pace_seconds'] % 60).astype(int)
+        df['date_str'] = df['start_date_local'].dt.strftime('%d.%m.%Y')
+        df['pace_str'] = pace_minutes.astype(str) + ':' + pace_seconds.astype(str).str.zfill(2)
+        moving_time = pd.to_datetime(df['moving_time'], unit='s').dt.strftime('%H:%M:%S')
+        df['time_str'] = (df['start_date_local'].dt.strftime('%H:%M:%S') + ' - ' +
+                          df['end_time'].dt.strftime('%H:%M:%S') + ' (Time: ' + moving_time + ')')
+
+        self.df = df.set_index('id', drop=False)
+        self.runs = self.df[self.df['type'] == 'Run']
+
+    def __len__(self):
+        return len(self.df)
+
+    def __contains__(self, activity_id):
+        return int(activity_id) in self.df.index
+
+    def join_tracks(self, track_ids, runs_only=False):
+        """
+        Select the activities that have a track.
+
+        Parameters:
+        track_ids (array-like): Ids of the stored tracks
+        runs_only (bool): If True, only return activities of type 'Run'
+
+        Returns:
+        pd.DataFrame: Matching activities in the order of track_ids
+        """
+        df = self.runs if runs_only else self.df
+        positions = df.index.get_indexer(np.asarray(track_ids, dtype=np.int64))
+        return df.iloc[positions[positions >= 0]]
+
+    def attach_track_metrics(self, features):
+        """
+        Add the geometry metrics of the stored tracks as columns, so that the stages can
+        use them without reading any track. Activities without a track get NaN.
+
+        Added columns: track_km, is_loop, start_lat/lon, end_lat/lon, centroid_lat/lon,
+        min_lat/lon and max_lat/lon (bounding box)
+
+        Parameters:
+        features (ingest.TrackFeatures): Features of the stored tracks
+        """
+        arrays = features.arrays
+        positions = pd.Index(arrays['ids']).get_indexer(self.df.index)
+        has_track = positions >= 0
+
+        def column(values):
+            out = np.full(len(positions), np.nan)
+            out[has_track] = values[positions[has_track]]
+            return out
+
+        df = self.df
+        df['track_km'] = column(arrays['length']) / 1000
+        df['is_loop'] = column(arrays['is_loop'].astype(np.float64)) == 1
+        for name in ('start', 'end', 'centroid'):
+            df[f'{name}_lat'] = column(arrays[name][:, 0])
+            df[f'{name}_lon'] = column(arrays[name][:, 1])
+        for i, name in enumerate(('min_lat', 'min_lon', 'max_lat', 'max_lon')):
+            df[name] = column(arrays['bbox'][:, i])
+        self.runs = df[df['type'] == 'Run']
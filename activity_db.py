@@ -0,0 +1,449 @@
+import os
+import sqlite3
+from datetime import date
+import numpy as np
+import pandas as pd
+
+# SQLite database holding activities, their locations and track metadata
+activity_db_path = 'strava.db'
+# Activities are imported from the CSV the first time the database is opened, and exported
+# to it after every sync, so that a fresh checkout starts from the latest activities
+csv_file_path = 'strava_activities.csv'
+# City and country of the runs, exported whenever new ones are stored. Runs without a
+# location take theirs from it, so that a fresh checkout does not geocode them again.
+locations_csv_path = 'run_locations.csv'
+
+# Activity columns, in order
+ACTIVITY_COLUMNS = ['id', 'name', 'type', 'start_date_local', 'distance', 'moving_time',
+                    'elapsed_time', 'total_elevation_gain', 'run_number']
+
+# Per-track features from the track store, see ingest.TrackFeatures. Derived data, so the
+# table is recreated when TRACK_META_VERSION changes.
+TRACK_META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS track_meta (
+    activity_id INTEGER PRIMARY KEY,
+    fingerprint INTEGER,
+    num_points INTEGER,
+    length REAL,
+    mid_lat REAL,
+    mid_lon REAL,
+    min_lat REAL,
+    min_lon REAL,
+    max_lat REAL,
+    max_lon REAL,
+    centroid_lat REAL,
+    centroid_lon REAL,
+    start_lat REAL,
+    start_lon REAL,
+    end_lat REAL,
+    end_lon REAL,
+    is_loop INTEGER
+);
+"""
+TRACK_META_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    type TEXT,
+    start_date_local TEXT,
+    distance REAL,
+    moving_time INTEGER,
+    elapsed_time INTEGER,
+    total_elevation_gain REAL,
+    run_number INTEGER
+);
+CREATE INDEX IF NOT EXISTS activities_type_start ON activities (type, start_date_local);
+
+-- City and country of an activity, resolved from the midpoint of the track with the
+-- given fingerprint; rows whose fingerprint no longer matches the track are resolved again
+CREATE TABLE IF NOT EXISTS activity_location (
+    activity_id INTEGER PRIMARY KEY REFERENCES activities (id) ON DELETE CASCADE,
+    city TEXT,
+    country TEXT,
+    fingerprint INTEGER
+);
+CREATE INDEX IF NOT EXISTS activity_location_city ON activity_location (city);
+CREATE INDEX IF NOT EXISTS activity_location_country ON activity_location (country);
+
+-- Routes followed by several runs, see routes.update_routes. A route is identified by the
+-- smallest activity id of its group.
+CREATE TABLE IF NOT EXISTS routes (
+    route_id INTEGER PRIMARY KEY,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS activity_route (
+    activity_id INTEGER PRIMARY KEY REFERENCES activities (id) ON DELETE CASCADE,
+    route_id INTEGER REFERENCES routes (route_id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS activity_route_route ON activity_route (route_id);
+
+-- Counters such as the activities revision, bumped by every write to the activities
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+
+-- Totals per activity type and day, week (starting Monday), month and year, identified by
+-- the local date the bucket starts on. Kept up to date by the triggers below.
+CREATE TABLE IF NOT EXISTS rollups (
+    type TEXT,
+    period TEXT,
+    start TEXT,
+    count INTEGER,
+    distance REAL,
+    moving_time INTEGER,
+    elevation REAL,
+    PRIMARY KEY (type, period, start)
+);
+
+CREATE VIEW IF NOT EXISTS city_stats AS
+    SELECT l.city AS name, SUM(a.distance) / 1000.0 AS distance_km, COUNT(*) AS runs
+    FROM activities a JOIN activity_location l ON l.activity_id = a.id
+    WHERE a.type = 'Run' AND l.city IS NOT NULL
+    GROUP BY l.city;
+
+CREATE VIEW IF NOT EXISTS country_stats AS
+    SELECT l.country AS name, SUM(a.distance) / 1000.0 AS distance_km, COUNT(*) AS runs
+    FROM activities a JOIN activity_location l ON l.activity_id = a.id
+    WHERE a.type = 'Run' AND l.country IS NOT NULL
+    GROUP BY l.country;
+"""
+
+# Bucket start of a rollup period, from the local date of an activity
+ROLLUP_PERIODS = {
+    'day': "date({d})",
+    'week': "date({d}, 'weekday 0', '-6 days')",
+    'month': "date({d}, 'start of month')",
+    'year': "date({d}, 'start of year')",
+}
+# Bump whenever the rollups change meaning, to rebuild them from the activities
+ROLLUPS_VERSION = 1
+
+
+def _local_date(row):
+    # Strava's local start time carries a UTC marker, the date is taken as written
+    return f"substr({row}.start_date_local, 1, 10)"
+
+
+def _rollup_delta(row, sign):
+    # Statements adding one activity to, or removing it from, the bucket of every period
+    statements = []
+    for period, bucket in ROLLUP_PERIODS.items():
+        start = bucket.format(d=_local_date(row))
+        # The WHERE clause is required by SQLite to tell the upsert clause from a join
+        statements.append(f"""
+        INSERT INTO rollups (type, period, start, count, distance, moving_time, elevation)
+        SELECT {row}.type, '{period}', {start}, {sign}1, {sign}COALESCE({row}.distance, 0),
+               {sign}COALESCE({row}.moving_time, 0), {sign}COALESCE({row}.total_elevation_gain, 0)
+        WHERE {row}.type IS NOT NULL AND {row}.start_date_local IS NOT NULL
+        ON CONFLICT (type, period, start) DO UPDATE SET
+            count = count + excluded.count, distance = distance + excluded.distance,
+            moving_time = moving_time + excluded.moving_time, elevation = elevation + excluded.elevation;""")
+        if sign:
+            statements.append(f"""
+        DELETE FROM rollups WHERE type = {row}.type AND period = '{period}' AND start = {start} AND count = 0;""")
+    return ''.join(statements)
+
+
+ROLLUP_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS rollups_insert AFTER INSERT ON activities
+BEGIN{_rollup_delta('new', '')}
+END;
+
+CREATE TRIGGER IF NOT EXISTS rollups_delete AFTER DELETE ON activities
+BEGIN{_rollup_delta('old', '-')}
+END;
+
+CREATE TRIGGER IF NOT EXISTS rollups_update AFTER UPDATE ON activities
+WHEN old.type IS NOT new.type OR old.start_date_local IS NOT new.start_date_local
+    OR old.distance IS NOT new.distance OR old.moving_time IS NOT new.moving_time
+    OR old.total_elevation_gain IS NOT new.total_elevation_gain
+BEGIN{_rollup_delta('old', '-')}{_rollup_delta('new', '')}
+END;
+"""
+
+
+def rebuild_rollups(conn):
+    # Recompute all rollups from the activities, in the caller's transaction
+    conn.execute('DELETE FROM rollups')
+    for period, bucket in ROLLUP_PERIODS.items():
+        conn.execute(f"""
+            INSERT INTO rollups (type, period, start, count, distance, moving_time, elevation)
+            SELECT type, '{period}', {bucket.format(d=_local_date('activities'))} AS bucket, COUNT(*),
+                   SUM(COALESCE(distance, 0)), SUM(COALESCE(moving_time, 0)),
+                   SUM(COALESCE(total_elevation_gain, 0))
+            FROM activities
+            WHERE type IS NOT NULL AND start_date_local IS NOT NULL
+            GROUP BY type, bucket""")
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollups_version', ?)", (ROLLUPS_VERSION,))
+
+
+def connect(path=activity_db_path):
+    """
+    Open the database, creating the schema and importing the CSV the first time.
+
+    Every thread opens its own connection. Use the connection as a context manager to
+    commit a group of writes as one transaction. Readers that do not write should use
+    connect_readonly.
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    # Write-ahead logging lets readers go on while an update holds a write transaction. The
+    # mode is stored in the database file, so it is only switched once.
+    if conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+        conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(SCHEMA + TRACK_META_SCHEMA + ROLLUP_TRIGGERS)
+    with conn:
+        # Take the write lock before checking, so only one connection imports the CSV
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute("SELECT value FROM meta WHERE key = 'rollups_version'").fetchone()
+        if row is None or row[0] != ROLLUPS_VERSION:
+            rebuild_rollups(conn)
+        row = conn.execute("SELECT value FROM meta WHERE key = 'track_meta_version'").fetchone()
+        if row is None or row[0] != TRACK_META_VERSION:
+            # Filled again by the next sync_track_meta
+            conn.execute('DROP TABLE IF EXISTS track_meta')
+            conn.execute(TRACK_META_SCHEMA)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('track_meta_version', ?)",
+                         (TRACK_META_VERSION,))
+        if activity_count(conn) == 0 and os.path.exists(csv_file_path):
+            df = pd.read_csv(csv_file_path)
+            _upsert(conn, df)
+            print(f"Imported {len(df)} activities from '{csv_file_path}' into '{path}'.")
+    return conn
+
+
+def connect_readonly(path=activity_db_path):
+    # Open an existing database without creating, migrating or seeding it, None if it does not exist
+    if not os.path.exists(path):
+        return None
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=30)
+
+
+def activity_count(conn):
+    return conn.execute('SELECT COUNT(*) FROM activities').fetchone()[0]
+
+
+def revision(conn, name):
+    # Changes whenever the named data ('activities', 'routes', 'locations') is written, used
+    # to tell if pages are out of date
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (f'{name}_revision',)).fetchone()
+    return row[0] if row else 0
+
+
+def bump_revision(conn, name):
+    conn.execute("INSERT INTO meta (key, value) VALUES (?, 1) "
+                 "ON CONFLICT (key) DO UPDATE SET value = value + 1", (f'{name}_revision',))
+
+
+def _upsert(conn, df):
+    df = df[ACTIVITY_COLUMNS].copy()
+    df['start_date_local'] = pd.to_datetime(df['start_date_local']).astype(str)
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    updates = ', '.join(f"{column} = excluded.{column}" for column in ACTIVITY_COLUMNS[1:])
+    conn.executemany(f"INSERT INTO activities ({', '.join(ACTIVITY_COLUMNS)}) "
+                     f"VALUES ({', '.join('?' * len(ACTIVITY_COLUMNS))}) "
+                     f"ON CONFLICT (id) DO UPDATE SET {updates}", rows)
+    bump_revision(conn, 'activities')
+
+
+def upsert_activities(conn, df):
+    """
+    Insert new activities and update existing ones, in one transaction.
+
+    Parameters:
+    df (pd.DataFrame): Activities with all ACTIVITY_COLUMNS
+    """
+    with conn:
+        _upsert(conn, df)
+
+
+def replace_activities(conn, df):
+    """
+    Make the activities table match df: upsert every row and delete activities missing
+    from it, together with their locations. Runs as one transaction.
+    """
+    with conn:
+        _upsert(conn, df)
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS keep_ids (id INTEGER PRIMARY KEY)')
+        conn.execute('DELETE FROM keep_ids')
+        conn.executemany('INSERT INTO keep_ids (id) VALUES (?)', ((int(i),) for i in df['id']))
+        deleted = conn.execute('DELETE FROM activities WHERE id NOT IN (SELECT id FROM keep_ids)').rowcount
+    return deleted
+
+
+def export_csv(conn, path=csv_file_path):
+    # Write all activities to the CSV the database is seeded from, by date
+    df = pd.read_sql_query(f"SELECT {', '.join(ACTIVITY_COLUMNS)} FROM activities ORDER BY start_date_local, id", conn)
+    tmp_path = path + '.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return len(df)
+
+
+def export_locations(conn, path=locations_csv_path):
+    # Write the location of every run to the CSV new databases take them from, by id
+    df = pd.read_sql_query('SELECT activity_id, city, country FROM activity_location ORDER BY activity_id', conn)
+    tmp_path = path + '.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return len(df)
+
+
+def read_exported_locations(path=locations_csv_path):
+    # (city, country) by activity id from the exported locations, None where one is unknown
+    if not os.path.exists(path):
+        return {}
+    df = pd.read_csv(path, dtype={'city': object, 'country': object})
+    df = df.astype(object).where(df.notna(), None)
+    return {int(activity_id): (city, country) for activity_id, city, country in df.itertuples(index=False)}
+
+
+def read_activities(conn):
+    # All activities with the id and name of their route, if any
+    columns = ', '.join(f'a.{column}' for column in ACTIVITY_COLUMNS)
+    return pd.read_sql_query(f"""
+        SELECT {columns}, ar.route_id, r.name AS route_name
+        FROM activities a
+        LEFT JOIN activity_route ar ON ar.activity_id = a.id
+        LEFT JOIN routes r ON r.route_id = ar.route_id
+        ORDER BY a.start_date_local, a.id
+    """, conn)
+
+
+def sync_track_meta(conn, features):
+    """
+    Bring track_meta up to date with the track features.
+
+    Only rows whose fingerprint changed are written; tracks no longer in the store are
+    removed.
+
+    Parameters:
+    features (ingest.TrackFeatures): Features of all stored tracks
+
+    Returns:
+    int: Number of rows written or deleted
+    """
+    arrays = features.arrays
+    stored = dict(conn.execute('SELECT activity_id, fingerprint FROM track_meta').fetchall())
+    ids = arrays['ids'].tolist()
+    fingerprints = arrays['fingerprint'].tolist()
+    changed = [i for i, (activity_id, fingerprint) in enumerate(zip(ids, fingerprints))
+               if stored.get(activity_id) != fingerprint]
+    removed = set(stored) - set(ids)
+    if not changed and not removed:
+        return 0
+
+    def value(x):
+        return None if np.isnan(x) else float(x)
+
+    rows = [(ids[i], fingerprints[i], int(arrays['num_points'][i]), float(arrays['length'][i]),
+             *(value(x) for x in arrays['midpoint'][i]), *(value(x) for x in arrays['bbox'][i]),
+             *(value(x) for x in arrays['centroid'][i]), *(value(x) for x in arrays['start'][i]),
+             *(value(x) for x in arrays['end'][i]), int(arrays['is_loop'][i])) for i in changed]
+    with conn:
+        conn.executemany(f"INSERT OR REPLACE INTO track_meta VALUES ({', '.join('?' * 17)})", rows)
+        conn.executemany('DELETE FROM track_meta WHERE activity_id = ?', ((i,) for i in removed))
+    return len(changed) + len(removed)
+
+
+def runs_without_location(conn):
+    """
+    Runs with a track whose location is missing or was resolved from an older track.
+
+    Returns:
+    list: (activity_id, mid_lat, mid_lon, fingerprint) per run
+    """
+    return conn.execute("""
+        SELECT a.id, t.mid_lat, t.mid_lon, t.fingerprint
+        FROM activities a
+        JOIN track_meta t ON t.activity_id = a.id
+        LEFT JOIN activity_location l ON l.activity_id = a.id
+        WHERE a.type = 'Run' AND t.num_points > 0
+          AND (l.activity_id IS NULL OR l.fingerprint IS NOT t.fingerprint)
+    """).fetchall()
+
+
+def upsert_locations(conn, rows):
+    # rows: (activity_id, city, country, fingerprint)
+    if not rows:
+        return
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO activity_location (activity_id, city, country, fingerprint) '
+                         'VALUES (?, ?, ?, ?)', rows)
+        bump_revision(conn, 'locations')
+
+
+def clear_locations(conn):
+    with conn:
+        conn.execute('DELETE FROM activity_location')
+        bump_revision(conn, 'locations')
+
+
+def location_stats(conn, view):
+    # Rows of the city_stats or country_stats view, by total distance in descending order
+    return conn.execute(f"SELECT name, distance_km, runs FROM {view} ORDER BY distance_km DESC, name").fetchall()
+
+
+def rollup_series(conn, period, activity_type, start=None, end=None):
+    """
+    Buckets of one period, optionally limited to those starting in [start, end).
+
+    Parameters:
+    period (str): 'day', 'week', 'month' or 'year'
+    activity_type (str): Activity type, such as 'Run'
+    start, end (datetime.date): Window of bucket start dates
+
+    Returns:
+    list: (start, count, distance, moving_time, elevation) per non-empty bucket, by date
+    """
+    return conn.execute("""
+        SELECT start, count, distance, moving_time, elevation FROM rollups
+        WHERE type = ? AND period = ? AND start >= ? AND start < ?
+        ORDER BY start
+    """, (activity_type, period, str(start or '0000-01-01'), str(end or '9999-12-31'))).fetchall()
+
+
+def _window_parts(start, end):
+    # Split [start, end) into buckets that cover it exactly: days at the edges, then
+    # months, then whole years in the middle
+    first_month = start if start.day == 1 else date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    last_month = end.replace(day=1)
+    if first_month >= last_month:
+        return [('day', start, end)]
+    parts = [('day', start, first_month), ('day', last_month, end)]
+    first_year = first_month if first_month.month == 1 else date(first_month.year + 1, 1, 1)
+    last_year = last_month.replace(month=1)
+    if first_year >= last_year:
+        return parts + [('month', first_month, last_month)]
+    return parts + [('month', first_month, first_year), ('month', last_year, last_month),
+                    ('year', first_year, last_year)]
+
+
+def rollup_window(conn, activity_type, start, end):
+    """
+    Totals of the activities of one type that started in [start, end).
+
+    The window is answered from at most a few dozen day and month buckets plus one bucket
+    per whole year, however many activities it contains.
+
+    Parameters:
+    activity_type (str): Activity type, such as 'Run'
+    start, end (datetime.date): First day of the window and the day after the last one
+
+    Returns:
+    (int, float, int, float): Count, distance in meters, moving time in seconds and elevation gain
+    """
+    count, distance, moving_time, elevation = 0, 0.0, 0, 0.0
+    for period, part_start, part_end in _window_parts(start, end):
+        for _, c, d, m, e in rollup_series(conn, period, activity_type, part_start, part_end):
+            count, distance, moving_time, elevation = count + c, distance + d, moving_time + m, elevation + e
+    return count, distance, moving_time, elevation
+
+
+def last_activity_date(conn, activity_type):
+    # Local date of the latest activity of a type, None without any
+    return conn.execute("SELECT MAX(start) FROM rollups WHERE type = ? AND period = 'day'",
+                        (activity_type,)).fetchone()[0]
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import threading
+import time
+
+# Files changed by another process, such as a build started from the command line, are
+# noticed at most this many seconds later
+REVALIDATE_INTERVAL = 30
+
+
+class ArtifactStore:
+    """
+    In-memory copies of the generated files, meant to be shared by all app sessions.
+
+    A file is read once and served from memory afterwards. It is checked against the disk
+    again after invalidate(), or once REVALIDATE_INTERVAL has passed: an unchanged mtime
+    and size means no read, a changed one means a re-read, and the content hash decides
+    whether the content changed.
+
+    Versions are the mtime and size of a file and never read it, so they cost the same
+    however large the file grows, such as the activity database.
+    """
+
+    def __init__(self, revalidate_interval=REVALIDATE_INTERVAL):
+        self.revalidate_interval = revalidate_interval
+        self.generation = 0
+        self._entries = {}
+        self._checked = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        # Called when a rebuild finished, the next access checks every file again
+        with self._lock:
+            self._checked.clear()
+            self._versions.clear()
+            self.generation += 1
+
+    def _entry(self, path):
+        with self._lock:
+            now = time.time()
+            entry = self._entries.get(path)
+            if path in self._checked and now - self._checked[path] < self.revalidate_interval:
+                return entry
+            self._checked[path] = now
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self._entries.pop(path, None)
+                return None
+            key = (stat.st_mtime_ns, stat.st_size)
+            if entry is not None and entry['stat'] == key:
+                return entry
+
+            with open(path, 'rb') as f:
+                data = f.read()
+            content_hash = hashlib.sha1(data).hexdigest()
+            if entry is not None and entry['hash'] == content_hash:
+                # Rewritten with the same content, keep the entry
+                entry['stat'] = key
+                return entry
+            try:
+                content = data.decode('utf-8')
+            except UnicodeDecodeError:
+                content = None
+            entry = {'stat': key, 'hash': content_hash, 'content': content}
+            self._entries[path] = entry
+            return entry
+
+    def read(self, path):
+        # Content of a file as text, or None if it does not exist
+        entry = self._entry(path)
+        return entry['content'] if entry is not None else None
+
+    def version(self, path):
+        # mtime and size of a file, usable as a cache key, or None if it does not exist
+        with self._lock:
+            now = time.time()
+            checked, version = self._versions.get(path, (None, None))
+            if checked is not None and now - checked < self.revalidate_interval:
+                return version
+            try:
+                stat = os.stat(path)
+            except OSError:
+                version = None
+            else:
+                version = f"{stat.st_mtime_ns}:{stat.st_size}"
+            self._versions[path] = (now, version)
+            return version
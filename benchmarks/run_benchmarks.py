@@ -0,0 +1,322 @@
+"""
+Time the sync, every page generation step and the app's artifact loading on synthetic
+histories, against a local stand-in for the Strava API.
+
+Every size runs in its own process and temporary folder. The results are written as one
+JSON file per invocation, which --baseline compares against an earlier one:
+
+    python benchmarks/run_benchmarks.py --sizes 1000 10000
+    python benchmarks/run_benchmarks.py --sizes 1000 --baseline benchmarks/results/<earlier>.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPO_FOLDER = os.path.dirname(BENCHMARK_FOLDER)
+sys.path.insert(0, REPO_FOLDER)
+
+results_folder = os.path.join(BENCHMARK_FOLDER, 'results')
+
+DEFAULT_SIZES = [1000, 10000]
+# Share of the history that only appears in the second, incremental sync. Those
+# activities are listed without their map, so every one of them is fetched on its own.
+NEW_SHARE = 0.01
+# Newest activities whose full resolution streams are fetched
+STREAM_ACTIVITIES = 500
+# Timings that got slower by more than this factor, and by more than the given number of
+# seconds to ignore noise in the quick steps, are flagged against the baseline
+REGRESSION_FACTOR = 1.2
+REGRESSION_SECONDS = 0.05
+# Bump whenever the layout of the results changes
+RESULTS_VERSION = 1
+
+# Generated files whose size is reported
+OUTPUT_FILES = ['strava.db', 'tracks.bin', 'track_features.npz', 'routes_state.npz', 'spatial_index.npz',
+                'coverage_state.npz', 'heatmap_state.npz', 'streams.bin', 'map_layer_cache.json', 'activity_map.html',
+                'heatmap_map.html', 'runs_list.html', 'generated_summary.html',
+                'generated_city_statistics_from_csv.html']
+PAGES = ['generated_summary.html', 'generated_city_statistics_from_csv.html', 'heatmap_map.html',
+         'activity_map.html', 'runs_list.html']
+
+
+class Timings:
+    # Wall clock seconds per step, printed as they finish
+    def __init__(self, out):
+        self.values = {}
+        self.out = out
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        yield
+        self.values[name] = round(time.perf_counter() - start, 4)
+        print(f"  {name}: {self.values[name]:.3f} s", file=self.out, flush=True)
+
+
+def _point_client_at(stub):
+    # Send the client's requests to the stub, with rate limit windows as long as the stub's
+    import strava_client
+    strava_client.api_base_url = stub.url
+    strava_client.token_url = stub.url + 'oauth/token'
+    strava_client.SHORT_TERM_WINDOW = stub.window
+    os.makedirs('.streamlit', exist_ok=True)
+    with open(os.path.join('.streamlit', 'secrets.toml'), 'w') as f:
+        f.write('STRAVA_CLIENT_ID = "1"\nSTRAVA_CLIENT_SECRET = "benchmark"\nSTRAVA_REFRESH_TOKEN = "benchmark"\n')
+
+
+def run_size(num_activities, seed, with_app=True, out=sys.stdout):
+    """
+    Run all benchmarks on a synthetic history, in the current folder.
+
+    Returns:
+    dict: Timings in seconds, counts and file sizes
+    """
+    from synthetic import generate_history, write_csv, write_boundaries
+    from strava_stub import StravaStub
+    from activity_db import connect, activity_count
+    from strava_sync import sync_activities, sync_streams
+    from stream_store import StreamStore
+    from gpx_reader import read_points
+    from stravaDash import (load_tracks, generate_map_and_statistics, generate_heatmap_html, generate_runs_list_html,
+                            generate_summary_html, generate_city_statistics_html)
+    from activity_catalog import ActivityCatalog
+    from routes import update_routes
+    from spatial_index import update_spatial_index
+    from tile_coverage import update_coverage
+    from build import run_build
+    from artifact_store import ArtifactStore
+    from instrumentation import start_run
+
+    # Spans and counters of everything below, such as API requests and bytes written
+    report = start_run('benchmark', profile=())
+    timings = Timings(out)
+    log = []
+    with timings('generate'):
+        history = generate_history(num_activities, seed=seed)
+    write_boundaries('boundaries.geojson')
+
+    # Seeding the database from the activity CSV, in a folder of its own
+    os.makedirs('csv_seed', exist_ok=True)
+    write_csv(history, os.path.join('csv_seed', 'strava_activities.csv'))
+    os.chdir('csv_seed')
+    try:
+        with timings('csv_import'):
+            connect().close()
+    finally:
+        os.chdir('..')
+
+    # A first sync of the whole history, then one that picks up the newest activities
+    num_new = max(1, int(len(history) * NEW_SHARE))
+    with StravaStub(history[:-num_new]) as stub:
+        _point_client_at(stub)
+        with timings('sync_full'):
+            sync_activities(write=log.append, warn=log.append, error=log.append)
+        full_stats = dict(stub.stats)
+        stub.set_activities(history)
+        stub.without_map = {activity['id'] for activity in history[-num_new:]}
+        # The budget is used up when the sync starts, so it sees 429s and waits for the window
+        stub.exhaust()
+        with timings('sync_incremental'):
+            sync_activities(write=log.append, warn=log.append, error=log.append)
+        incremental_stats = {name: stub.stats[name] - full_stats[name] for name in stub.stats}
+        # Streams of the newest activities, waiting for the rate limit windows to reset
+        with timings('sync_streams'):
+            sync_streams(max_activities=STREAM_ACTIVITIES, wait=True, write=log.append, warn=log.append,
+                         error=log.append)
+        stream_requests = {name: stub.stats[name] - full_stats[name] - incremental_stats[name] for name in stub.stats}
+
+    # Storage and load time per point of the streams, next to the GPX files of the same
+    # activities. Those only hold the positions of the summary polyline, without time or
+    # altitude, so the comparison favours GPX.
+    stream_store = StreamStore()
+    stream_ids = stream_store.ids().tolist()
+    with timings('streams_load'):
+        stream_points = sum(len(stream_store.streams(activity_id)['time']) for activity_id in stream_ids)
+    gpx_paths = [os.path.join('API_GPX_FILES', f'{activity_id}.gpx') for activity_id in stream_ids]
+    with timings('gpx_read'):
+        gpx_points = sum(len(read_points(path)) for path in gpx_paths)
+    streams = {
+        'activities': len(stream_ids),
+        'requests': stream_requests,
+        'stream_bytes_per_point': round(os.path.getsize('streams.bin') / max(stream_points, 1), 2),
+        'gpx_bytes_per_point': round(sum(map(os.path.getsize, gpx_paths)) / max(gpx_points, 1), 2),
+        'stream_load_us_per_point': round(timings.values['streams_load'] * 1e6 / max(stream_points, 1), 3),
+        'gpx_read_us_per_point': round(timings.values['gpx_read'] * 1e6 / max(gpx_points, 1), 3),
+    }
+
+    # The pre-build steps and every page, from scratch and again with nothing changed
+    for suffix in ('', '_warm'):
+        with timings('load_tracks' + suffix):
+            store, features = load_tracks()
+        with timings('update_routes' + suffix):
+            update_routes(store, features)
+        with timings('update_spatial_index' + suffix):
+            update_spatial_index(store, features)
+        with timings('update_coverage' + suffix):
+            update_coverage(store, features)
+        with timings('load_catalog' + suffix):
+            catalog = ActivityCatalog()
+            catalog.attach_track_metrics(features)
+        with timings('generate_map_and_statistics' + suffix):
+            generate_map_and_statistics(catalog=catalog)
+        with timings('generate_heatmap_html' + suffix):
+            generate_heatmap_html()
+        with timings('generate_runs_list_html' + suffix):
+            generate_runs_list_html(catalog=catalog)
+        with timings('generate_summary_html' + suffix):
+            generate_summary_html()
+        with timings('generate_city_statistics_html' + suffix):
+            generate_city_statistics_html()
+    run_build(write=log.append)
+    with timings('run_build_up_to_date'):
+        run_build(write=log.append)
+
+    # What the app does on a page load: read the pages and the activities
+    artifacts = ArtifactStore()
+    with timings('artifact_load_cold'):
+        for path in PAGES:
+            artifacts.read(path)
+        artifacts.version('strava.db')
+    with timings('artifact_load_warm'):
+        for path in PAGES:
+            artifacts.read(path)
+        artifacts.version('strava.db')
+    with timings('catalog_load'):
+        ActivityCatalog().df
+    if with_app:
+        from streamlit.testing.v1 import AppTest
+        app = AppTest.from_file(os.path.join(REPO_FOLDER, 'streamlit_app.py'), default_timeout=600)
+        with timings('app_first_run'):
+            app.run()
+        with timings('app_rerun'):
+            app.run()
+        if app.exception:
+            log.extend(str(exception.value) for exception in app.exception)
+
+    conn = connect()
+    try:
+        stored = activity_count(conn)
+        located = conn.execute('SELECT COUNT(*) FROM activity_location WHERE city IS NOT NULL').fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        'activities': num_activities,
+        'timings': timings.values,
+        'counts': {
+            'stored_activities': stored,
+            'gpx_files': len(os.listdir('API_GPX_FILES')),
+            'located_runs': located,
+            'sync_full_requests': full_stats,
+            'sync_incremental_requests': incremental_stats,
+        },
+        'streams': streams,
+        'file_sizes': {path: os.path.getsize(path) for path in OUTPUT_FILES if os.path.exists(path)},
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'spans': report.to_dict()['spans'],
+        'counters': dict(report.counters),
+        'log_tail': [str(line) for line in log[-10:]],
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_FOLDER, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, out=sys.stdout):
+    # Print the timings next to those of a baseline run, flagging the ones that got slower
+    previous = {run['activities']: run['timings'] for run in baseline.get('runs', [])}
+    for run in results['runs']:
+        if run['activities'] not in previous:
+            continue
+        print(f"{run['activities']} activities against {baseline.get('commit') or 'baseline'}:", file=out)
+        for name, seconds in run['timings'].items():
+            before = previous[run['activities']].get(name)
+            if not before:
+                continue
+            ratio = seconds / before
+            flag = '  <-- slower' if ratio > REGRESSION_FACTOR and seconds - before > REGRESSION_SECONDS else ''
+            print(f"  {name}: {before:.3f} s -> {seconds:.3f} s ({ratio:.2f}x){flag}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sync and page generation on synthetic histories.")
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help="Numbers of activities")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic histories")
+    parser.add_argument('--output', help="Results file, a new file in benchmarks/results by default")
+    parser.add_argument('--baseline', help="Earlier results file to compare the timings with")
+    parser.add_argument('--no-app', action='store_true', help="Skip running the Streamlit app")
+    parser.add_argument('--keep', action='store_true', help="Keep the work folders")
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--single-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        # Child process: one size in the current folder
+        sys.path.insert(0, BENCHMARK_FOLDER)
+        # Streamlit warns about every st.write outside of a running app. Its levels are reset
+        # whenever the config is read, so the logger is switched off instead.
+        logging.getLogger('streamlit.runtime.scriptrunner_utils.script_run_context').disabled = True
+        with open('benchmark.log', 'w') as log, contextlib.redirect_stdout(log):
+            result = run_size(args.single, args.seed, with_app=not args.no_app, out=sys.__stdout__)
+        with open(args.single_output, 'w') as f:
+            json.dump(result, f)
+        return
+
+    results = {
+        'version': RESULTS_VERSION,
+        'created': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'runs': [],
+    }
+    for size in args.sizes:
+        work_folder = tempfile.mkdtemp(prefix=f'strava_benchmark_{size}_')
+        print(f"{size} activities in {work_folder}")
+        result_path = os.path.join(work_folder, 'result.json')
+        command = [sys.executable, os.path.abspath(__file__), '--single', str(size), '--seed', str(args.seed),
+                   '--single-output', result_path] + (['--no-app'] if args.no_app else [])
+        # The pages report progress with st.write, which warns once when not run by Streamlit
+        os.makedirs(os.path.join(work_folder, '.streamlit'))
+        with open(os.path.join(work_folder, '.streamlit', 'config.toml'), 'w') as f:
+            f.write('[global]\nshowWarningOnDirectExecution = false\n')
+        try:
+            subprocess.run(command, cwd=work_folder, check=True)
+        except subprocess.CalledProcessError as e:
+            # The work folder is kept for a look at the log
+            print(f"Benchmark of {size} activities failed ({e}), see {work_folder}/benchmark.log")
+            continue
+        with open(result_path) as f:
+            results['runs'].append(json.load(f))
+        if not args.keep:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    output = args.output or os.path.join(results_folder, f"benchmark-{results['created'].replace(':', '')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import bisect
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pandas as pd
+
+from synthetic import detail_polyline, activity_streams
+
+# Request budget of the stub per window, like Strava's 100 requests per 15 minutes but
+# with a window short enough for a benchmark
+SHORT_TERM_LIMIT = 100
+DAILY_LIMIT = 30000
+WINDOW = 2  # Seconds
+
+
+class StravaStub:
+    """
+    Local stand-in for the Strava endpoints the sync uses: 'oauth/token',
+    'athlete/activities', 'activities/{id}' and 'activities/{id}/streams'.
+
+    Every response carries the X-RateLimit-Limit and X-RateLimit-Usage headers. Requests
+    beyond the budget of the current window are answered with 429 until the window
+    resets, like the real API.
+
+    Parameters:
+    activities (list): Activities as returned by synthetic.generate_history
+    short_term_limit (int): Requests allowed per window
+    window (float): Length of the rate limit window in seconds
+    latency (float): Seconds every request takes before it is answered
+    """
+
+    def __init__(self, activities, short_term_limit=SHORT_TERM_LIMIT, window=WINDOW, latency=0.0):
+        self.short_term_limit = short_term_limit
+        self.window = window
+        self.latency = latency
+        # Activities listed without their map, so the sync has to request them one by one
+        self.without_map = set()
+        self.set_activities(activities)
+        self.stats = {'token': 0, 'list': 0, 'detail': 0, 'streams': 0, 'rate_limited': 0}
+        self._usage = {'window': 0, 'short_term': 0, 'daily': 0}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}/'
+
+    def set_activities(self, activities):
+        self.activities = sorted(activities, key=lambda activity: (activity['start_date'], activity['id']))
+        self.by_id = {activity['id']: activity for activity in self.activities}
+        self.start_times = [pd.Timestamp(activity['start_date']).timestamp() for activity in self.activities]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _count(self):
+        # Count a request against the budget, returns the usage headers and whether it is allowed
+        with self._lock:
+            window = int(time.time() // self.window)
+            if window != self._usage['window']:
+                self._usage['window'] = window
+                self._usage['short_term'] = 0
+            allowed = self._usage['short_term'] < self.short_term_limit and self._usage['daily'] < DAILY_LIMIT
+            if allowed:
+                self._usage['short_term'] += 1
+                self._usage['daily'] += 1
+            else:
+                self.stats['rate_limited'] += 1
+            return allowed, {'X-RateLimit-Limit': f"{self.short_term_limit},{DAILY_LIMIT}",
+                             'X-RateLimit-Usage': f"{self._usage['short_term']},{self._usage['daily']}"}
+
+    def exhaust(self):
+        # Use up the budget of the current window, as if another client of the same app had
+        with self._lock:
+            self._usage['window'] = int(time.time() // self.window)
+            self._usage['short_term'] = self.short_term_limit
+
+    def list_page(self, page, per_page, after=None):
+        # Newest first like Strava, or oldest first when 'after' is given
+        if after is None:
+            activities = self.activities[::-1]
+        else:
+            activities = self.activities[bisect.bisect_right(self.start_times, after):]
+        return [dict(activity, map={}) if activity['id'] in self.without_map else activity
+                for activity in activities[(page - 1) * per_page:page * per_page]]
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not urlparse(self.path).path.endswith('oauth/token'):
+                    return self._send(404, {'message': 'Record Not Found'})
+                with stub._lock:
+                    stub.stats['token'] += 1
+                self._send(200, {'token_type': 'Bearer', 'access_token': 'benchmark', 'refresh_token': 'benchmark',
+                                 'expires_at': int(time.time()) + 6 * 60 * 60})
+
+            def do_GET(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+                allowed, headers = stub._count()
+                if not allowed:
+                    return self._send(429, {'message': 'Rate Limit Exceeded'}, headers)
+
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path.endswith('/athlete/activities'):
+                    with stub._lock:
+                        stub.stats['list'] += 1
+                    after = float(query['after'][0]) if 'after' in query else None
+                    page = stub.list_page(int(query.get('page', ['1'])[0]), int(query.get('per_page', ['30'])[0]), after)
+                    return self._send(200, page, headers)
+
+                parts = url.path.rstrip('/').split('/')
+                if len(parts) >= 3 and parts[-3] == 'activities' and parts[-2].isdigit() and parts[-1] == 'streams':
+                    activity = stub.by_id.get(int(parts[-2]))
+                    if activity is None or not activity['map'].get('summary_polyline'):
+                        return self._send(404, {'message': 'Record Not Found'}, headers)
+                    with stub._lock:
+                        stub.stats['streams'] += 1
+                    return self._send(200, activity_streams(activity), headers)
+                if len(parts) >= 2 and parts[-2] == 'activities' and parts[-1].isdigit():
+                    activity = stub.by_id.get(int(parts[-1]))
+                    if activity is None:
+                        return self._send(404, {'message': 'Record Not Found'}, headers)
+                    with stub._lock:
+                        stub.stats['detail'] += 1
+                    summary = activity['map'].get('summary_polyline') or ''
+                    detail = dict(activity, map={'summary_polyline': summary,
+                                                 'polyline': detail_polyline(activity) if summary else ''})
+                    return self._send(200, detail, headers)
+                self._send(404, {'message': 'Record Not Found'}, headers)
+
+        return Handler
@@ -0,0 +1,205 @@
+import json
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+import polyline
+
+# City centers the synthetic athlete trains in, with the share of activities in each.
+# Most training happens at home, some on trips.
+CITIES = [
+    ('Copenhagen', 'Denmark', 55.6761, 12.5683, 0.70),
+    ('Aarhus', 'Denmark', 56.1629, 10.2039, 0.10),
+    ('Berlin', 'Germany', 52.5200, 13.4050, 0.08),
+    ('Munich', 'Germany', 48.1351, 11.5820, 0.05),
+    ('Stockholm', 'Sweden', 59.3293, 18.0686, 0.04),
+    ('Zurich', 'Switzerland', 47.3769, 8.5417, 0.03),
+]
+# Half width of the square boundary around every city, in degrees
+CITY_RADIUS = 0.25
+
+# Activity types and their share, speed range in m/s and distance range in km
+ACTIVITY_TYPES = [
+    ('Run', 0.85, (2.6, 3.9), (3, 21)),
+    ('Ride', 0.10, (6.0, 9.0), (15, 80)),
+    ('Walk', 0.05, (1.2, 1.6), (2, 8)),
+]
+# Share of activities that repeat one of the athlete's usual routes
+REPEAT_SHARE = 0.6
+# Point spacing of the summary polyline in the activity list and of the detailed one
+SUMMARY_SPACING = 100  # Meters
+DETAIL_SPACING = 10  # Meters
+# GPS noise added to every recording of a route
+GPS_NOISE = 5  # Meters
+
+METERS_PER_DEGREE = 111320.0
+
+
+def encode_polyline(lat, lon):
+    # Google encoded polyline of many points at once, the same string polyline.encode gives
+    values = np.round(np.column_stack((lat, lon)) * 1e5).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=0).ravel()
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    # Five bit chunks from the lowest up, every chunk but the last has the 0x20 flag set
+    chunks = (zigzag[:, None] >> np.arange(0, 35, 5)) & 0x1F
+    used = np.arange(7) < np.maximum(1, (np.log2(np.maximum(zigzag, 1)) // 5 + 1).astype(np.int64))[:, None]
+    last = used & ~np.roll(used, -1, axis=1)
+    return (chunks + 63 + np.where(used & ~last, 0x20, 0))[used].astype(np.uint8).tobytes().decode('ascii')
+
+
+def _walk(rng, lat, lon, length, spacing):
+    # Random walk with a slowly turning heading; loops turn back towards the start halfway
+    steps = max(int(length / spacing), 2)
+    turn = rng.normal(0, 0.25, steps).cumsum()
+    heading = rng.uniform(0, 2 * np.pi) + turn
+    is_loop = rng.random() < 0.5
+    if is_loop:
+        heading[steps // 2:] += np.pi
+    dy = np.cos(heading) * spacing / METERS_PER_DEGREE
+    dx = np.sin(heading) * spacing / (METERS_PER_DEGREE * np.cos(np.radians(lat)))
+    lats = lat + np.concatenate(([0], dy.cumsum()))
+    lons = lon + np.concatenate(([0], dx.cumsum()))
+    if is_loop:
+        # Close the loop by spreading the remaining offset over the track
+        weight = np.linspace(0, 1, len(lats))
+        lats -= weight * (lats[-1] - lat)
+        lons -= weight * (lons[-1] - lon)
+    return lats, lons
+
+
+def _resample(lats, lons, spacing, rng, noise):
+    # Points every spacing meters along the track, with GPS noise
+    dy = np.diff(lats) * METERS_PER_DEGREE
+    dx = np.diff(lons) * METERS_PER_DEGREE * np.cos(np.radians(lats[0]))
+    distance = np.concatenate(([0], np.hypot(dx, dy).cumsum()))
+    samples = np.linspace(0, distance[-1], max(int(distance[-1] / spacing), 1) + 1)
+    lat = np.interp(samples, distance, lats) + rng.normal(0, noise / METERS_PER_DEGREE, len(samples))
+    lon = np.interp(samples, distance, lons) + rng.normal(0, noise / METERS_PER_DEGREE, len(samples))
+    return lat, lon, float(distance[-1])
+
+
+def generate_history(num_activities, seed=0, end=None):
+    """
+    Generate the activity history of a synthetic athlete in the format of Strava's
+    'athlete/activities' endpoint.
+
+    Activities are spread over the years before end, about one per day, in the cities of
+    CITIES. A share of them repeat one of a pool of usual routes with GPS noise, so that
+    route grouping, heatmap and coverage see the overlap of a real history.
+
+    Parameters:
+    num_activities (int): Number of activities
+    seed (int): Seed of the random generator, the same seed gives the same history
+    end (datetime): Start time of the latest activity, now if not given
+
+    Returns:
+    list: Activities sorted by start date, each with 'map.summary_polyline'
+    """
+    rng = np.random.default_rng(seed)
+    end = end or datetime.now(timezone.utc).replace(microsecond=0)
+    city_weights = np.array([city[4] for city in CITIES])
+    type_weights = np.array([activity_type[1] for activity_type in ACTIVITY_TYPES])
+
+    # Usual routes per city and type, shared by the repeated activities
+    usual_routes = {}
+    activities = []
+    start = end - timedelta(days=int(num_activities * 1.1))
+    times = np.sort(rng.uniform(0, (end - start).total_seconds(), num_activities))
+    for i, offset in enumerate(times):
+        city_index = rng.choice(len(CITIES), p=city_weights / city_weights.sum())
+        type_index = rng.choice(len(ACTIVITY_TYPES), p=type_weights / type_weights.sum())
+        name, country, city_lat, city_lon, _ = CITIES[city_index]
+        activity_type, _, speed_range, distance_range = ACTIVITY_TYPES[type_index]
+
+        routes = usual_routes.setdefault((city_index, type_index), [])
+        if routes and rng.random() < REPEAT_SHARE:
+            lats, lons = routes[rng.integers(len(routes))]
+        else:
+            lats, lons = _walk(rng, city_lat, city_lon, rng.uniform(*distance_range) * 1000, SUMMARY_SPACING / 2)
+            # Move the track so its middle point, which locates it, is well inside the city
+            middle = len(lats) // 2
+            lats = lats - lats[middle] + city_lat + rng.uniform(-0.6, 0.6) * CITY_RADIUS
+            lons = lons - lons[middle] + city_lon + rng.uniform(-0.6, 0.6) * CITY_RADIUS
+            if len(routes) < 5 + num_activities // 200:
+                routes.append((lats, lons))
+
+        summary_lat, summary_lon, distance = _resample(lats, lons, SUMMARY_SPACING, rng, GPS_NOISE)
+        moving_time = int(distance / rng.uniform(*speed_range))
+        start_date = start + timedelta(seconds=float(offset))
+        utc_offset = timedelta(hours=2 if 4 <= start_date.month <= 9 else 1)
+        activity_id = 10 ** 9 + i * 7 + int(rng.integers(7))
+
+        activities.append({
+            'id': activity_id,
+            'name': f"{name} {activity_type.lower()}",
+            'type': activity_type,
+            'start_date': start_date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'start_date_local': (start_date + utc_offset).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'distance': round(distance, 1),
+            'moving_time': moving_time,
+            'elapsed_time': moving_time + int(rng.integers(0, 600)),
+            'total_elevation_gain': round(float(rng.gamma(2, 20)), 1),
+            'map': {'summary_polyline': encode_polyline(summary_lat, summary_lon)},
+        })
+    return activities
+
+
+def _detail_points(activity):
+    # Full resolution points of an activity, made up from its summary polyline the same way
+    # every time they are requested
+    points = np.array(polyline.decode(activity['map']['summary_polyline']))
+    rng = np.random.default_rng(activity['id'])
+    lat, lon, _ = _resample(points[:, 0], points[:, 1], DETAIL_SPACING, rng, GPS_NOISE)
+    return lat, lon, rng
+
+
+def detail_polyline(activity):
+    # The full resolution polyline of an activity
+    lat, lon, _ = _detail_points(activity)
+    return encode_polyline(lat, lon)
+
+
+def activity_streams(activity):
+    # The streams of an activity as 'activities/{id}/streams' returns them with key_by_type:
+    # position, time at the activity's average speed, distance, and a random walk for the
+    # altitude, heart rate and cadence
+    lat, lon, rng = _detail_points(activity)
+    step = np.hypot(np.diff(lat) * METERS_PER_DEGREE, np.diff(lon) * METERS_PER_DEGREE * np.cos(np.radians(lat[0])))
+    distance = np.concatenate(([0], step.cumsum()))
+    speed = activity['distance'] / max(activity['moving_time'], 1)
+    n = len(lat)
+    streams = {
+        'latlng': np.column_stack((lat, lon)).round(6),
+        'time': np.round(distance / speed).astype(np.int64),
+        'distance': distance.round(1),
+        'altitude': (20 + rng.normal(0, 0.3, n).cumsum()).round(1),
+        'heartrate': np.clip(140 + rng.normal(0, 1, n).cumsum(), 90, 195).round().astype(np.int64),
+    }
+    if activity['type'] == 'Run':
+        streams['cadence'] = np.clip(84 + rng.normal(0, 2, n), 70, 100).round().astype(np.int64)
+    return {name: {'data': data.tolist(), 'series_type': 'distance', 'original_size': n, 'resolution': 'high'}
+            for name, data in streams.items()}
+
+
+def write_csv(activities, path):
+    # The activity CSV the database is seeded from, numbered by date like a full sync
+    df = pd.DataFrame([{key: activity[key] for key in
+                        ('id', 'name', 'type', 'start_date_local', 'distance', 'moving_time', 'elapsed_time',
+                         'total_elevation_gain')} for activity in activities])
+    df['start_date_local'] = pd.to_datetime(df['start_date_local'])
+    df = df.sort_values(by='start_date_local', kind='stable')
+    df['run_number'] = range(1, len(df) + 1)
+    df.to_csv(path, index=False)
+
+
+def write_boundaries(path):
+    # Square city boundaries, so locations resolve offline instead of through Nominatim
+    features = [{
+        'type': 'Feature',
+        'properties': {'city': name, 'country': country},
+        'geometry': {'type': 'Polygon', 'coordinates': [[
+            [lon - CITY_RADIUS, lat - CITY_RADIUS], [lon + CITY_RADIUS, lat - CITY_RADIUS],
+            [lon + CITY_RADIUS, lat + CITY_RADIUS], [lon - CITY_RADIUS, lat + CITY_RADIUS],
+            [lon - CITY_RADIUS, lat - CITY_RADIUS]]]},
+    } for name, country, lat, lon, _ in CITIES]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
@@ -0,0 +1,343 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import datetime
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from activity_catalog import ActivityCatalog
+from activity_db import connect_readonly, revision, runs_without_location
+from ingest import track_features_path
+from instrumentation import span, count, start_run, finish_run, PROFILERS
+from track_store import TrackStore, TrackSources, track_store_path
+from routes import update_routes, routes_state_path
+from spatial_index import update_spatial_index, spatial_index_path
+from tile_coverage import update_coverage, coverage_state_path
+from stravaDash import (generate_map_and_statistics, generate_heatmap_html, generate_runs_list_html,
+                        generate_summary_html, generate_city_statistics_html, update_run_locations, load_tracks,
+                        gpx_folder, heatmap_map_path)
+
+# Input hashes of the last successful build of every stage
+build_state_path = '.build_state.json'
+
+# A stage rebuilds its outputs when the content of one of its inputs changed. 'extra' returns
+# anything else the output depends on, such as the revision of the stored activities or the
+# current date for the summary.
+Stage = namedtuple('Stage', ['name', 'inputs', 'outputs', 'build', 'extra'])
+
+
+def _db_version(*names):
+    # The database also holds data written by the stages themselves, such as the activity
+    # locations, so the stages depend on the revisions of what they read instead of the file.
+    # It is opened read-only, so checking a build never creates or seeds it.
+    conn = connect_readonly()
+    if conn is None:
+        return ','.join(f"{name}:missing" for name in names)
+    try:
+        return ','.join(f"{name}:{revision(conn, name)}" for name in names)
+    finally:
+        conn.close()
+
+
+def _locations_complete():
+    # Runs whose location could not be resolved, such as during an offline build, keep the
+    # prepare steps out of date so that they are tried again by the next build
+    conn = connect_readonly()
+    if conn is None:
+        return True
+    try:
+        return not runs_without_location(conn)
+    finally:
+        conn.close()
+
+
+def build_stages(incremental=True):
+    # The stages do not depend on each other, so they can all run at the same time
+    return [
+        Stage('map', [track_store_path, coverage_state_path], ['activity_map.html'],
+              lambda catalog, tracks: generate_map_and_statistics(incremental=incremental, catalog=catalog,
+                                                                  tracks=tracks),
+              lambda: _db_version('activities', 'routes')),
+        Stage('heatmap', [track_store_path], [heatmap_map_path],
+              lambda catalog, tracks: generate_heatmap_html(incremental=incremental, catalog=catalog, tracks=tracks),
+              lambda: _db_version('activities')),
+        Stage('runs_list', [track_store_path], ['runs_list.html'],
+              lambda catalog, tracks: generate_runs_list_html(catalog=catalog, tracks=tracks),
+              lambda: _db_version('activities', 'routes')),
+        Stage('summary', [], ['generated_summary.html'],
+              lambda catalog, tracks: generate_summary_html(),
+              lambda: f"{_db_version('activities')}:{datetime.now().strftime('%Y-%m-%d')}"),
+        Stage('city_stats', [], ['generated_city_statistics_from_csv.html'],
+              lambda catalog, tracks: generate_city_statistics_html(),
+              lambda: _db_version('activities', 'locations')),
+    ]
+
+
+STAGE_NAMES = [stage.name for stage in build_stages()]
+# Steps that bring the shared data up to date before the stages run, each timed on its own
+PREPARE_STEPS = ['load_tracks', 'locations', 'routes', 'spatial_index', 'coverage']
+# The track store is compacted once older versions of changed tracks take up more than this
+# fraction of it
+COMPACT_FRACTION = 0.25
+# Files the prepare steps read and write. The steps run again when one of them changed since
+# they last completed, when the activities changed, when GPX files wait to be imported, or
+# when runs were left without a location.
+PREPARE_FILES = [track_store_path, track_features_path, routes_state_path, spatial_index_path, coverage_state_path]
+
+
+class FileHasher:
+    """
+    Content hashes of input files, reusing the previous hash while size and mtime match.
+
+    Parameters:
+    known (dict): Maps path to {'size', 'mtime_ns', 'hash'} from the previous build
+    """
+
+    def __init__(self, known=None):
+        self.known = dict(known or {})
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        entry = self.known.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            count('cache.file_hash.hits')
+            return entry['hash']
+        count('cache.file_hash.misses')
+        content = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                content.update(block)
+        self.known[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': content.hexdigest()}
+        return content.hexdigest()
+
+    def path_hash(self, path):
+        # Folders are hashed over the names and hashes of all files inside them
+        if os.path.isdir(path):
+            content = hashlib.sha1()
+            for root, _, files in sorted(os.walk(path)):
+                for file_name in sorted(files):
+                    file_path = os.path.join(root, file_name)
+                    content.update(f"{file_path}:{self.file_hash(file_path)}\n".encode())
+            return content.hexdigest()
+        if os.path.exists(path):
+            return self.file_hash(path)
+        return 'missing'
+
+    def prepare_digest(self):
+        content = hashlib.sha1()
+        for path in PREPARE_FILES:
+            content.update(f"{path}:{self.path_hash(path)}\n".encode())
+        content.update(_db_version('activities').encode())
+        return content.hexdigest()
+
+    def stage_digest(self, stage):
+        content = hashlib.sha1()
+        for path in stage.inputs:
+            content.update(f"{path}:{self.path_hash(path)}\n".encode())
+        if stage.extra is not None:
+            content.update(stage.extra().encode())
+        return content.hexdigest()
+
+
+def load_build_state():
+    if not os.path.exists(build_state_path):
+        return {}
+    try:
+        with open(build_state_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error loading build state: {e}")
+        return {}
+
+
+def save_build_state(state):
+    tmp_path = build_state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, build_state_path)
+
+
+def _has_unimported_tracks():
+    # GPX files that are new or changed since they were imported, without importing them
+    return bool(TrackSources().changed_files(gpx_folder, TrackStore()))
+
+
+def _stale_stages(stages, hasher, built_digests, force=False, tracks_pending=False):
+    # Stages whose outputs are missing or whose inputs changed since their last build
+    return [stage for stage in stages
+            if force
+            or (tracks_pending and track_store_path in stage.inputs)
+            or not all(os.path.exists(path) for path in stage.outputs)
+            or built_digests.get(stage.name) != hasher.stage_digest(stage)]
+
+
+def _prepare(incremental=True):
+    # Bring the track store, features, run locations, routes, spatial index and explored tiles
+    # up to date, so that the stages only read them. Routes are named after the cities of
+    # their runs, so the locations are stored first.
+    with span('prepare.load_tracks', profile=True):
+        store, features = load_tracks()
+    with span('prepare.locations', profile=True):
+        update_run_locations(features, incremental)
+    with span('prepare.routes', profile=True):
+        update_routes(store, features)
+    with span('prepare.spatial_index', profile=True):
+        update_spatial_index(store, features)
+    with span('prepare.coverage', profile=True):
+        update_coverage(store, features)
+    return store, features
+
+
+def _compact_track_store(store, hasher, built_digests, state):
+    # update_heatmap_tiles subtracts a changed track by its older version, so they are only
+    # dropped while the heatmap is up to date with the store. Compacting keeps the tracks, so
+    # digests that matched the store before are moved to the compacted file.
+    if store.superseded_bytes() <= COMPACT_FRACTION * os.path.getsize(store.path):
+        return
+    stages = build_stages()
+    heatmap = next(stage for stage in stages if stage.name == 'heatmap')
+    if built_digests.get(heatmap.name) != hasher.stage_digest(heatmap):
+        return
+    before = {stage.name: hasher.stage_digest(stage) for stage in stages}
+    prepared = hasher.prepare_digest()
+    with span('build.compact'):
+        store.compact()
+    for stage in stages:
+        if built_digests.get(stage.name) == before[stage.name]:
+            built_digests[stage.name] = hasher.stage_digest(stage)
+    if state.get('prepared') == prepared:
+        state['prepared'] = hasher.prepare_digest()
+
+
+def _build_stage(stage, catalog, tracks):
+    with span(f"build.{stage.name}", profile=True):
+        stage.build(catalog, tracks)
+
+
+def run_build(only=None, force=False, dry_run=False, incremental=True, max_workers=None, write=print,
+              on_stage=None):
+    """
+    Regenerate the pages whose inputs changed since they were last built.
+
+    Nothing is read beyond file stats and database revisions until something is out of
+    date. The prepare steps (see PREPARE_STEPS) only run when new or changed GPX files wait
+    to be imported or their own inputs changed. Stages that are out of date run
+    concurrently and share the loaded tracks and one ActivityCatalog, with the geometry
+    metrics of the tracks attached. The input hashes of a stage are recorded once
+    it succeeds, so a failed stage is retried on the next build.
+
+    Parameters:
+    only (list): Names of the stages to consider, all stages if None
+    force (bool): If True, rebuild the selected stages even if they are up to date
+    dry_run (bool): If True, only report which stages would be rebuilt
+    incremental (bool): Passed to the prepare steps and stages that keep their own caches
+    write (callable): Used to report progress
+    on_stage (callable): Called with (stage name, status) whenever the status of a stage
+        changes: 'up to date', 'running', 'built' or 'failed'
+
+    Returns:
+    dict: Maps stage name to 'up to date', 'stale', 'built' or 'failed'
+    """
+    start_time = time.time()
+    stages = [stage for stage in build_stages(incremental) if only is None or stage.name in only]
+    state = load_build_state()
+    built_digests = state.get('stages', {})
+    hasher = FileHasher(state.get('files'))
+
+    # Check what is out of date first, without loading any tracks
+    tracks_pending = _has_unimported_tracks()
+    prepare = force or tracks_pending or state.get('prepared') != hasher.prepare_digest()
+    stale = _stale_stages(stages, hasher, built_digests, force, tracks_pending)
+    if dry_run:
+        write(f"prepare: {'stale' if prepare else 'up to date'}")
+
+    tracks = None
+    if prepare and not dry_run:
+        tracks = _prepare(incremental)
+        state['prepared'] = hasher.prepare_digest() if _locations_complete() else None
+        # The prepare steps may have changed the inputs of any stage
+        stale = _stale_stages(stages, hasher, built_digests, force)
+
+    results = {stage.name: 'stale' if stage in stale else 'up to date' for stage in stages}
+    if on_stage is not None:
+        for stage in stages:
+            if stage not in stale:
+                on_stage(stage.name, 'up to date')
+    if dry_run or not stale:
+        if tracks is not None:
+            save_build_state({**state, 'files': hasher.known, 'stages': built_digests})
+        for name, status in results.items():
+            write(f"{name}: {status}")
+        return results
+
+    if tracks is None:
+        with span('prepare.load_tracks', profile=True):
+            tracks = load_tracks()
+    with span('prepare.catalog'):
+        catalog = ActivityCatalog()
+        catalog.attach_track_metrics(tracks[1])
+    # Worker threads report to the Streamlit page that started the build, if any
+    ctx = get_script_run_ctx(suppress_warning=True)
+    with ThreadPoolExecutor(max_workers=max_workers or len(stale),
+                            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as executor:
+        futures = {executor.submit(_build_stage, stage, catalog, tracks): stage for stage in stale}
+        if on_stage is not None:
+            for stage in stale:
+                on_stage(stage.name, 'running')
+        for future in as_completed(futures):
+            stage = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                write(f"{stage.name}: failed ({e})")
+                results[stage.name] = 'failed'
+                built_digests.pop(stage.name, None)
+            else:
+                results[stage.name] = 'built'
+            if on_stage is not None:
+                on_stage(stage.name, results[stage.name])
+
+    # Record the inputs as they are after the build; stages may update their own inputs,
+    # such as the geocode cache
+    for stage in stale:
+        if results[stage.name] == 'built':
+            built_digests[stage.name] = hasher.stage_digest(stage)
+    _compact_track_store(tracks[0], hasher, built_digests, state)
+    save_build_state({**state, 'files': hasher.known, 'stages': built_digests})
+
+    for name, status in results.items():
+        write(f"{name}: {status}")
+    write(f"Build finished in {time.time() - start_time:.1f} seconds.")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regenerate the pages whose inputs changed.")
+    parser.add_argument('--force', action='store_true', help="Rebuild the selected stages even if they are up to date")
+    parser.add_argument('--only', nargs='+', choices=STAGE_NAMES, help="Only consider these stages")
+    parser.add_argument('--dry-run', action='store_true', help="Only report which stages would be rebuilt")
+    parser.add_argument('--profile', nargs='*', choices=PREPARE_STEPS + STAGE_NAMES,
+                        help="Profile these steps and stages, all of them if none are given")
+    parser.add_argument('--profiler', choices=PROFILERS, help="Profiler used with --profile, cProfile by default")
+    args = parser.parse_args()
+
+    # update_worker imports this module, so the lock is imported here
+    from update_worker import update_lock, UpdateInProgress
+
+    # Never write the outputs at the same time as an update started from the app; a dry run
+    # only reads them
+    try:
+        with update_lock() if not args.dry_run else nullcontext():
+            # Without --profile, the STRAVA_PROFILE environment variable decides what is profiled
+            start_run('build', profile=(args.profile or ['all']) if args.profile is not None else None,
+                      profiler=args.profiler)
+            results = run_build(only=args.only, force=args.force, dry_run=args.dry_run)
+            finish_run('failed' if 'failed' in results.values() else 'finished')
+    except UpdateInProgress as e:
+        print(e)
+        raise SystemExit(1)
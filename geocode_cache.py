@@ -0,0 +1,211 @@
+import json
+import os
+import time
+import numpy as np
+from geopy.geocoders import Nominatim
+
+from instrumentation import span, count
+
+# Path to the on-disk geocoding cache
+geocode_cache_path = 'geocode_cache.json'
+
+# Geohash cells of precision 6 are about 1.2 x 0.6 km, roughly one neighbourhood
+GEOHASH_PRECISION = 6
+# Found places are kept for half a year, cells without a city are retried after a week
+CACHE_TTL = 180 * 24 * 60 * 60
+NEGATIVE_CACHE_TTL = 7 * 24 * 60 * 60
+# When the cache grows beyond this, the least recently used cells are dropped
+MAX_CACHE_ENTRIES = 20000
+
+_GEOHASH_ALPHABET = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+
+
+def geohash_encode(lat, lon, precision=GEOHASH_PRECISION):
+    """
+    Encode arrays of coordinates as geohash strings.
+
+    Parameters:
+    lat, lon (array-like): Coordinates in degrees
+    precision (int): Number of characters per geohash
+
+    Returns:
+    np.ndarray: Geohash strings, one per point
+    """
+    lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+    lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+    num_bits = 5 * precision
+    lon_bits = (num_bits + 1) // 2
+    lat_bits = num_bits // 2
+
+    # Quantize both axes, then interleave the bits starting with longitude
+    lat_cells = np.clip(((lat + 90) / 180 * (1 << lat_bits)).astype(np.int64), 0, (1 << lat_bits) - 1)
+    lon_cells = np.clip(((lon + 180) / 360 * (1 << lon_bits)).astype(np.int64), 0, (1 << lon_bits) - 1)
+    code = np.zeros(len(lat), dtype=np.int64)
+    for bit in range(num_bits):
+        if bit % 2 == 0:
+            value = (lon_cells >> (lon_bits - 1 - bit // 2)) & 1
+        else:
+            value = (lat_cells >> (lat_bits - 1 - bit // 2)) & 1
+        code = (code << 1) | value
+
+    # Every 5 bits become one base32 character
+    chars = [_GEOHASH_ALPHABET[(code >> (5 * (precision - 1 - i))) & 31] for i in range(precision)]
+    return np.array([''.join(cell) for cell in zip(*chars)]) if len(code) else np.array([], dtype=str)
+
+
+def geohash_decode(cells):
+    """
+    Decode geohash strings of equal length to the centres of their cells.
+
+    Returns:
+    (np.ndarray, np.ndarray): Latitudes and longitudes in degrees
+    """
+    if len(cells) == 0:
+        return np.zeros(0), np.zeros(0)
+    precision = len(cells[0])
+    lookup = {char: value for value, char in enumerate(_GEOHASH_ALPHABET)}
+    code = np.array([sum(lookup[char] << (5 * (precision - 1 - i)) for i, char in enumerate(cell))
+                     for cell in cells], dtype=np.int64)
+    num_bits = 5 * precision
+    lon_bits = (num_bits + 1) // 2
+    lat_bits = num_bits // 2
+
+    # Split the interleaved bits back into the two axes
+    lat_cells = np.zeros(len(code), dtype=np.int64)
+    lon_cells = np.zeros(len(code), dtype=np.int64)
+    for bit in range(num_bits):
+        value = (code >> (num_bits - 1 - bit)) & 1
+        if bit % 2 == 0:
+            lon_cells = (lon_cells << 1) | value
+        else:
+            lat_cells = (lat_cells << 1) | value
+    lat = (lat_cells + 0.5) / (1 << lat_bits) * 180 - 90
+    lon = (lon_cells + 0.5) / (1 << lon_bits) * 360 - 180
+    return lat, lon
+
+
+# Helper function to extract city and country names from location data
+def get_city_and_country(location):
+    city, country = None, None
+    if location and location.raw and 'address' in location.raw:
+        address = location.raw['address']
+        city = address.get('city') or address.get('town') or address.get('village')
+        country = address.get('country', 'Unknown')
+    return city, country
+
+
+class GeocodeCache:
+    """
+    On-disk cache of reverse geocoding results keyed by geohash cell.
+
+    Entries expire after CACHE_TTL, or NEGATIVE_CACHE_TTL for cells where no city was
+    found. The cache is bounded to MAX_CACHE_ENTRIES by evicting the least recently
+    used cells when it is saved.
+    """
+
+    def __init__(self, path=geocode_cache_path):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Error loading geocode cache: {e}")
+
+    def get(self, cell):
+        # Return (city, country) for a cell, or None when it is unknown or expired
+        entry = self.entries.get(cell)
+        now = time.time()
+        if entry is not None:
+            found = entry['city'] is not None or entry['country'] is not None
+            ttl = CACHE_TTL if found else NEGATIVE_CACHE_TTL
+            if now - entry['time'] < ttl:
+                entry['used'] = now
+                self.hits += 1
+                return entry['city'], entry['country']
+        self.misses += 1
+        return None
+
+    def put(self, cell, city, country):
+        now = time.time()
+        self.entries[cell] = {'city': city, 'country': country, 'time': now, 'used': now}
+
+    def save(self):
+        if len(self.entries) > MAX_CACHE_ENTRIES:
+            keep = sorted(self.entries.items(), key=lambda item: item[1]['used'], reverse=True)
+            self.entries = dict(keep[:MAX_CACHE_ENTRIES])
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+
+def cluster_points(lat, lon, precision=GEOHASH_PRECISION):
+    """
+    Group points by geohash cell.
+
+    Returns:
+    (np.ndarray, np.ndarray, np.ndarray): The distinct cells, the cell index of every
+        point and the (lat, lon) centroid of the points in each cell
+    """
+    cells, inverse = np.unique(geohash_encode(lat, lon, precision), return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(cells))
+    centroids = np.column_stack((
+        np.bincount(inverse, weights=lat, minlength=len(cells)) / counts,
+        np.bincount(inverse, weights=lon, minlength=len(cells)) / counts,
+    ))
+    return cells, inverse, centroids
+
+
+def reverse_geocode_points(lat, lon, cache=None, geolocator=None):
+    """
+    Find city and country for many points, with one lookup per neighbourhood.
+
+    Points are grouped into geohash cells. Each cell is looked up in the cache and only
+    cells missing from it are sent to Nominatim, one request per cell.
+
+    Parameters:
+    lat, lon (np.ndarray): Coordinates in degrees
+    cache (GeocodeCache): Cache to read and update, saved before returning
+
+    Returns:
+    list: (city, country) per point, or None where geocoding failed
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if len(lat) == 0:
+        return []
+    if cache is None:
+        cache = GeocodeCache()
+    if geolocator is None:
+        geolocator = Nominatim(user_agent="strava_city_stats")
+
+    cells, inverse, centroids = cluster_points(lat, lon)
+    cell_results = []
+    for cell, (cell_lat, cell_lon) in zip(cells, centroids):
+        result = cache.get(cell)
+        if result is None:
+            try:
+                # Add a delay to respect Nominatim's usage policy
+                time.sleep(1)
+
+                # Reverse geocode to get city and country
+                count('geocode.requests')
+                with span('geocode.nominatim'):
+                    location = geolocator.reverse(f"{cell_lat:.5f},{cell_lon:.5f}", exactly_one=True)
+                result = get_city_and_country(location)
+                cache.put(cell, *result)
+            except Exception as e:
+                count('geocode.errors')
+                print(f"Geocoding error for cell {cell}: {e}")
+        cell_results.append(result)
+
+    cache.save()
+    count('cache.geocode.hits', cache.hits)
+    count('cache.geocode.misses', cache.misses)
+    print(f"Geocoded {len(lat)} points in {len(cells)} cells "
+          f"({cache.hits} cache hits, {cache.misses} misses).")
+    return [cell_results[i] for i in inverse]
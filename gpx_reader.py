@@ -0,0 +1,123 @@
+import mmap
+import re
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+# Byte-level patterns for the parts of a GPX file we read. Scanning the raw bytes avoids
+# building an object per track point, which is what makes gpxpy slow on large files.
+# Patterns start with a literal so that the regex engine can skip ahead quickly.
+_TRACK_START = re.compile(rb'<trk[\s>]')
+_SEGMENT_START = re.compile(rb'<trkseg[\s>]')
+_POINT = re.compile(rb'<trkpt[\s>]')
+_LAT = re.compile(rb' lat="([^"]+)"')
+_LON = re.compile(rb' lon="([^"]+)"')
+# Fallbacks for files that use other whitespace, single quotes or spaces around '='
+_LAT_ANY = re.compile(rb'\blat\s*=\s*["\']([^"\']+)["\']')
+_LON_ANY = re.compile(rb'\blon\s*=\s*["\']([^"\']+)["\']')
+_ELEVATION = re.compile(rb'<ele>\s*([^<\s]+)\s*</ele>')
+_TIME = re.compile(rb'<time>\s*([^<\s]+)\s*</time>')
+
+# One track segment: coords is an (N, 2) array of (lat, lon), time and elevation are
+# None unless requested
+GpxSegment = namedtuple('GpxSegment', ['track', 'segment', 'coords', 'time', 'elevation'])
+
+
+def _to_float(values):
+    # Convert a list of ASCII numbers to a float array without intermediate objects
+    if not values:
+        return np.zeros(0, dtype=np.float64)
+    return np.fromiter(map(float, values), dtype=np.float64, count=len(values))
+
+
+def _per_point(segment, pattern, num_points):
+    # Slow path for files where some points lack the element: look it up point by point
+    values = [None] * num_points
+    starts = [match.start() for match in _POINT.finditer(segment)] + [len(segment)]
+    for i in range(num_points):
+        match = pattern.search(segment, starts[i], starts[i + 1])
+        if match:
+            values[i] = match.group(1)
+    return values
+
+
+def _read_elevation(segment, num_points):
+    values = _ELEVATION.findall(segment)
+    if len(values) == num_points:
+        return _to_float(values)
+    values = _per_point(segment, _ELEVATION, num_points)
+    return np.array([float(value) if value is not None else np.nan for value in values], dtype=np.float64)
+
+
+def _read_time(segment, num_points):
+    values = _TIME.findall(segment)
+    if len(values) != num_points:
+        values = _per_point(segment, _TIME, num_points)
+    strings = [value.decode('ascii') if value is not None else None for value in values]
+    # Timestamps are returned as naive UTC datetime64 values
+    return pd.to_datetime(strings, utc=True, format='ISO8601').tz_localize(None).values
+
+
+def _read_segment(track_index, segment_index, segment, with_time, with_elevation):
+    num_points = len(_POINT.findall(segment))
+    lat = _LAT.findall(segment)
+    lon = _LON.findall(segment)
+    if len(lat) != num_points or len(lon) != num_points:
+        lat = _LAT_ANY.findall(segment)
+        lon = _LON_ANY.findall(segment)
+    if len(lat) != num_points or len(lon) != num_points:
+        raise ValueError(f"Track point without lat/lon in track {track_index}, segment {segment_index}")
+
+    coords = np.column_stack((_to_float(lat), _to_float(lon)))
+    time = _read_time(segment, num_points) if with_time else None
+    elevation = _read_elevation(segment, num_points) if with_elevation else None
+    return GpxSegment(track_index, segment_index, coords, time, elevation)
+
+
+def iter_segments(file_path, with_time=False, with_elevation=False):
+    """
+    Stream the track segments of a GPX file without building a full object tree.
+
+    The file is memory-mapped and scanned segment by segment, so only one segment is
+    held in memory at a time. All tracks and all segments are returned.
+
+    Parameters:
+    file_path (str): Path of the GPX file
+    with_time (bool): If True, also read the timestamp of every point
+    with_elevation (bool): If True, also read the elevation of every point
+
+    Yields:
+    GpxSegment: Track index, segment index and the NumPy arrays of the segment
+    """
+    with open(file_path, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            track_index = 0
+            track = _TRACK_START.search(data)
+            while track:
+                track_end = data.find(b'</trk>', track.end())
+                if track_end < 0:
+                    track_end = len(data)
+
+                segment_index = 0
+                segment = _SEGMENT_START.search(data, track.end(), track_end)
+                while segment:
+                    segment_end = data.find(b'</trkseg>', segment.end(), track_end)
+                    if segment_end < 0:
+                        segment_end = track_end
+                    yield _read_segment(track_index, segment_index, data[segment.start():segment_end],
+                                        with_time, with_elevation)
+                    segment_index += 1
+                    segment = _SEGMENT_START.search(data, segment_end, track_end)
+
+                track_index += 1
+                track = _TRACK_START.search(data, track_end)
+
+
+def read_points(file_path):
+    # Read all track points of a GPX file as one (N, 2) array of (lat, lon)
+    segments = [segment.coords for segment in iter_segments(file_path)]
+    if not segments:
+        return np.zeros((0, 2), dtype=np.float64)
+    return np.concatenate(segments)
@@ -0,0 +1,275 @@
+import os
+import shutil
+import numpy as np
+from PIL import Image
+
+from instrumentation import span, count, count_written
+from ingest import track_fingerprint
+from track_store import COORD_SCALE
+
+# Tiles are written where Streamlit's static file serving picks them up
+heatmap_tile_folder = os.path.join('static', 'heatmap')
+heatmap_tile_url = '/app/static/heatmap/{z}/{x}/{y}.png'
+# Per-pixel activity counts of all zoom levels and the activities (with the fingerprints of
+# their tracks) they include
+heatmap_state_path = 'heatmap_state.npz'
+
+TILE_SIZE = 256
+MIN_HEATMAP_ZOOM = 0
+MAX_HEATMAP_ZOOM = 14
+# Number of activities crossing a pixel that gives the brightest colour. The scale is fixed,
+# so tiles rebuilt at different times stay consistent with each other.
+SATURATION_COUNT = 100
+# Activities rasterised together; keeps the sample arrays of a batch small
+BATCH_ACTIVITIES = 256
+# Bump whenever the stored counts change meaning, to force a full rebuild
+HEATMAP_VERSION = 2
+
+# Web Mercator is undefined at the poles
+MAX_LATITUDE = 85.05112878
+
+# Colour ramp from faint red to white, indexed by intensity
+_RAMP_STOPS = np.array([0.0, 0.35, 0.7, 1.0])
+_RAMP_COLORS = np.array([
+    [160, 0, 0, 90],
+    [255, 40, 0, 190],
+    [255, 190, 0, 240],
+    [255, 255, 210, 255],
+])
+COLOR_RAMP = np.column_stack([
+    np.interp(np.linspace(0, 1, 256), _RAMP_STOPS, _RAMP_COLORS[:, channel]) for channel in range(4)
+]).astype(np.uint8)
+
+
+def world_coords(lat, lon):
+    # Web Mercator coordinates in [0, 1), y pointing south like slippy map tiles
+    lat = np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE)
+    x = (lon + 180) / 360
+    y = (1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2
+    return x, y
+
+
+def _batch_pixel_counts(x, y, owner, num_owners, zoom):
+    """
+    Rasterise the tracks of one batch at a zoom level.
+
+    Consecutive points of the same activity are joined and sampled at least once per
+    pixel, so tracks stay connected when zoomed in. Every activity counts once per pixel.
+
+    Returns:
+    (np.ndarray, np.ndarray): Sorted global pixel keys and the number of activities per key
+    """
+    world_size = TILE_SIZE << zoom
+    px, py = x * world_size, y * world_size
+
+    # Segments between consecutive points of the same activity
+    segment = np.flatnonzero(owner[:-1] == owner[1:])
+    dx, dy = px[segment + 1] - px[segment], py[segment + 1] - py[segment]
+    steps = np.maximum(np.ceil(np.hypot(dx, dy)), 1).astype(np.int64)
+    seg = np.repeat(np.arange(len(segment)), steps)
+    t = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[seg]
+
+    # Segment samples plus every point itself, which also covers single-point tracks
+    sample_x = np.concatenate((px[segment][seg] + t * dx[seg], px))
+    sample_y = np.concatenate((py[segment][seg] + t * dy[seg], py))
+    sample_owner = np.concatenate((owner[segment][seg], owner))
+
+    gx = np.clip(sample_x.astype(np.int64), 0, world_size - 1)
+    gy = np.clip(sample_y.astype(np.int64), 0, world_size - 1)
+    keys = gy * world_size + gx
+
+    # Deduplicate (pixel, activity) pairs, then count activities per pixel
+    pairs = np.unique(keys * num_owners + sample_owner)
+    return np.unique(pairs // num_owners, return_counts=True)
+
+
+def _merge_counts(parts):
+    # Sum sparse (keys, counts) arrays into one sorted pair. Negative counts subtract, and
+    # pixels whose count drops to zero are left out.
+    if not parts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32)
+    keys = np.concatenate([keys for keys, _ in parts])
+    counts = np.concatenate([counts.astype(np.int64) for _, counts in parts])
+    merged, inverse = np.unique(keys, return_inverse=True)
+    summed = np.bincount(inverse, weights=counts, minlength=len(merged)).round().astype(np.int64)
+    keep = summed > 0
+    return merged[keep], summed[keep].astype(np.uint32)
+
+
+def rasterise_tracks(tracks, zooms):
+    """
+    Count the tracks crossing every pixel at several zoom levels.
+
+    Parameters:
+    tracks (list): (lat, lon) int32 arrays in COORD_SCALE units per track
+    zooms (iterable): Zoom levels to produce
+
+    Returns:
+    dict: Maps zoom level to sorted (pixel keys, track counts)
+    """
+    zooms = list(zooms)
+    parts = {zoom: [] for zoom in zooms}
+    tracks = [track for track in tracks if len(track[0])]
+    for start in range(0, len(tracks), BATCH_ACTIVITIES):
+        batch = tracks[start:start + BATCH_ACTIVITIES]
+        lat = np.concatenate([lat for lat, _ in batch]) / COORD_SCALE
+        lon = np.concatenate([lon for _, lon in batch]) / COORD_SCALE
+        owner = np.repeat(np.arange(len(batch)), [len(lat) for lat, _ in batch])
+        x, y = world_coords(lat, lon)
+        for zoom in zooms:
+            parts[zoom].append(_batch_pixel_counts(x, y, owner, len(batch), zoom))
+    return {zoom: _merge_counts(parts[zoom]) for zoom in zooms}
+
+
+def rasterise_activities(store, activity_ids, zooms):
+    # Count the activities of the store crossing every pixel, see rasterise_tracks
+    return rasterise_tracks([store.raw(activity_id) for activity_id in activity_ids], zooms)
+
+
+def _tile_ids(keys, zoom):
+    world_size = TILE_SIZE << zoom
+    return (keys // world_size // TILE_SIZE) * (1 << zoom) + (keys % world_size) // TILE_SIZE
+
+
+def render_tiles(keys, counts, zoom, tiles, folder=heatmap_tile_folder):
+    """
+    Write the PNG tiles of a zoom level, replacing tiles that already exist. Tiles
+    without any counted pixel left are removed.
+
+    Parameters:
+    keys, counts (np.ndarray): Pixel keys and activity counts of the whole zoom level
+    tiles (np.ndarray): Ids (y * 2**zoom + x) of the tiles to write
+
+    Returns:
+    int: Number of tiles written
+    """
+    world_size = TILE_SIZE << zoom
+    tile_of_key = _tile_ids(keys, zoom)
+    selected = np.flatnonzero(np.isin(tile_of_key, tiles))
+    selected = selected[np.argsort(tile_of_key[selected], kind='stable')]
+    tile_starts = np.flatnonzero(np.diff(tile_of_key[selected], prepend=-1))
+
+    # Fixed logarithmic intensity scale
+    intensity = np.clip(np.log1p(counts[selected]) / np.log1p(SATURATION_COUNT), 0, 1)
+    colors = COLOR_RAMP[(intensity * 255).astype(np.uint8)]
+    pixel_x = (keys[selected] % world_size) % TILE_SIZE
+    pixel_y = (keys[selected] // world_size) % TILE_SIZE
+
+    for start, end in zip(tile_starts, np.append(tile_starts[1:], len(selected))):
+        tile = int(tile_of_key[selected[start]])
+        tile_x, tile_y = tile % (1 << zoom), tile // (1 << zoom)
+        image = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+        image[pixel_y[start:end], pixel_x[start:end]] = colors[start:end]
+        tile_folder = os.path.join(folder, str(zoom), str(tile_x))
+        os.makedirs(tile_folder, exist_ok=True)
+        Image.fromarray(image, 'RGBA').save(os.path.join(tile_folder, f'{tile_y}.png'))
+        count_written(os.path.join(tile_folder, f'{tile_y}.png'))
+    count('heatmap.tiles_written', len(tile_starts))
+
+    for tile in np.setdiff1d(tiles, tile_of_key[selected]).tolist():
+        tile_path = os.path.join(folder, str(zoom), str(tile % (1 << zoom)), f'{tile // (1 << zoom)}.png')
+        if os.path.exists(tile_path):
+            os.remove(tile_path)
+    return len(tile_starts)
+
+
+def _load_state():
+    if not os.path.exists(heatmap_state_path):
+        return None
+    try:
+        with np.load(heatmap_state_path) as data:
+            state = {name: data[name] for name in data.files}
+    except (OSError, ValueError) as e:
+        print(f"Error loading heatmap state: {e}")
+        return None
+    if int(state.get('version', -1)) != HEATMAP_VERSION or int(state['max_zoom']) != MAX_HEATMAP_ZOOM:
+        return None
+    return state
+
+
+def _save_state(ids, fingerprints, counts):
+    arrays = {'version': HEATMAP_VERSION, 'max_zoom': MAX_HEATMAP_ZOOM, 'ids': ids, 'fingerprint': fingerprints}
+    for zoom, (keys, values) in counts.items():
+        arrays[f'keys_{zoom}'] = keys
+        arrays[f'counts_{zoom}'] = values
+    tmp_path = heatmap_state_path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, heatmap_state_path)
+    count_written(heatmap_state_path)
+
+
+def _previous_tracks(store, state, fingerprints):
+    # The stored version every changed or removed track was counted with, or None if one of
+    # them was dropped from the store by compact()
+    previous = {}
+    for activity_id, fingerprint in zip(state['ids'].tolist(), state['fingerprint'].tolist()):
+        if fingerprints.get(activity_id) == fingerprint:
+            continue
+        if activity_id not in store:
+            return None
+        track = next((version for version in store.versions(activity_id) if track_fingerprint(*version) == fingerprint),
+                     None)
+        if track is None:
+            return None
+        previous[activity_id] = track
+    return previous
+
+
+def update_heatmap_tiles(store, features, incremental=True, activity_ids=None):
+    """
+    Bring the heatmap tile pyramid up to date with the track store.
+
+    New activities are rasterised and their counts added to the stored per-pixel counts,
+    then only the tiles they touch are written again. An activity whose track changed has
+    the counts of its previous track, still in the store as a superseded version,
+    subtracted first, and a removed activity has the counts of its track subtracted. When a
+    previous track is no longer stored, or incremental is False, the pyramid is rebuilt
+    from scratch.
+
+    Parameters:
+    store (TrackStore): Source of the tracks
+    features (ingest.TrackFeatures): Features of the stored tracks, for their fingerprints
+    incremental (bool): If True, reuse the stored counts and tiles
+    activity_ids (array-like): Activities to show, such as those still in the activity
+        database, all stored tracks if None
+
+    Returns:
+    (int, int): Number of activities added or changed and number of tiles written
+    """
+    zooms = range(MIN_HEATMAP_ZOOM, MAX_HEATMAP_ZOOM + 1)
+    store_ids = store.ids()
+    if activity_ids is not None:
+        store_ids = store_ids[np.isin(store_ids, np.asarray(activity_ids, dtype=np.int64))]
+    fingerprints = features.arrays['fingerprint'][[features.row(activity_id) for activity_id in store_ids.tolist()]] \
+        if len(store_ids) else np.zeros(0, dtype=np.uint32)
+    state = _load_state() if incremental else None
+    previous = None
+    if state is not None:
+        previous = _previous_tracks(store, state, dict(zip(store_ids.tolist(), fingerprints.tolist())))
+    if previous is not None:
+        counted = set(state['ids'].tolist())
+        new_ids = [activity_id for activity_id in store_ids.tolist() if activity_id not in counted or activity_id in previous]
+        counts = {zoom: (state[f'keys_{zoom}'], state[f'counts_{zoom}']) for zoom in zooms}
+    else:
+        new_ids = store_ids.tolist()
+        previous = {}
+        counts = {zoom: (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32)) for zoom in zooms}
+        shutil.rmtree(heatmap_tile_folder, ignore_errors=True)
+
+    if not new_ids and not previous:
+        return 0, 0
+
+    with span('heatmap.rasterise', activities=len(new_ids)):
+        new_counts = rasterise_activities(store, new_ids, zooms)
+        old_counts = rasterise_tracks(list(previous.values()), zooms)
+    written = 0
+    with span('heatmap.render'):
+        for zoom in zooms:
+            old_keys, old_values = old_counts[zoom]
+            counts[zoom] = _merge_counts([counts[zoom], new_counts[zoom], (old_keys, -old_values.astype(np.int64))])
+            touched = np.unique(_tile_ids(np.concatenate((new_counts[zoom][0], old_keys)), zoom))
+            written += render_tiles(*counts[zoom], zoom, touched)
+
+    with span('write.heatmap_state.npz'):
+        _save_state(store_ids, fingerprints, counts)
+    return len(new_ids), written
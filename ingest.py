@@ -0,0 +1,327 @@
+import multiprocessing
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from gpx_reader import read_points
+from instrumentation import span, count, count_written, record_span
+from track_metrics import concatenate_tracks, track_metrics, METRIC_NAMES
+from track_simplify import simplify_for_zoom
+from track_store import TrackStore, TrackSources, COORD_SCALE, gpx_folder, track_store_path, track_sources_path
+
+# Per-activity features derived from the tracks, reused until a track changes
+track_features_path = 'track_features.npz'
+
+# Activities handed to a worker at once; large enough to amortise the inter-process
+# transfer, small enough to keep all workers busy until the end
+CHUNK_SIZE = 32
+# Below this many activities the work is done in-process, starting workers costs more
+MIN_PARALLEL_ACTIVITIES = 2 * CHUNK_SIZE
+# Bump whenever the features change meaning, to recompute all of them
+FEATURES_VERSION = 2
+# Features with one row per activity, the simplified geometry is stored separately
+ROW_FEATURES = ('ids', 'fingerprint', 'num_points') + METRIC_NAMES
+
+
+def track_fingerprint(lat, lon):
+    # CRC of the fixed-point coordinates, changes whenever the stored track changes
+    return zlib.crc32(lon.tobytes(), zlib.crc32(lat.tobytes()))
+
+
+def _extract(activity_ids, fixed_tracks):
+    """
+    Compute the features of a batch of tracks.
+
+    The geometry metrics of the whole batch come from one vectorized pass over the
+    concatenated points, see track_metrics. Only the fingerprint and the simplification
+    are computed per track.
+
+    Parameters:
+    activity_ids (list): Activity ids
+    fixed_tracks (list): (lat, lon) int32 arrays in COORD_SCALE units per activity
+
+    Returns:
+    dict: Feature arrays of the batch, simplified geometry concatenated with offsets
+    """
+    n = len(activity_ids)
+    lat, lon, offsets = concatenate_tracks(fixed_tracks)
+    lat, lon = lat / COORD_SCALE, lon / COORD_SCALE
+    features = {
+        'ids': np.asarray(activity_ids, dtype=np.int64),
+        'fingerprint': np.fromiter((track_fingerprint(*track) for track in fixed_tracks), dtype=np.uint32, count=n),
+        'num_points': np.diff(offsets),
+        **track_metrics(lat, lon, offsets),
+    }
+    simple_coords, simple_zoom = [], []
+    for i in range(n):
+        points, zoom = simplify_for_zoom(np.column_stack((lat[offsets[i]:offsets[i + 1]], lon[offsets[i]:offsets[i + 1]])))
+        simple_coords.append(points)
+        simple_zoom.append(zoom)
+
+    features['simple_offsets'] = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(zoom) for zoom in simple_zoom], out=features['simple_offsets'][1:])
+    features['simple_coords'] = np.concatenate(simple_coords) if n else np.zeros((0, 2))
+    features['simple_zoom'] = np.concatenate(simple_zoom) if n else np.zeros(0, dtype=np.uint8)
+    return features
+
+
+def _fixed(points):
+    # Same fixed-point representation the track store keeps
+    fixed = np.round(np.asarray(points, dtype=np.float64).reshape(-1, 2) * COORD_SCALE).astype(np.int32)
+    return np.ascontiguousarray(fixed[:, 0]), np.ascontiguousarray(fixed[:, 1])
+
+
+def _timed_extract(activity_ids, fixed_tracks, timings):
+    start = time.perf_counter()
+    features = _extract(activity_ids, fixed_tracks)
+    timings['features.extract'] = (time.perf_counter() - start, len(activity_ids))
+    return features
+
+
+def _parse_chunk(paths):
+    # Worker: parse GPX files and compute their features. Returns the fixed-point tracks so
+    # the parent can append them to the store without parsing again, and the time spent
+    # per step, which the parent records since workers have no report of their own.
+    activity_ids, fixed_tracks = [], []
+    start = time.perf_counter()
+    for activity_id, path in paths:
+        try:
+            fixed_tracks.append(_fixed(read_points(path)))
+            activity_ids.append(activity_id)
+        except Exception as e:
+            print(f"Error parsing GPX file {path}: {e}")
+    timings = {'gpx.parse': (time.perf_counter() - start, len(paths))}
+    return fixed_tracks, _timed_extract(activity_ids, fixed_tracks, timings), timings
+
+
+def _store_chunk(store_path, activity_ids):
+    # Worker: compute the features of tracks already in the store, read through its own mapping
+    store = TrackStore(store_path)
+    timings = {}
+    return None, _timed_extract(activity_ids, [store.raw(activity_id) for activity_id in activity_ids], timings), timings
+
+
+def _record_timings(timings):
+    for name, (seconds, num_activities) in timings.items():
+        record_span(name, seconds, count=num_activities)
+
+
+def _run_chunks(func, chunks, max_workers):
+    # Run the chunks in a process pool, or in-process when there is little work
+    if sum(len(chunk[-1]) for chunk in chunks) < MIN_PARALLEL_ACTIVITIES or max_workers == 1:
+        return [func(*chunk) for chunk in chunks]
+    # Spawned workers only import this module, forking a threaded parent (Streamlit, the
+    # build's thread pool) is not safe
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(func, *zip(*chunks)))
+
+
+class TrackFeatures:
+    """
+    Features of every stored track: the geometry metrics of track_metrics (length in
+    meters, bounding box, centroid, start, end and middle point, loop flag) and the
+    geometry simplified for all zoom levels (see track_simplify).
+
+    The arrays are kept in one npz file and looked up by activity id.
+    """
+
+    def __init__(self, arrays=None, store_stat=None):
+        self.arrays = arrays if arrays is not None else _extract([], [])
+        # Size and mtime of the track store the features were computed from
+        self.store_stat = store_stat
+        self._index = {activity_id: i for i, activity_id in enumerate(self.arrays['ids'].tolist())}
+
+    @classmethod
+    def load(cls, path=track_features_path):
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError) as e:
+            print(f"Error loading track features: {e}")
+            return cls()
+        if int(arrays.pop('version', -1)) != FEATURES_VERSION:
+            return cls()
+        store_stat = tuple(arrays.pop('store_stat').tolist())
+        return cls(arrays, store_stat)
+
+    def save(self, store_stat, path=track_features_path):
+        self.store_stat = tuple(store_stat)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, version=FEATURES_VERSION, store_stat=np.asarray(store_stat, dtype=np.int64),
+                 **self.arrays)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, activity_id):
+        return int(activity_id) in self._index
+
+    def row(self, activity_id):
+        return self._index[int(activity_id)]
+
+    def midpoint(self, activity_id):
+        return self.arrays['midpoint'][self.row(activity_id)]
+
+    def bbox(self, activity_id):
+        return self.arrays['bbox'][self.row(activity_id)]
+
+    def length(self, activity_id):
+        return float(self.arrays['length'][self.row(activity_id)])
+
+    def centroid(self, activity_id):
+        return self.arrays['centroid'][self.row(activity_id)]
+
+    def endpoints(self, activity_id):
+        # First and last point of the track
+        i = self.row(activity_id)
+        return self.arrays['start'][i], self.arrays['end'][i]
+
+    def is_loop(self, activity_id):
+        return bool(self.arrays['is_loop'][self.row(activity_id)])
+
+    def simplified(self, activity_id):
+        # Simplified (lat, lon) vertices and the minimum zoom level of each
+        i = self.row(activity_id)
+        start, end = self.arrays['simple_offsets'][i:i + 2]
+        return self.arrays['simple_coords'][start:end], self.arrays['simple_zoom'][start:end]
+
+    def updated(self, parts, keep_ids):
+        """
+        Merge newly computed feature batches into these features.
+
+        Parameters:
+        parts (list): Feature dicts as returned by the workers
+        keep_ids (set): Ids of the stored tracks; features of other ids are dropped
+
+        Returns:
+        TrackFeatures: The merged features
+        """
+        replaced = set()
+        for part in parts:
+            replaced.update(part['ids'].tolist())
+        keep = [i for i, activity_id in enumerate(self.arrays['ids'].tolist())
+                if activity_id not in replaced and activity_id in keep_ids]
+        batches = [_select(self.arrays, keep)] + parts
+        merged = {name: np.concatenate([batch[name] for batch in batches])
+                  for name in ROW_FEATURES + ('simple_coords', 'simple_zoom')}
+        offsets = [np.diff(batch['simple_offsets']) for batch in batches]
+        merged['simple_offsets'] = np.concatenate(([0], np.cumsum(np.concatenate(offsets)))).astype(np.int64)
+        return TrackFeatures(merged)
+
+
+def _select(arrays, rows):
+    # Feature arrays restricted to some rows, with the simplified geometry re-packed
+    rows = np.asarray(rows, dtype=np.int64)
+    selected = {name: arrays[name][rows] for name in ROW_FEATURES}
+    starts, ends = arrays['simple_offsets'][rows], arrays['simple_offsets'][rows + 1]
+    lengths = ends - starts
+    points = np.repeat(starts, lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    selected['simple_coords'] = arrays['simple_coords'][points].reshape(-1, 2)
+    selected['simple_zoom'] = arrays['simple_zoom'][points]
+    selected['simple_offsets'] = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    return selected
+
+
+def _store_stat(store_path):
+    if not os.path.exists(store_path):
+        return (0, 0)
+    stat = os.stat(store_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def ingest_tracks(folder=gpx_folder, store_path=track_store_path, features_path=track_features_path,
+                  sources_path=track_sources_path, max_workers=None):
+    """
+    Import new and changed GPX files into the track store and bring the per-activity
+    features up to date.
+
+    Parsing and feature extraction run in a process pool, CHUNK_SIZE activities per task.
+    Workers return compact arrays; the parent appends all new tracks to the store as one
+    chunk. A GPX file counts as changed when its size or mtime differs from when it was
+    imported, see TrackSources. Features are cached per activity and only computed for
+    tracks that are new or whose points changed.
+
+    Parameters:
+    folder (str): Folder containing one '<activity_id>.gpx' file per activity
+    max_workers (int): Number of worker processes, the number of CPUs if None
+
+    Returns:
+    (TrackStore, TrackFeatures): The opened store and the features of all its tracks
+    """
+    store = TrackStore(store_path)
+    features = TrackFeatures.load(features_path)
+    sources = TrackSources(sources_path)
+    max_workers = max_workers or os.cpu_count() or 1
+
+    changed_files = sources.changed_files(folder, store)
+    new_files = [(activity_id, path) for activity_id, path, _ in changed_files]
+
+    # The store only ever grows by appending, so an unchanged size and mtime means every
+    # cached feature is still valid and the fingerprints need not be checked
+    if not new_files and features.store_stat == _store_stat(store_path) and len(features) == len(store):
+        sources.save()
+        count('cache.features.hits', len(store))
+        return store, features
+
+    parts = []
+    if new_files:
+        chunks = [(new_files[i:i + CHUNK_SIZE],) for i in range(0, len(new_files), CHUNK_SIZE)]
+        new_tracks = {}
+        with span('ingest.parse', files=len(new_files)):
+            for fixed_tracks, part, timings in _run_chunks(_parse_chunk, chunks, max_workers):
+                for activity_id, (lat, lon) in zip(part['ids'].tolist(), fixed_tracks):
+                    new_tracks[activity_id] = np.column_stack((lat, lon)) / COORD_SCALE
+                parts.append(part)
+                _record_timings(timings)
+        # The store only grows, its new chunk is what was written
+        store_size = _store_stat(store_path)[0]
+        with span('write.tracks.bin'):
+            store.append(new_tracks)
+        count('bytes_written', _store_stat(store_path)[0] - store_size)
+        count('gpx.files_parsed', len(new_files))
+        count('tracks.imported', len(new_tracks))
+        print(f"Imported {len(new_tracks)} new or changed GPX files into the track store.")
+        # Recorded once the tracks are stored, an interrupted import is repeated. Files that
+        # failed to parse are skipped until they change.
+        for activity_id, _, stat in changed_files:
+            if activity_id in new_tracks:
+                sources.record(activity_id, stat)
+            else:
+                sources.record_failed(activity_id, stat)
+        count('gpx.files_failed', len(new_files) - len(new_tracks))
+    sources.save()
+
+    # Tracks that were already stored but have no features yet, or changed since
+    computed = {activity_id for part in parts for activity_id in part['ids'].tolist()}
+    stale = []
+    for activity_id in store.ids().tolist():
+        if activity_id in computed:
+            continue
+        if activity_id not in features or \
+                features.arrays['fingerprint'][features.row(activity_id)] != track_fingerprint(*store.raw(activity_id)):
+            stale.append(activity_id)
+    if stale:
+        chunks = [(store_path, stale[i:i + CHUNK_SIZE]) for i in range(0, len(stale), CHUNK_SIZE)]
+        with span('ingest.features', activities=len(stale)):
+            for _, part, timings in _run_chunks(_store_chunk, chunks, max_workers):
+                parts.append(part)
+                _record_timings(timings)
+        print(f"Computed features of {len(stale)} stored tracks.")
+    count('cache.features.hits', len(store) - len(computed) - len(stale))
+    count('cache.features.misses', len(computed) + len(stale))
+
+    features = features.updated(parts, set(store.ids().tolist()))
+    with span('write.track_features.npz'):
+        features.save(_store_stat(store_path), features_path)
+    count_written(features_path)
+    return store, features
+
+
+if __name__ == "__main__":
+    store, features = ingest_tracks()
+    print(f"Track store holds {len(store)} activities, features cached for {len(features)}.")
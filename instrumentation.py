@@ -0,0 +1,334 @@
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Report of the last update, written when it finishes
+run_report_path = 'run_report.json'
+# cProfile stats and collapsed sampling stacks of the profiled stages
+profile_folder = 'profiles'
+
+# Stages to profile when an update does not say otherwise: comma separated names, or 'all'.
+# STRAVA_PROFILER picks 'cprofile' or 'sampling'.
+PROFILE_ENV = 'STRAVA_PROFILE'
+PROFILER_ENV = 'STRAVA_PROFILER'
+PROFILERS = ('cprofile', 'sampling')
+# Seconds between two stack samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+# Individual spans kept in the timeline of a report; the totals per name are always complete
+MAX_TIMELINE_SPANS = 1000
+# Functions listed per profile in the report, the profile files hold all of them
+TOP_FUNCTIONS = 25
+# Bump whenever the layout of the report changes
+REPORT_VERSION = 1
+
+
+def _profile_targets(profile):
+    if profile is None:
+        profile = os.environ.get(PROFILE_ENV, '')
+    if isinstance(profile, str):
+        profile = profile.split(',')
+    return {name.strip() for name in profile if name.strip()}
+
+
+class RunReport:
+    """
+    Timings, counters and profiles of one run of the pipeline, such as an update.
+
+    Spans are summed per name, so a span that runs for every activity costs a few bytes no
+    matter how many activities there are. The first MAX_TIMELINE_SPANS spans are also kept
+    one by one, with their thread and the span they ran in.
+
+    Parameters:
+    name (str): Name of the run
+    profile (list or str): Span names to profile, 'all' for every profiled span. Taken from
+        the STRAVA_PROFILE environment variable if None.
+    profiler (str): 'cprofile' or 'sampling', from STRAVA_PROFILER if None
+    """
+
+    def __init__(self, name, profile=None, profiler=None):
+        self.name = name
+        self.profile = _profile_targets(profile)
+        self.profiler = profiler or os.environ.get(PROFILER_ENV) or 'cprofile'
+        if self.profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler '{self.profiler}', use one of {', '.join(PROFILERS)}.")
+        self.started = time.time()
+        self.finished = None
+        self.status = 'running'
+        self.spans = {}
+        self.timeline = []
+        self.dropped_spans = 0
+        self.counters = Counter()
+        self.profiles = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name, seconds, count=1, start=None, parent=None, attrs=None):
+        with self._lock:
+            totals = self.spans.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            totals['count'] += count
+            totals['seconds'] += seconds
+            totals['max'] = max(totals['max'], seconds / max(count, 1))
+            if len(self.timeline) >= MAX_TIMELINE_SPANS:
+                self.dropped_spans += 1
+                return
+            self.timeline.append({
+                'name': name,
+                'start': round((start if start is not None else time.perf_counter() - seconds) - self._start, 4),
+                'seconds': round(seconds, 4),
+                'count': count,
+                'thread': threading.current_thread().name,
+                'parent': parent,
+                **({'attrs': attrs} if attrs else {}),
+            })
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def wants_profile(self, name):
+        # Stages are profiled by their full span name or by the part after the first dot
+        return 'all' in self.profile or name in self.profile or name.split('.', 1)[-1] in self.profile
+
+    def add_profile(self, profile):
+        with self._lock:
+            self.profiles.append(profile)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'version': REPORT_VERSION,
+                'name': self.name,
+                'status': self.status,
+                'started': self.started,
+                'finished': self.finished,
+                'seconds': round((self.finished or time.time()) - self.started, 3),
+                'pid': os.getpid(),
+                'python': platform.python_version(),
+                'spans': {name: {'count': totals['count'], 'seconds': round(totals['seconds'], 4),
+                                 'max': round(totals['max'], 4)}
+                          for name, totals in sorted(self.spans.items(), key=lambda item: -item[1]['seconds'])},
+                'counters': dict(sorted(self.counters.items())),
+                'profiles': list(self.profiles),
+                'timeline': list(self.timeline),
+                'dropped_spans': self.dropped_spans,
+            }
+
+    def save(self, path=run_report_path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(tmp_path, path)
+
+
+# Spans recorded outside of a run, such as from the benchmarks or a plain import, go to a
+# report of the process that is never saved
+_current = RunReport('process', profile=())
+_current_lock = threading.Lock()
+# Names of the spans open in every thread, the innermost one is the parent of a new span
+_open_spans = threading.local()
+# Only one cProfile profiler can be active at a time, other stages fall back to sampling
+_cprofile_lock = threading.Lock()
+
+
+def current_run():
+    with _current_lock:
+        return _current
+
+
+def start_run(name, profile=None, profiler=None):
+    """
+    Start a new report; spans and counters of all threads are recorded into it until the
+    next run starts.
+
+    Returns:
+    RunReport: The new report
+    """
+    global _current
+    report = RunReport(name, profile=profile, profiler=profiler)
+    with _current_lock:
+        _current = report
+    return report
+
+
+def finish_run(status='finished', path=run_report_path):
+    # Write the report of the current run, returns it
+    report = current_run()
+    report.status = status
+    report.finished = time.time()
+    report.save(path)
+    return report
+
+
+def count(name, value=1):
+    current_run().count(name, value)
+
+
+def record_span(name, seconds, count=1):
+    # Add time measured elsewhere, such as in a worker process, as count spans of name
+    stack = getattr(_open_spans, 'names', None)
+    current_run().add_span(name, seconds, count=count, parent=stack[-1] if stack else None)
+
+
+def count_written(path, name='bytes_written'):
+    # Count the size of a file that was just written
+    try:
+        current_run().count(name, os.path.getsize(path))
+    except OSError:
+        pass
+
+
+@contextmanager
+def span(name, profile=False, **attrs):
+    """
+    Time the enclosed block as a span of the current run.
+
+    Parameters:
+    name (str): Span name, dotted by area, such as 'api.athlete/activities' or 'build.map'
+    profile (bool): If True, the block is also profiled when the run asks for name
+    attrs: Extra values kept with the span in the timeline
+    """
+    report = current_run()
+    if not hasattr(_open_spans, 'names'):
+        _open_spans.names = []
+    parent = _open_spans.names[-1] if _open_spans.names else None
+    _open_spans.names.append(name)
+    start = time.perf_counter()
+    try:
+        if profile and report.wants_profile(name):
+            with _profiled(report, name):
+                yield
+        else:
+            yield
+    finally:
+        seconds = time.perf_counter() - start
+        _open_spans.names.pop()
+        report.add_span(name, seconds, start=start, parent=parent, attrs=attrs or None)
+
+
+@contextmanager
+def writing(path, name=None):
+    # Span around writing a file, whose size is counted once it is written
+    with span(name or f"write.{os.path.basename(path)}"):
+        yield
+    count_written(path)
+
+
+def _profile_path(name, extension):
+    os.makedirs(profile_folder, exist_ok=True)
+    safe_name = ''.join(char if char.isalnum() or char in '-_' else '_' for char in name)
+    return os.path.join(profile_folder, f"{safe_name}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+
+@contextmanager
+def _profiled(report, name):
+    # Profile the enclosed block in the current thread with the profiler the run asks for.
+    # Work done in worker processes, such as the GPX import, is not part of the profile.
+    use_cprofile = report.profiler == 'cprofile' and _cprofile_lock.acquire(blocking=False)
+    start = time.perf_counter()
+    if use_cprofile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+        finally:
+            _cprofile_lock.release()
+        path = _profile_path(name, 'prof')
+        profiler.dump_stats(path)
+        report.add_profile({'name': name, 'profiler': 'cprofile', 'seconds': round(time.perf_counter() - start, 3),
+                            'path': path, 'top': _cprofile_top(profiler)})
+    else:
+        sampler = SamplingProfiler(threading.get_ident())
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+        path = _profile_path(name, 'folded')
+        sampler.save(path)
+        report.add_profile({'name': name, 'profiler': 'sampling', 'seconds': round(time.perf_counter() - start, 3),
+                            'path': path, 'samples': sampler.num_samples, 'top': sampler.top()})
+
+
+def _cprofile_top(profiler, limit=TOP_FUNCTIONS):
+    # The functions with the most cumulative time, as plain values
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (file_name, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+        rows.append({'function': f"{os.path.basename(file_name)}:{line}({function})", 'calls': calls,
+                     'total': round(total, 4), 'cumulative': round(cumulative, 4)})
+    rows.sort(key=lambda row: -row['cumulative'])
+    return rows[:limit]
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread every SAMPLE_INTERVAL seconds from a background thread.
+
+    Unlike cProfile it does not slow down the profiled code, and several threads can be
+    sampled at the same time. The stacks are saved in the collapsed format that flame
+    graph tools such as speedscope and flamegraph.pl read.
+
+    Parameters:
+    thread_id (int): threading.get_ident() of the thread to sample
+    interval (float): Seconds between two samples
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.num_samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(names))] += 1
+            self.num_samples += 1
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+
+    def top(self, limit=TOP_FUNCTIONS):
+        # Functions by the share of samples they were at the top of the stack in, then by the
+        # share they were on the stack in at all
+        inclusive = Counter()
+        own = Counter()
+        for stack, samples in self.stacks.items():
+            names = stack.split(';')
+            own[names[-1]] += samples
+            for name in set(names):
+                inclusive[name] += samples
+        total = max(self.num_samples, 1)
+        names = sorted(inclusive, key=lambda name: (-own[name], -inclusive[name]))[:limit]
+        return [{'function': name, 'samples': inclusive[name], 'share': round(inclusive[name] / total, 3),
+                 'own_share': round(own[name] / total, 3)} for name in names]
@@ -0,0 +1,267 @@
+import json
+import os
+from collections import Counter
+import numpy as np
+
+from geocode_cache import GeocodeCache, geohash_decode
+
+# Nominatim responses with boundary polygons, and an optional local GeoJSON boundary file
+boundary_cache_folder = 'cache'
+boundary_file_path = 'boundaries.geojson'
+
+# Nominatim place ranks: countries are rank 4, anything from regions down is treated as a city
+COUNTRY_PLACE_RANK = 4
+# Number of children per R-tree node
+NODE_CAPACITY = 16
+# Upper bound on the point x edge matrix built per point-in-polygon batch
+MAX_BATCH_ELEMENTS = 4_000_000
+
+
+class Boundary:
+    def __init__(self, name, country, is_country, rank, polygons):
+        self.name = name
+        self.country = country
+        self.is_country = is_country
+        self.rank = rank
+        # Edges of all rings as (x0, y0, x1, y1) in (lon, lat); holes are just more rings
+        # because containment uses the even-odd rule
+        rings = [np.asarray(ring, dtype=np.float64)[:, :2] for polygon in polygons for ring in polygon if len(ring) > 2]
+        if not rings:
+            raise ValueError(f"boundary of '{name}' has no ring with more than 2 points")
+        self.edges = np.concatenate([np.hstack((ring[:-1], ring[1:])) for ring in rings])
+        self.bbox = (self.edges[:, [0, 2]].min(), self.edges[:, [1, 3]].min(),
+                     self.edges[:, [0, 2]].max(), self.edges[:, [1, 3]].max())
+
+    def contains(self, lon, lat):
+        # Vectorized even-odd ray casting, in batches to bound memory
+        inside = np.zeros(len(lon), dtype=bool)
+        x0, y0, x1, y1 = (self.edges[:, i] for i in range(4))
+        batch = max(1, MAX_BATCH_ELEMENTS // len(self.edges))
+        for start in range(0, len(lon), batch):
+            px = lon[start:start + batch, None]
+            py = lat[start:start + batch, None]
+            crosses = (y0 > py) != (y1 > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+            inside[start:start + batch] = np.count_nonzero(crosses & (px < x_cross), axis=1) % 2 == 1
+        return inside
+
+
+def _polygons(geometry):
+    if geometry.get('type') == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry.get('type') == 'MultiPolygon':
+        return geometry['coordinates']
+    return []
+
+
+def _from_nominatim(result):
+    # Boundary from a Nominatim search result that includes its geojson polygon
+    polygons = _polygons(result.get('geojson') or {})
+    if not polygons:
+        return None
+    address = result.get('address') or {}
+    rank = int(result.get('place_rank', 16))
+    is_country = rank <= COUNTRY_PLACE_RANK or result.get('addresstype') == 'country'
+    name = (address.get('city') or address.get('town') or address.get('village')
+            or address.get('municipality') or result.get('name'))
+    country = address.get('country') or result.get('display_name', '').split(',')[-1].strip() or None
+    return Boundary(name, country, is_country, rank, polygons)
+
+
+def _from_feature(feature):
+    # Boundary from a GeoJSON feature with 'city' and/or 'country' properties
+    polygons = _polygons(feature.get('geometry') or {})
+    properties = feature.get('properties') or {}
+    if not polygons:
+        return None
+    is_country = not properties.get('city')
+    name = properties.get('country') if is_country else properties.get('city')
+    rank = int(properties.get('place_rank', COUNTRY_PLACE_RANK if is_country else 16))
+    return Boundary(name, properties.get('country'), is_country, rank, polygons)
+
+
+def _load_boundary(make, item, source):
+    # A malformed polygon only loses its own boundary, points inside it are looked up online
+    try:
+        return make(item)
+    except (AttributeError, TypeError, ValueError, IndexError, KeyError) as e:
+        print(f"Skipping malformed boundary in {source}: {e}")
+        return None
+
+
+def load_boundaries(folder=boundary_cache_folder, file_path=boundary_file_path):
+    boundaries = []
+    if os.path.isdir(folder):
+        for file_name in sorted(os.listdir(folder)):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(folder, file_name), 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Error loading boundary file {file_name}: {e}")
+                continue
+            for result in data if isinstance(data, list) else [data]:
+                if isinstance(result, dict):
+                    boundary = _load_boundary(_from_nominatim, result, file_name)
+                    if boundary is not None:
+                        boundaries.append(boundary)
+
+    if os.path.exists(file_path):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading boundary file {file_path}: {e}")
+            data = {}
+        features = data.get('features') if isinstance(data, dict) else None
+        for feature in features if isinstance(features, list) else []:
+            if isinstance(feature, dict):
+                boundary = _load_boundary(_from_feature, feature, file_path)
+                if boundary is not None:
+                    boundaries.append(boundary)
+    return boundaries
+
+
+class STRTree:
+    """
+    Static R-tree over bounding boxes, packed with the Sort-Tile-Recursive algorithm.
+
+    Every level holds its boxes in packed order; consecutive runs of NODE_CAPACITY boxes
+    form one node of the level above. Queries take whole arrays of points and descend
+    all of them level by level.
+    """
+
+    def __init__(self, bboxes):
+        boxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        entries = np.arange(len(boxes))
+        # Each level is (boxes, entries): entries are the original box indices at the leaf
+        # level and the node numbers of the level below everywhere else
+        self.levels = []
+        while True:
+            order = self._str_order(boxes)
+            boxes, entries = boxes[order], entries[order]
+            self.levels.append((boxes, entries))
+            if len(boxes) <= NODE_CAPACITY:
+                break
+            starts = np.arange(0, len(boxes), NODE_CAPACITY)
+            boxes = np.column_stack((
+                np.minimum.reduceat(boxes[:, 0], starts),
+                np.minimum.reduceat(boxes[:, 1], starts),
+                np.maximum.reduceat(boxes[:, 2], starts),
+                np.maximum.reduceat(boxes[:, 3], starts),
+            ))
+            entries = np.arange(len(boxes))
+
+    @staticmethod
+    def _str_order(bboxes):
+        # Sort by x centre into vertical slices, then by y centre inside each slice
+        if len(bboxes) == 0:
+            return np.zeros(0, dtype=np.int64)
+        num_nodes = int(np.ceil(len(bboxes) / NODE_CAPACITY))
+        slice_size = NODE_CAPACITY * int(np.ceil(np.sqrt(num_nodes)))
+        cx = (bboxes[:, 0] + bboxes[:, 2]) / 2
+        cy = (bboxes[:, 1] + bboxes[:, 3]) / 2
+        by_x = np.argsort(cx, kind='stable')
+        slices = np.arange(len(bboxes)) // slice_size
+        return by_x[np.lexsort((cy[by_x], slices))]
+
+    def query_points(self, x, y):
+        """
+        Find the boxes containing each point.
+
+        Returns:
+        (np.ndarray, np.ndarray): Point indices and box indices of all (point, box) pairs
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        points = np.arange(len(x))
+        # Every point starts at the single root node above the top level
+        nodes = np.zeros(len(x), dtype=np.int64)
+        for boxes, entries in reversed(self.levels):
+            # Expand every (point, node) pair into (point, child) pairs
+            starts = nodes * NODE_CAPACITY
+            counts = np.clip(len(boxes) - starts, 0, NODE_CAPACITY)
+            points = np.repeat(points, counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            children = np.repeat(starts, counts) + offsets
+            child_boxes = boxes[children]
+            px, py = x[points], y[points]
+            keep = ((child_boxes[:, 0] <= px) & (px <= child_boxes[:, 2]) &
+                    (child_boxes[:, 1] <= py) & (py <= child_boxes[:, 3]))
+            points = points[keep]
+            nodes = entries[children[keep]]
+        return points, nodes
+
+
+class OfflineGeocoder:
+    """
+    Reverse geocoder answering city/country queries from locally stored boundary polygons.
+
+    Boundaries come from the Nominatim responses in cache/ and from boundaries.geojson.
+    When the geocode cache has entries inside a boundary, their most common city and
+    country names replace the boundary's own, so offline and online lookups report the
+    same names.
+    """
+
+    def __init__(self, boundaries=None, geocode_cache=None):
+        self.boundaries = load_boundaries() if boundaries is None else boundaries
+        self.tree = STRTree([boundary.bbox for boundary in self.boundaries])
+        self._align_names(geocode_cache or GeocodeCache())
+
+    def _align_names(self, geocode_cache):
+        cached = [(cell, entry['city'], entry['country']) for cell, entry in geocode_cache.entries.items()
+                  if entry.get('city') or entry.get('country')]
+        if not cached or not self.boundaries:
+            return
+        lat, lon = geohash_decode([cell for cell, _, _ in cached])
+        cities, countries = {}, {}
+        for i, b in zip(*self._containing(lat, lon)):
+            _, city, country = cached[i]
+            if city:
+                cities.setdefault(b, Counter())[city] += 1
+            if country:
+                countries.setdefault(b, Counter())[country] += 1
+        for b, boundary in enumerate(self.boundaries):
+            country = countries[b].most_common(1)[0][0] if b in countries else None
+            if boundary.is_country:
+                boundary.name = country or boundary.name
+            else:
+                boundary.name = cities[b].most_common(1)[0][0] if b in cities else boundary.name
+                boundary.country = country or boundary.country
+
+    def _containing(self, lat, lon):
+        # All (point, boundary) pairs where the point lies inside the boundary polygon
+        point_idx, boundary_idx = self.tree.query_points(lon, lat)
+        inside = np.zeros(len(point_idx), dtype=bool)
+        for b in np.unique(boundary_idx):
+            pairs = np.flatnonzero(boundary_idx == b)
+            inside[pairs] = self.boundaries[b].contains(lon[point_idx[pairs]], lat[point_idx[pairs]])
+        return point_idx[inside], boundary_idx[inside]
+
+    def resolve(self, lat, lon):
+        """
+        Find city and country for a batch of points.
+
+        Parameters:
+        lat, lon (array-like): Coordinates in degrees
+
+        Returns:
+        list: (city, country) per point, or None where no city boundary contains the point
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        cities = [None] * len(lat)
+        countries = [None] * len(lat)
+        city_ranks = np.full(len(lat), -1)
+        for i, b in zip(*self._containing(lat, lon)):
+            boundary = self.boundaries[b]
+            if boundary.is_country:
+                countries[i] = boundary.name
+            elif boundary.rank > city_ranks[i]:
+                # The highest place rank is the most specific area
+                city_ranks[i] = boundary.rank
+                cities[i] = boundary
+        return [(city.name, countries[i] or city.country) if city is not None else None
+                for i, city in enumerate(cities)]
@@ -0,0 +1,229 @@
+import os
+from collections import Counter
+import numpy as np
+
+from instrumentation import count_written
+from track_store import COORD_SCALE
+from spatial_index import track_cells
+from activity_db import connect, revision, bump_revision
+
+# Signatures, cells and matched pairs of the clustered tracks, reused until a track changes
+routes_state_path = 'routes_state.npz'
+
+# Tracks are compared as sets of Web Mercator cells at this zoom level, about 150 m at the
+# equator and 90 m in Copenhagen
+CELL_ZOOM = 18
+# MinHash signature length, split into LSH bands of BAND_ROWS values. Two tracks become a
+# candidate pair if all values of one band agree, which is likely from a Jaccard
+# similarity of about (1 / NUM_BANDS) ** (1 / BAND_ROWS) = 0.36 upwards; pairs at
+# MIN_JACCARD are found with a probability of 99.4%.
+NUM_HASHES = 64
+BAND_ROWS = 3
+NUM_BANDS = NUM_HASHES // BAND_ROWS
+# Candidates are confirmed on the exact Jaccard similarity of their cell sets
+MIN_JACCARD = 0.6
+# Groups with fewer runs are not shown as a route
+MIN_ROUTE_RUNS = 3
+# Bump whenever the cells or signatures change meaning, to recompute all of them
+ROUTES_VERSION = 1
+
+# Fixed hash functions h(x) = (a * x + b) mod 2^32, so signatures stay comparable between runs
+_rng = np.random.default_rng(20240601)
+HASH_A = _rng.integers(1, 2 ** 32, NUM_HASHES, dtype=np.uint64) | np.uint64(1)
+HASH_B = _rng.integers(0, 2 ** 32, NUM_HASHES, dtype=np.uint64)
+
+
+def minhash(cells):
+    # MinHash signature of a cell set, NUM_HASHES uint32 values
+    if len(cells) == 0:
+        return np.full(NUM_HASHES, 2 ** 32 - 1, dtype=np.uint32)
+    # Mix the cell ids down to 32 bits first, neighbouring cells differ in the low bits only
+    mixed = (cells.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+    hashes = (HASH_A[:, None] * mixed[None, :] + HASH_B[:, None]) & np.uint64(0xFFFFFFFF)
+    return hashes.min(axis=1).astype(np.uint32)
+
+
+def jaccard(cells_a, cells_b):
+    union = len(cells_a) + len(cells_b)
+    if union == 0:
+        return 0.0
+    shared = len(np.intersect1d(cells_a, cells_b, assume_unique=True))
+    return shared / (union - shared)
+
+
+def candidate_pairs(signatures, new_rows):
+    """
+    Pairs of tracks that share at least one LSH band, with at least one of them new.
+
+    Parameters:
+    signatures (np.ndarray): (n, NUM_HASHES) MinHash signatures
+    new_rows (np.ndarray): Bool mask of the tracks to find partners for
+
+    Returns:
+    set: (row, row) pairs with the smaller row first
+    """
+    pairs = set()
+    for band in range(NUM_BANDS):
+        rows = np.ascontiguousarray(signatures[:, band * BAND_ROWS:(band + 1) * BAND_ROWS])
+        keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * BAND_ROWS))).ravel()
+        _, bucket = np.unique(keys, return_inverse=True)
+        order = np.argsort(bucket, kind='stable')
+        bounds = np.flatnonzero(np.diff(bucket[order])) + 1
+        for members in np.split(order, bounds):
+            if len(members) < 2 or not new_rows[members].any():
+                continue
+            for a in members[new_rows[members]].tolist():
+                for b in members.tolist():
+                    if a != b:
+                        pairs.add((min(a, b), max(a, b)))
+    return pairs
+
+
+def _components(ids, edges):
+    # Union-find over activity ids, returns the smallest id of the group of every id
+    parent = {activity_id: activity_id for activity_id in ids}
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in edges:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    return {activity_id: find(activity_id) for activity_id in ids}
+
+
+def _load_state(path):
+    empty = {'ids': np.zeros(0, dtype=np.int64), 'fingerprint': np.zeros(0, dtype=np.uint32),
+             'signatures': np.zeros((0, NUM_HASHES), dtype=np.uint32), 'cells': np.zeros(0, dtype=np.int64),
+             'cell_offsets': np.zeros(1, dtype=np.int64), 'edges': np.zeros((0, 2), dtype=np.int64)}
+    if not os.path.exists(path):
+        return empty
+    try:
+        with np.load(path) as data:
+            state = {name: data[name] for name in data.files}
+    except (OSError, ValueError) as e:
+        print(f"Error loading route state: {e}")
+        return empty
+    if int(state.pop('version', -1)) != ROUTES_VERSION:
+        return empty
+    return state
+
+
+def _save_state(state, path):
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, version=ROUTES_VERSION, **state)
+    os.replace(tmp_path, path)
+    count_written(path)
+
+
+def _route_names(conn, groups, features):
+    # Name every route after the most common city of its runs, whether it is a loop and
+    # its typical length, e.g. 'Kongens Lyngby loop, 7.2 km'
+    names = {}
+    for route_id, members in sorted(groups.items()):
+        placeholders = ', '.join('?' * len(members))
+        cities = Counter(city for city, in conn.execute(
+            f"SELECT city FROM activity_location WHERE activity_id IN ({placeholders}) AND city IS NOT NULL",
+            members))
+        loops = sum(features.is_loop(activity_id) for activity_id in members)
+        kind = 'loop' if 2 * loops > len(members) else 'route'
+        km = np.median([features.length(activity_id) for activity_id in members]) / 1000
+        name = f"{cities.most_common(1)[0][0]} {kind}" if cities else kind.capitalize()
+        name = f"{name}, {km:.1f} km"
+        # Routes of the same kind and length in the same city are numbered
+        taken = set(names.values())
+        if name in taken:
+            number = 2
+            while f"{name} ({number})" in taken:
+                number += 1
+            name = f"{name} ({number})"
+        names[route_id] = name
+    return names
+
+
+def update_routes(store, features, state_path=routes_state_path):
+    """
+    Group runs that follow the same route and store the groups in the activity database.
+
+    Every track becomes the set of grid cells it passes through. Near-duplicate tracks
+    are found with MinHash signatures and LSH banding instead of comparing all pairs, and
+    confirmed on the Jaccard similarity of their cells. Matched pairs are kept in the
+    state file, so new runs are only compared with candidates from their LSH buckets.
+    Groups of at least MIN_ROUTE_RUNS runs become routes, identified by the smallest
+    activity id in the group.
+
+    Parameters:
+    store (TrackStore): Tracks of all activities
+    features (ingest.TrackFeatures): Track features, for fingerprints, lengths and loops
+
+    Returns:
+    int: Number of routes
+    """
+    conn = connect()
+    try:
+        run_ids = {activity_id for activity_id, in conn.execute("SELECT id FROM activities WHERE type = 'Run'")}
+        ids = np.array([activity_id for activity_id in store.ids().tolist()
+                        if activity_id in run_ids and store.num_points(activity_id)], dtype=np.int64)
+        fingerprints = features.arrays['fingerprint'][[features.row(activity_id) for activity_id in ids.tolist()]] \
+            if len(ids) else np.zeros(0, dtype=np.uint32)
+
+        # Keep the cells and signatures of the tracks that did not change
+        state = _load_state(state_path)
+        previous = {activity_id: i for i, activity_id in enumerate(state['ids'].tolist())}
+        kept = {activity_id for activity_id, fingerprint in zip(ids.tolist(), fingerprints.tolist())
+                if activity_id in previous and state['fingerprint'][previous[activity_id]] == fingerprint}
+        signatures = np.zeros((len(ids), NUM_HASHES), dtype=np.uint32)
+        cells = []
+        is_new = np.zeros(len(ids), dtype=bool)
+        for i, activity_id in enumerate(ids.tolist()):
+            if activity_id in kept:
+                row = previous[activity_id]
+                signatures[i] = state['signatures'][row]
+                cells.append(state['cells'][state['cell_offsets'][row]:state['cell_offsets'][row + 1]])
+            else:
+                cells.append(track_cells(*(np.asarray(x) / COORD_SCALE for x in store.raw(activity_id)), CELL_ZOOM))
+                signatures[i] = minhash(cells[-1])
+                is_new[i] = True
+
+        # Pairs between unchanged tracks stay valid, new tracks are matched against their candidates
+        edges = [(a, b) for a, b in state['edges'].tolist() if a in kept and b in kept]
+        candidates = candidate_pairs(signatures, is_new)
+        for a, b in candidates:
+            if jaccard(cells[a], cells[b]) >= MIN_JACCARD:
+                edges.append((int(ids[a]), int(ids[b])))
+        print(f"Matched {is_new.sum()} new tracks against {len(candidates)} candidate pairs "
+              f"instead of {int(is_new.sum()) * (len(ids) - 1)} comparisons.")
+
+        cell_offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in cells], out=cell_offsets[1:])
+        _save_state({'ids': ids, 'fingerprint': fingerprints, 'signatures': signatures,
+                     'cells': np.concatenate(cells) if cells else np.zeros(0, dtype=np.int64),
+                     'cell_offsets': cell_offsets, 'edges': np.array(edges, dtype=np.int64).reshape(-1, 2)},
+                    state_path)
+
+        groups = {}
+        for activity_id, route_id in _components(ids.tolist(), edges).items():
+            groups.setdefault(route_id, []).append(activity_id)
+        groups = {route_id: members for route_id, members in groups.items() if len(members) >= MIN_ROUTE_RUNS}
+        names = _route_names(conn, groups, features)
+
+        # Replace the routes in one transaction, the revision only moves if they changed
+        assignments = sorted((activity_id, route_id) for route_id, members in groups.items() for activity_id in members)
+        current = (conn.execute('SELECT activity_id, route_id FROM activity_route ORDER BY activity_id').fetchall(),
+                   conn.execute('SELECT route_id, name FROM routes ORDER BY route_id').fetchall())
+        if current != (assignments, sorted(names.items())):
+            with conn:
+                conn.execute('DELETE FROM activity_route')
+                conn.execute('DELETE FROM routes')
+                conn.executemany('INSERT INTO routes (route_id, name) VALUES (?, ?)', sorted(names.items()))
+                conn.executemany('INSERT INTO activity_route (activity_id, route_id) VALUES (?, ?)', assignments)
+                bump_revision(conn, 'routes')
+        print(f"Found {len(groups)} routes covering {len(assignments)} of {len(ids)} runs "
+              f"(routes revision {revision(conn, 'routes')}).")
+        return len(groups)
+    finally:
+        conn.close()
@@ -0,0 +1,278 @@
+import os
+import numpy as np
+
+from heatmap_tiles import world_coords
+from instrumentation import count_written
+from track_store import COORD_SCALE
+from track_metrics import EARTH_RADIUS
+
+# Posting lists of all stored tracks, reused until a track changes
+spatial_index_path = 'spatial_index.npz'
+
+# Cells are Web Mercator tiles at this zoom level, about 300 m at the equator and 175 m
+# in Copenhagen
+INDEX_ZOOM = 17
+# Bump whenever the index changes meaning, to rebuild it
+INDEX_VERSION = 1
+
+EARTH_CIRCUMFERENCE = 2 * np.pi * EARTH_RADIUS  # Meters
+
+
+def track_cells(lat, lon, zoom):
+    """
+    The grid cells at a zoom level a track passes through, as sorted unique int64 ids
+    (x * 2**zoom + y).
+
+    Every segment is sampled at least twice per cell, so sparse summary polylines cover
+    the same cells as dense recordings of the same route.
+    """
+    if len(lat) == 0:
+        return np.zeros(0, dtype=np.int64)
+    x, y = world_coords(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+    scale = 2 ** zoom
+    x, y = x * scale, y * scale
+    steps = np.maximum(np.ceil(2 * np.hypot(np.diff(x), np.diff(y))), 1).astype(np.int64)
+    segment = np.repeat(np.arange(len(steps)), steps)
+    t = (np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+    xs = np.concatenate((x[segment] + t * np.diff(x)[segment], x[-1:]))
+    ys = np.concatenate((y[segment] + t * np.diff(y)[segment], y[-1:]))
+    xs = np.clip(np.floor(xs).astype(np.int64), 0, scale - 1)
+    ys = np.clip(np.floor(ys).astype(np.int64), 0, scale - 1)
+    return np.unique(xs * scale + ys)
+
+
+def _local_meters(lat, lon, lat0, lon0):
+    # Equirectangular projection around (lat0, lon0), accurate enough within a few km
+    x = np.radians(lon - lon0) * np.cos(np.radians(lat0)) * EARTH_RADIUS
+    y = np.radians(lat - lat0) * EARTH_RADIUS
+    return x, y
+
+
+def _distance_to_track(lat, lon, center_lat, center_lon):
+    # Smallest distance in meters from a point to the segments of a track
+    x, y = _local_meters(lat, lon, center_lat, center_lon)
+    if len(x) == 1:
+        return float(np.hypot(x[0], y[0]))
+    dx, dy = np.diff(x), np.diff(y)
+    length2 = dx * dx + dy * dy
+    t = np.clip(-(x[:-1] * dx + y[:-1] * dy) / np.where(length2 > 0, length2, 1), 0, 1)
+    return float(np.hypot(x[:-1] + t * dx, y[:-1] + t * dy).min())
+
+
+def _crosses_bbox(lat, lon, lat_min, lon_min, lat_max, lon_max):
+    # True if a point of the track lies in the box or a segment crosses it (Liang-Barsky)
+    if np.any((lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)):
+        return True
+    if len(lat) < 2:
+        return False
+    x0, y0, dx, dy = lon[:-1], lat[:-1], np.diff(lon), np.diff(lat)
+    t0, t1 = np.zeros(len(dx)), np.ones(len(dx))
+    inside = np.ones(len(dx), dtype=bool)
+    for p, q in ((-dx, x0 - lon_min), (dx, lon_max - x0), (-dy, y0 - lat_min), (dy, lat_max - y0)):
+        parallel = p == 0
+        inside &= ~(parallel & (q < 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = q / p
+        t0 = np.where(~parallel & (p < 0), np.maximum(t0, r), t0)
+        t1 = np.where(~parallel & (p > 0), np.minimum(t1, r), t1)
+    return bool(np.any(inside & (t0 <= t1)))
+
+
+class SpatialIndex:
+    """
+    Uniform grid over all track points: for every cell the sorted ids of the activities
+    passing through it, stored as posting lists (cell keys, offsets, activity ids).
+
+    Queries collect the posting lists of the cells they touch. Activities found in cells
+    that lie entirely inside the query area match right away; the others are checked
+    against their track when a store is given.
+    """
+
+    def __init__(self, arrays=None):
+        if arrays is None:
+            arrays = {'ids': np.zeros(0, dtype=np.int64), 'fingerprint': np.zeros(0, dtype=np.uint32),
+                      'pair_cells': np.zeros(0, dtype=np.int64), 'pair_ids': np.zeros(0, dtype=np.int64)}
+        self.arrays = arrays
+        # (cell, activity) pairs sorted by cell and id, the posting lists are their runs
+        self.keys, starts = np.unique(arrays['pair_cells'], return_index=True)
+        self.offsets = np.append(starts, len(arrays['pair_cells'])).astype(np.int64)
+        self.postings = arrays['pair_ids']
+
+    @classmethod
+    def load(cls, path=spatial_index_path):
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError) as e:
+            print(f"Error loading spatial index: {e}")
+            return cls()
+        if int(arrays.pop('version', -1)) != INDEX_VERSION:
+            return cls()
+        return cls(arrays)
+
+    def save(self, path=spatial_index_path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, version=INDEX_VERSION, **self.arrays)
+        os.replace(tmp_path, path)
+        count_written(path)
+
+    def __len__(self):
+        return len(self.arrays['ids'])
+
+    def _rows(self, cells):
+        # Positions in self.keys of those of the given cells that are stored
+        cells = np.asarray(cells, dtype=np.int64)
+        rows = np.searchsorted(self.keys, cells)
+        found = rows < len(self.keys)
+        found[found] = self.keys[rows[found]] == cells[found]
+        return rows, found
+
+    def _postings(self, rows):
+        # Concatenated posting lists of the given rows, and the row position each id came from
+        lengths = self.offsets[rows + 1] - self.offsets[rows]
+        positions = np.repeat(self.offsets[rows] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self.postings[positions], np.repeat(np.arange(len(rows)), lengths)
+
+    def _collect(self, cells):
+        # Activity ids in the posting lists of the given cells
+        rows, found = self._rows(cells)
+        return np.unique(self._postings(rows[found])[0])
+
+    def _cells_in_range(self, x_min, x_max, y_min, y_max):
+        # Stored cells with x_min <= x <= x_max and y_min <= y <= y_max, one key range per column
+        scale = 2 ** INDEX_ZOOM
+        columns = np.arange(x_min, x_max + 1, dtype=np.int64)
+        lo = np.searchsorted(self.keys, columns * scale + y_min)
+        hi = np.searchsorted(self.keys, columns * scale + y_max, side='right')
+        lengths = hi - lo
+        positions = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self.keys[positions]
+
+    def _refine(self, candidates, store, matches):
+        if store is None:
+            return candidates
+        return np.array([activity_id for activity_id in candidates.tolist()
+                         if activity_id in store and matches(*(np.asarray(x) / COORD_SCALE for x in store.raw(activity_id)))],
+                        dtype=np.int64)
+
+    def query_bbox(self, lat_min, lon_min, lat_max, lon_max, store=None):
+        """
+        Activities passing through a bounding box.
+
+        Parameters:
+        lat_min, lon_min, lat_max, lon_max (float): The box in degrees
+        store (TrackStore): If given, activities near the edge of the box are checked against
+            their tracks; otherwise every activity in a touched cell is returned
+
+        Returns:
+        np.ndarray: Sorted activity ids
+        """
+        scale = 2 ** INDEX_ZOOM
+        (x0, x1), (y1, y0) = (np.clip(np.floor(np.array(c) * scale).astype(np.int64), 0, scale - 1)
+                              for c in world_coords(np.array([lat_min, lat_max]), np.array([lon_min, lon_max])))
+        cells = self._cells_in_range(x0, x1, y0, y1)
+        x, y = cells // scale, cells % scale
+        interior = (x > x0) & (x < x1) & (y > y0) & (y < y1)
+        inside = self._collect(cells[interior])
+        edge = np.setdiff1d(self._collect(cells[~interior]), inside, assume_unique=True)
+        edge = self._refine(edge, store, lambda lat, lon: _crosses_bbox(lat, lon, lat_min, lon_min, lat_max, lon_max))
+        return np.union1d(inside, edge)
+
+    def query_radius(self, lat, lon, radius, store=None):
+        """
+        Activities passing within radius meters of a point.
+
+        Parameters:
+        lat, lon (float): Center in degrees
+        radius (float): Radius in meters
+        store (TrackStore): If given, activities near the edge of the circle are checked
+            against their tracks; otherwise every activity in a touched cell is returned
+
+        Returns:
+        np.ndarray: Sorted activity ids
+        """
+        scale = 2 ** INDEX_ZOOM
+        cx, cy = (float(c) * scale for c in world_coords(np.array(lat), np.array(lon)))
+        # Meters per cell at this latitude
+        cell_size = EARTH_CIRCUMFERENCE * np.cos(np.radians(lat)) / scale
+        reach = radius / cell_size
+        cells = self._cells_in_range(int(np.floor(cx - reach)), int(np.floor(cx + reach)),
+                                     int(np.floor(cy - reach)), int(np.floor(cy + reach)))
+        x, y = (cells // scale).astype(np.float64), (cells % scale).astype(np.float64)
+        # Nearest and farthest point of every cell from the center, in cells
+        near = np.hypot(np.clip(cx, x, x + 1) - cx, np.clip(cy, y, y + 1) - cy)
+        far = np.hypot(np.maximum(np.abs(x - cx), np.abs(x + 1 - cx)), np.maximum(np.abs(y - cy), np.abs(y + 1 - cy)))
+        touched = near <= reach
+        interior = far <= reach
+        inside = self._collect(cells[interior])
+        edge = np.setdiff1d(self._collect(cells[touched & ~interior]), inside, assume_unique=True)
+        edge = self._refine(edge, store, lambda track_lat, track_lon: _distance_to_track(track_lat, track_lon, lat, lon) <= radius)
+        return np.union1d(inside, edge)
+
+    def query_polyline(self, lat, lon, min_fraction=0.8):
+        """
+        Activities that follow a polyline, such as another run.
+
+        The polyline is turned into the cells it passes through; an activity matches when
+        it covers at least min_fraction of them, allowing one cell of GPS offset.
+
+        Parameters:
+        lat, lon (array-like): Points of the polyline in degrees
+        min_fraction (float): Share of the polyline the activity has to cover
+
+        Returns:
+        np.ndarray: Sorted activity ids
+        """
+        scale = 2 ** INDEX_ZOOM
+        cells = track_cells(lat, lon, INDEX_ZOOM)
+        if not len(cells):
+            return np.zeros(0, dtype=np.int64)
+        # Every query cell counts once per activity found in it or one of its neighbours
+        x, y = cells // scale, cells % scale
+        neighbours = ((x[:, None] + np.repeat([-1, 0, 1], 3)) * scale + y[:, None] + np.tile([-1, 0, 1], 3)).ravel()
+        rows, found = self._rows(neighbours)
+        activity_ids, source = self._postings(rows[found])
+        query_cell = np.flatnonzero(found)[source] // 9
+        pairs = np.unique(activity_ids * len(cells) + query_cell)
+        matched, counts = np.unique(pairs // len(cells), return_counts=True)
+        return matched[counts >= min_fraction * len(cells)]
+
+
+def update_spatial_index(store, features, path=spatial_index_path):
+    """
+    Bring the spatial index up to date with the track store.
+
+    The cells of tracks that did not change are kept; only new or changed tracks are
+    rasterised into cells.
+
+    Parameters:
+    store (TrackStore): Tracks of all activities
+    features (ingest.TrackFeatures): Track features, for the fingerprints
+
+    Returns:
+    SpatialIndex: The updated index
+    """
+    index = SpatialIndex.load(path)
+    ids = store.ids()
+    fingerprints = features.arrays['fingerprint'][[features.row(activity_id) for activity_id in ids.tolist()]] \
+        if len(ids) else np.zeros(0, dtype=np.uint32)
+    previous = dict(zip(index.arrays['ids'].tolist(), index.arrays['fingerprint'].tolist()))
+    kept = np.array([previous.get(activity_id) == fingerprint
+                     for activity_id, fingerprint in zip(ids.tolist(), fingerprints.tolist())], dtype=bool)
+    if kept.all() and len(previous) == len(ids):
+        return index
+
+    keep_pairs = np.isin(index.arrays['pair_ids'], ids[kept])
+    new_cells = [track_cells(*(np.asarray(x) / COORD_SCALE for x in store.raw(activity_id)), INDEX_ZOOM)
+                 for activity_id in ids[~kept].tolist()]
+    pair_cells = np.concatenate([index.arrays['pair_cells'][keep_pairs]] + new_cells)
+    pair_ids = np.concatenate([index.arrays['pair_ids'][keep_pairs],
+                               np.repeat(ids[~kept], [len(cells) for cells in new_cells])]).astype(np.int64)
+    order = np.lexsort((pair_ids, pair_cells))
+    index = SpatialIndex({'ids': ids, 'fingerprint': fingerprints,
+                          'pair_cells': pair_cells[order], 'pair_ids': pair_ids[order]})
+    index.save(path)
+    print(f"Spatial index updated with {int((~kept).sum())} tracks ({len(index.keys)} cells).")
+    return index
@@ -1,377 +1,557 @@
 import os
-import gpxpy
+import numpy as np
 import pandas as pd
 import folium
-from datetime import datetime
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderUnavailable
+from datetime import datetime, date, timedelta
 from collections import defaultdict
 import streamlit as st
 from datetime import datetime
 import time
 import json
+import hashlib
+import html
+from branca.element import MacroElement
+from jinja2 import Template
+from ingest import ingest_tracks
+from instrumentation import span, count, writing
+from geocode_cache import get_city_and_country, reverse_geocode_points
+from offline_geocoder import OfflineGeocoder
+from activity_catalog import ActivityCatalog
+from activity_db import (activity_db_path, connect as connect_activity_db, sync_track_meta, runs_without_location,
+                         upsert_locations, clear_locations, export_locations, read_exported_locations,
+                         locations_csv_path, location_stats, rollup_series, rollup_window,
+                         last_activity_date)
+from heatmap_tiles import update_heatmap_tiles, heatmap_tile_url, MAX_HEATMAP_ZOOM
+from tile_coverage import Coverage, COVERAGE_ZOOMS, OVERLAY_ZOOM
 
 # Paths to files and folders
 gpx_folder = 'API_GPX_FILES'
-csv_file_path = 'strava_activities.csv'
-
-# Helper function to extract city and country names from location data
-def get_city_and_country(location):
-    city, country = None, None
-    if location and location.raw and 'address' in location.raw:
-        address = location.raw['address']
-        city = address.get('city') or address.get('town') or address.get('village')
-        country = address.get('country', 'Unknown')
-    return city, country
-
-def generate_map_and_statistics(incremental=True):
-    # Load the CSV file for activities
-    df = pd.read_csv(csv_file_path)
-    
-    # Ensure that only "Run" activities are processed
-    df_runs = df[df['type'] == 'Run']
-    
-    # Check if existing map file is present
+map_layer_cache_path = 'map_layer_cache.json'
+heatmap_map_path = 'heatmap_map.html'
+
+# Style of the activity tracks on the map. Bump FRAGMENT_VERSION whenever the rendered
+# fragments change so that cached ones are rendered again.
+TRACK_STYLE = {'color': 'red', 'weight': 2.5, 'opacity': 1}
+FRAGMENT_VERSION = '3'
+# Highest zoom level whose geometry is embedded in the map. Closer in, the tracks keep this
+# detail: one pixel at zoom 15 is about 2.7 m in Copenhagen, the GPS noise of a track, and
+# the finer levels would double the vertices in the file.
+MAP_MAX_ZOOM = 15
+
+# The map and the runs list show the run numbers listed here, or all runs while it is null.
+# The app fills it in from spatial index queries without rebuilding the pages.
+AREA_FILTER_PLACEHOLDER = 'null /* area filter */'
+
+# Helper function to open the track store and the per-track features. GPX files that are not
+# part of the store yet are imported, and features of new tracks computed, in parallel.
+def load_tracks():
+    return ingest_tracks(gpx_folder)
+
+# All activities are drawn as one GeoJSON layer on a canvas renderer. Every feature is a
+# pre-rendered fragment; its vertices carry the minimum zoom level at which they are drawn,
+# one hex digit per vertex, and the layer is rebuilt with the matching vertices whenever the
+# zoom level changes.
+class CachedTrackLayer(MacroElement):
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function(map) {
+                var tracks = {"type": "FeatureCollection", "features": [{{ this.fragments }}]};
+                var style = {{ this.style }};
+                var area = {{ this.area }};
+                var tileZooms = {{ this.tile_zooms }};
+                if (area) {
+                    area = new Set(area);
+                    tracks.features = tracks.features.filter(function(feature) { return area.has(feature.properties.n); });
+                }
+                var layer = L.geoJSON(null, {
+                    style: function() { return style; },
+                    renderer: L.canvas(),
+                    onEachFeature: function(feature, line) {
+                        var p = feature.properties;
+                        line.bindTooltip("<div>Run Number: " + p.n + "<br>Date: " + p.d +
+                                         "<br>Total Distance: " + p.km + " km<br>Pace: " + p.p + " min/km" +
+                                         (p.r ? "<br>Route: " + p.r : "") +
+                                         (p.t ? "<br>New tiles: " + p.t.map(function(n, i) {
+                                             return n + " (zoom " + tileZooms[i] + ")";
+                                         }).join(", ") : "") + "</div>",
+                                         {"sticky": true});
+                    }
+                }).addTo(map);
+                var byZoom = {};
+                function forZoom(zoom) {
+                    if (!byZoom[zoom]) {
+                        byZoom[zoom] = tracks.features.map(function(feature) {
+                            var z = feature.properties.z;
+                            return {"type": "Feature", "properties": feature.properties, "geometry": {
+                                "type": "LineString",
+                                "coordinates": feature.geometry.coordinates.filter(function(c, i) { return parseInt(z.charAt(i), 16) <= zoom; })
+                            }};
+                        });
+                    }
+                    return byZoom[zoom];
+                }
+                function render() {
+                    layer.clearLayers();
+                    layer.addData(forZoom(Math.min(Math.round(map.getZoom()), {{ this.max_zoom }})));
+                }
+                map.on('zoomend', render);
+                render();
+            })({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, fragments):
+        super().__init__()
+        self._name = 'CachedTrackLayer'
+        self.fragments = ',\n'.join(fragments)
+        self.style = json.dumps(TRACK_STYLE)
+        self.max_zoom = MAP_MAX_ZOOM
+        self.area = AREA_FILTER_PLACEHOLDER
+        self.tile_zooms = json.dumps(COVERAGE_ZOOMS)
+
+# Render one activity as a GeoJSON feature from its track simplified for all zoom levels,
+# leaving out the vertices only needed above MAP_MAX_ZOOM
+def render_track_fragment(points, zoom, properties):
+    keep = zoom <= MAP_MAX_ZOOM
+    feature = {
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': np.round(points[keep, ::-1], 5).tolist()},
+        'properties': {**properties, 'z': ''.join(f"{z:x}" for z in zoom[keep].tolist())},
+    }
+    return json.dumps(feature, separators=(',', ':'))
+
+# Hash of everything a fragment is rendered from, so that changed activities are re-rendered
+def track_fragment_hash(store, activity_id, properties):
+    lat, lon = store.raw(activity_id)
+    content = hashlib.sha1(FRAGMENT_VERSION.encode())
+    content.update(lat.tobytes())
+    content.update(lon.tobytes())
+    content.update(json.dumps(properties, sort_keys=True).encode())
+    return content.hexdigest()
+
+# Restrict a generated map or runs list to the given run numbers
+def apply_area_filter(content, run_numbers):
+    return content.replace(AREA_FILTER_PLACEHOLDER, json.dumps(sorted(int(n) for n in run_numbers)))
+
+def load_map_layer_cache():
+    if os.path.exists(map_layer_cache_path):
+        try:
+            with open(map_layer_cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading map layer cache: {e}")
+    return {}
+
+def generate_map_and_statistics(incremental=True, catalog=None, tracks=None):
+    """
+    Generate the activity map from cached per-activity layer fragments.
+
+    All activities end up in a single GeoJSON layer, simplified per zoom level.
+
+    Parameters:
+    incremental (bool): If True, reuse the cached fragment of every activity whose track and
+        tooltip did not change, and only render new or changed activities
+    catalog (ActivityCatalog): Activities shared between the stages, loaded if not given
+    tracks (tuple): Track store and features shared between the stages, loaded if not given
+    """
+    if catalog is None:
+        catalog = ActivityCatalog()
+
+    # Rendered fragments by activity id, each with the hash of the content it was rendered from
+    layer_cache = load_map_layer_cache() if incremental else {}
+    new_layer_cache = {}
+    rendered = 0
+    reused = 0
+
+    # Initialize folium map
     map_file_path = 'activity_map.html'
-    if incremental and os.path.exists(map_file_path):
-        processed_activities = set()  # Set of already processed activity IDs
-        with open(map_file_path, 'r', encoding='utf-8') as map_file:
-            content = map_file.read()
-            for activity_id in df_runs['id']:
-                if f"Run Number: {activity_id}" in content:  # Simple heuristic to check if activity exists
-                    processed_activities.add(activity_id)
-    else:
-        processed_activities = set()
-    
-    # Initialize folium map or load the existing one
-    if incremental and os.path.exists(map_file_path):
-        activity_map = folium.Map(location=[55.6761, 12.5683], zoom_start=11, tiles='cartodb positron')
-    else:
-        activity_map = folium.Map(location=[55.6761, 12.5683], zoom_start=11, tiles='cartodb positron')
-
-    # Process new GPX files
-    for file_name in os.listdir(gpx_folder):
-        if file_name.endswith('.gpx'):
-            activity_id = file_name.replace('.gpx', '')
-            if activity_id in processed_activities:  # Skip already processed activities
-                continue
-
-            activity_data = df[df['id'] == int(activity_id)]
-            if activity_data.empty:
-                continue
-
-            start_time = pd.to_datetime(activity_data['start_date_local'].values[0])
-            file_path = os.path.join(gpx_folder, file_name)
-
-            with open(file_path, 'r') as gpx_file:
-                gpx = gpxpy.parse(gpx_file)
-                if gpx.tracks and gpx.tracks[0].segments and gpx.tracks[0].segments[0].points:
-                    track_points = [(point.latitude, point.longitude) for point in gpx.tracks[0].segments[0].points]
-
-                    # Generate popup and polyline
-                    total_distance_km = activity_data['distance'].values[0] / 1000
-                    total_time_seconds = activity_data['moving_time'].values[0]
-                    avg_pace_seconds_per_km = total_time_seconds / total_distance_km if total_distance_km > 0 else 0
-                    avg_pace_minutes = int(avg_pace_seconds_per_km // 60)
-                    avg_pace_seconds = int(avg_pace_seconds_per_km % 60)
-                    run_date = start_time.to_pydatetime().strftime("%d.%m.%Y")
-                    run_number = activity_data['run_number'].values[0]
-
-                    popup_text = (f"Run Number: {run_number}<br>"
-                                  f"Date: {run_date}<br>"
-                                  f"Total Distance: {total_distance_km:.3f} km<br>"
-                                  f"Pace: {avg_pace_minutes}:{avg_pace_seconds:02d} min/km")
-                    points = [(point[0], point[1]) for point in track_points]
-                    folium.PolyLine(points, color='red', weight=2.5, opacity=1, tooltip=popup_text).add_to(activity_map)
-
-    # Save the updated map
-    activity_map.save(map_file_path)
-
-    st.write(f"Map updated with {len(processed_activities)} processed activities.")
-
-
-# Generate the run list in a sortable HTML table
-def generate_runs_list_html():
-    # Load the CSV file for activities
-    df = pd.read_csv(csv_file_path)
-    
-    # Ensure only run activities are processed
-    df_runs = df[df['type'] == 'Run']
-    
-    runs_data = []
-    for file_name in os.listdir(gpx_folder):
-        if file_name.endswith('.gpx'):
-            activity_id = file_name.replace('.gpx', '')
-            activity_data = df_runs[df_runs['id'] == int(activity_id)]
-            if activity_data.empty:
-                continue
-
-            start_time = pd.to_datetime(activity_data['start_date_local'].values[0])
-            total_distance_km = activity_data['distance'].values[0] / 1000
-            total_time_seconds = activity_data['moving_time'].values[0]
-            run_number = activity_data['run_number'].values[0]
-
-            # Calculate average pace
-            avg_pace_seconds_per_km = total_time_seconds / total_distance_km if total_distance_km > 0 else 0
-            avg_pace_minutes = int(avg_pace_seconds_per_km // 60)
-            avg_pace_seconds = int(avg_pace_seconds_per_km % 60)
-
-            # Generate time strings for the HTML table
-            run_date = start_time.strftime("%d.%m.%Y")
-            end_time = start_time + pd.to_timedelta(total_time_seconds, unit='s')
-            time_str = f"{start_time.strftime('%H:%M:%S')} - {end_time.strftime('%H:%M:%S')} (Time: {pd.to_datetime(total_time_seconds, unit='s').strftime('%H:%M:%S')})"
-
-            # Append to the runs_data list
-            runs_data.append((run_number, run_date, time_str, total_distance_km, f"{avg_pace_minutes}:{avg_pace_seconds:02d} min/km", start_time))
-
-    # Sort runs by date in descending order for the HTML table
-    runs_data.sort(key=lambda x: x[5], reverse=True)  # Sort by start_time in descending order
+    activity_map = folium.Map(location=[55.6761, 12.5683], zoom_start=11, tiles='cartodb positron')
+
+    # Explored tiles below the tracks, with the largest fully explored square outlined
+    coverage = Coverage.load()
+    if len(coverage.bitmaps[OVERLAY_ZOOM]):
+        square = coverage.squares[OVERLAY_ZOOM][0]
+        folium.GeoJson(
+            coverage.overlay_geojson(OVERLAY_ZOOM),
+            name=f"Explored tiles: {len(coverage.bitmaps[OVERLAY_ZOOM])} at zoom {OVERLAY_ZOOM}, max square {square}x{square}",
+            style_function=lambda feature: ({'color': 'blue', 'weight': 3, 'fill': False} if feature['properties']['square']
+                                            else {'color': 'blue', 'weight': 0, 'fillOpacity': 0.12}),
+            interactive=False,
+        ).add_to(activity_map)
+        folium.LayerControl(collapsed=False).add_to(activity_map)
+
+    # Process tracks from the track store
+    store, features = tracks or load_tracks()
+    fragments = []
+    for activity in catalog.join_tracks(store.ids()).itertuples(index=False):
+        activity_id = activity.id
+        if not store.num_points(activity_id):
+            continue
+
+        # Tooltip values, the tooltip itself is built in the browser
+        properties = {
+            'n': int(activity.run_number),
+            'd': activity.date_str,
+            'km': f"{activity.distance_km:.3f}",
+            'p': activity.pace_str,
+        }
+        if isinstance(activity.route_name, str):
+            properties['r'] = activity.route_name
+        added = coverage.added_by(activity_id)
+        if added is not None:
+            properties['t'] = list(added)
+
+        # Reuse the cached fragment if nothing it depends on has changed
+        content_hash = track_fragment_hash(store, activity_id, properties)
+        cached = layer_cache.get(str(activity_id))
+        if cached is not None and cached['hash'] == content_hash:
+            fragment = cached['fragment']
+            reused += 1
+        else:
+            fragment = render_track_fragment(*features.simplified(activity_id), properties)
+            rendered += 1
+
+        new_layer_cache[str(activity_id)] = {'hash': content_hash, 'fragment': fragment}
+        fragments.append(fragment)
+
+    CachedTrackLayer(fragments).add_to(activity_map)
+
+    # Save the updated map and the layer cache
+    with writing(map_file_path):
+        activity_map.save(map_file_path)
+    with writing(map_layer_cache_path), open(map_layer_cache_path, 'w', encoding='utf-8') as f:
+        json.dump(new_layer_cache, f)
+    count('cache.map_layer.hits', reused)
+    count('cache.map_layer.misses', rendered)
+
+    st.write(f"Map updated with {len(fragments)} activities ({rendered} rendered, {reused} reused from the layer cache).")
+
+
+def generate_heatmap_html(incremental=True, catalog=None, tracks=None):
+    """
+    Update the heatmap tile pyramid and generate the map that shows it.
+
+    The map only references the tiles, so its size does not grow with the number of
+    activities; the browser loads the tiles in view from Streamlit's static files.
+
+    Parameters:
+    incremental (bool): If True, only rebuild the tiles touched by new or changed activities
+    catalog (ActivityCatalog): Activities shared between the stages, loaded if not given
+    tracks (tuple): Track store and features shared between the stages, loaded if not given
+    """
+    if catalog is None:
+        catalog = ActivityCatalog()
+    store, features = tracks or load_tracks()
+    # Activities deleted from the database leave their tracks in the store, they are taken
+    # out of the heatmap
+    added, written = update_heatmap_tiles(store, features, incremental=incremental,
+                                          activity_ids=catalog.df['id'].to_numpy())
+
+    # The tile URL changes with every update so that browsers do not show stale tiles
+    heatmap_map = folium.Map(location=[55.6761, 12.5683], zoom_start=11, tiles='cartodb positron')
+    folium.TileLayer(
+        tiles=f"{heatmap_tile_url}?v={int(time.time())}",
+        attr='Strava activities',
+        name='Heatmap',
+        overlay=True,
+        max_native_zoom=MAX_HEATMAP_ZOOM,
+        max_zoom=18,
+    ).add_to(heatmap_map)
+    with writing(heatmap_map_path):
+        heatmap_map.save(heatmap_map_path)
+    count('heatmap.activities_added', added)
+
+    st.write(f"Heatmap updated with {added} new or changed activities ({written} tiles written).")
+
+
+# Generate the run list as a virtualized, sortable and filterable HTML table
+def generate_runs_list_html(catalog=None, tracks=None):
+    """
+    Generate the runs list from a columnar JSON payload.
+
+    The page only holds the numbers; the browser formats the rows and renders just the
+    ones in view, so the table opens and sorts quickly even with tens of thousands of runs.
+    Date, time, distance and pace are sorted by their numeric values.
+
+    Parameters:
+    catalog (ActivityCatalog): Activities shared between the stages, loaded if not given
+    tracks (tuple): Track store and features shared between the stages, loaded if not given
+    """
+    # Load the activities unless they are shared by the caller
+    if catalog is None:
+        catalog = ActivityCatalog()
+
+    # Runs that have a track, sorted by date in descending order for the HTML table
+    store, _ = tracks or load_tracks()
+    runs = catalog.join_tracks(store.ids(), runs_only=True)
+    runs = runs.sort_values(by='start_date_local', ascending=False, kind='stable')
+
+    # Routes by number of runs, with their best pace and typical distance
+    route_runs = runs[runs['route_name'].notna()]
+    routes = (route_runs.groupby('route_name')
+              .agg(runs=('id', 'size'), best_pace=('pace_seconds', lambda pace: pace[pace > 0].min()),
+                   km=('distance_km', 'median'), last_run=('start_date_local', 'max'))
+              .sort_values(by=['runs', 'last_run'], ascending=False))
+    route_names = routes.index.tolist()
+
+    # One array per column: run number, local start time in seconds since the epoch, moving
+    # time in seconds, distance in meters, pace in seconds per km and route (index into the
+    # route names, -1 for none)
+    payload = {
+        'n': runs['run_number'].astype(int).tolist(),
+        's': runs['start_date_local'].values.astype('datetime64[s]').astype(np.int64).tolist(),
+        'm': runs['moving_time'].astype(int).tolist(),
+        'd': runs['distance'].round(1).tolist(),
+        'p': runs['pace_seconds'].astype(int).tolist(),
+        'r': pd.Index(route_names).get_indexer(runs['route_name']).tolist(),
+        'routes': route_names,
+    }
+
+    # Per-route section; clicking a route filters the list below
+    route_rows = ''.join(
+        f'<tr class="route" data-route="{i}"><td>{html.escape(name)}</td><td>{route.runs}</td>'
+        f'<td>{f"{int(route.best_pace) // 60}:{int(route.best_pace) % 60:02d} min/km" if route.best_pace > 0 else "-"}</td>'
+        f'<td>{route.km:.1f}</td><td>{route.last_run.strftime("%d.%m.%Y")}</td></tr>'
+        for i, (name, route) in enumerate(routes.iterrows()))
+    routes_section = f"""
+        <h3>Routes</h3>
+        <table class="routes">
+            <thead><tr><th>Route</th><th>Runs</th><th>Best Pace</th><th>Distance (km)</th><th>Last Run</th></tr></thead>
+            <tbody>{route_rows}</tbody>
+        </table>""" if route_rows else ''
 
     # Generate the HTML content
     html_content = """
     <html>
     <head>
         <style>
-            body { font-family: Arial, sans-serif; color: #333; }
-            table { width: 100%; border-collapse: collapse; margin: 20px 0; }
-            th, td { padding: 12px; border: 1px solid #ddd; text-align: left; }
-            th { background-color: #f4f4f4; cursor: pointer; }
+            body { font-family: Arial, sans-serif; color: #333; margin: 0; }
+            .filters { margin: 10px 0; }
+            .filters input { padding: 6px; margin-right: 10px; border: 1px solid #ddd; }
+            #viewport { height: 700px; overflow-y: auto; border: 1px solid #ddd; }
+            table { width: 100%; border-collapse: collapse; table-layout: fixed; }
+            th, td { padding: 12px; border: 1px solid #ddd; text-align: left; white-space: nowrap; overflow: hidden; }
+            th { background-color: #f4f4f4; cursor: pointer; position: sticky; top: 0; }
             th.sort-asc::after { content: " \\2191"; }
             th.sort-desc::after { content: " \\2193"; }
-            tr:nth-child(even) { background-color: #f9f9f9; }
+            tr.row { height: 45px; }
+            tr.even { background-color: #f9f9f9; }
+            td.spacer { padding: 0; border: none; }
+            table.routes { margin-bottom: 20px; }
+            table.routes th { cursor: default; position: static; }
+            tr.route { cursor: pointer; }
+            tr.route:hover { background-color: #f4f4f4; }
         </style>
-        <script>
-            document.addEventListener('DOMContentLoaded', () => {
-                const getCellValue = (tr, idx) => tr.children[idx].innerText || tr.children[idx].textContent;
-                const comparer = (idx, asc, type) => (a, b) => {
-                    let v1 = getCellValue(asc ? a : b, idx);
-                    let v2 = getCellValue(asc ? b : a, idx);
-                    if (type === 'date') {
-                        v1 = new Date(v1);
-                        v2 = new Date(v2);
-                    } else if (type === 'pace') {
-                        const [min1, sec1] = v1.split(':');
-                        const [min2, sec2] = v2.split(':');
-                        v1 = parseInt(min1) * 60 + parseInt(sec1);
-                        v2 = parseInt(min2) * 60 + parseInt(sec2);
-                    } else if (!isNaN(v1) && !isNaN(v2)) {
-                        v1 = parseFloat(v1);
-                        v2 = parseFloat(v2);
-                    }
-                    return v1 > v2 ? 1 : v1 < v2 ? -1 : 0;
-                };
-
-                document.querySelectorAll('th').forEach(th => th.addEventListener('click', (() => {
-                    const table = th.closest('table');
-                    const type = th.getAttribute('data-type');
-                    Array.from(table.querySelectorAll('tr:nth-child(n+2)'))
-                        .sort(comparer(Array.from(th.parentNode.children).indexOf(th), this.asc = !this.asc, type))
-                        .forEach(tr => table.appendChild(tr));
-                    th.classList.toggle('sort-asc', this.asc);
-                    th.classList.toggle('sort-desc', !this.asc);
-                })));
-            });
-        </script>
     </head>
     <body>
-        <table>
-            <tr>
-                <th data-type="number">Run Number</th>
-                <th data-type="date">Date</th>
-                <th data-type="text">Time</th>
-                <th data-type="number">Distance (km)</th>
-                <th data-type="pace">Average Pace (min/km)</th>
-            </tr>
-    """
-
-    # Add rows to the table
-    for run in runs_data:
-        run_number, run_date, time_str, distance_km, pace, _ = run
-        html_content += f"""
-            <tr>
-                <td>{run_number}</td>
-                <td>{run_date}</td>
-                <td>{time_str}</td>
-                <td>{distance_km:.3f}</td>
-                <td>{pace}</td>
-            </tr>
-        """
-
-    # Close the HTML content
-    html_content += """
-        </table>
+        __ROUTES__
+        <div class="filters">
+            <input id="search" type="search" placeholder="Run number or date">
+            <input id="min-km" type="number" step="0.5" placeholder="Min km">
+            <input id="max-km" type="number" step="0.5" placeholder="Max km">
+            <select id="route"><option value="">All routes</option></select>
+            <span id="count"></span>
+        </div>
+        <div id="viewport">
+            <table>
+                <thead>
+                    <tr>
+                        <th data-key="number">Run Number</th>
+                        <th data-key="date" class="sort-desc">Date</th>
+                        <th data-key="time">Time</th>
+                        <th data-key="distance">Distance (km)</th>
+                        <th data-key="pace">Average Pace (min/km)</th>
+                        <th data-key="route">Route</th>
+                    </tr>
+                </thead>
+                <tbody id="rows"></tbody>
+            </table>
+        </div>
+        <script>
+            const runs = __RUNS__;
+            const total = runs.n.length;
+            const area = __AREA__;
+            const inArea = area && new Set(area);
+            const ROW_HEIGHT = 45;
+            const OVERSCAN = 10;
+
+            const pad = v => String(v).padStart(2, '0');
+            const clock = t => pad(Math.floor(t / 3600) % 24) + ':' + pad(Math.floor(t / 60) % 60) + ':' + pad(t % 60);
+            const dateStr = i => {
+                const d = new Date(runs.s[i] * 1000);
+                return pad(d.getUTCDate()) + '.' + pad(d.getUTCMonth() + 1) + '.' + d.getUTCFullYear();
+            };
+            const dates = Array.from({length: total}, (_, i) => dateStr(i));
+            const escapeHtml = text => text.replace(/[&<>"]/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'})[c]);
+            const routeNames = runs.routes.map(escapeHtml);
+            const routeSelect = document.getElementById('route');
+            routeNames.forEach((name, r) => routeSelect.add(new Option(runs.routes[r], r)));
+
+            // Numeric sort keys per column
+            const keys = {
+                number: runs.n,
+                date: runs.s,
+                time: runs.s.map(s => s % 86400),
+                distance: runs.d,
+                pace: runs.p,
+                route: runs.r,
+            };
+
+            let order = Array.from({length: total}, (_, i) => i);
+            let view = order;
+            const viewport = document.getElementById('viewport');
+            const rows = document.getElementById('rows');
+
+            function rowHtml(i, position) {
+                const start = runs.s[i], moving = runs.m[i], pace = runs.p[i];
+                return '<tr class="row' + (position % 2 ? ' even' : '') + '">' +
+                    '<td>' + runs.n[i] + '</td>' +
+                    '<td>' + dates[i] + '</td>' +
+                    '<td>' + clock(start % 86400) + ' - ' + clock((start + moving) % 86400) + ' (Time: ' + clock(moving) + ')</td>' +
+                    '<td>' + (runs.d[i] / 1000).toFixed(3) + '</td>' +
+                    '<td>' + Math.floor(pace / 60) + ':' + pad(pace % 60) + ' min/km</td>' +
+                    '<td>' + (runs.r[i] >= 0 ? routeNames[runs.r[i]] : '') + '</td></tr>';
+            }
+
+            // Only the rows in view are in the DOM, spacer rows keep the scroll height
+            function render() {
+                const visible = Math.ceil(viewport.clientHeight / ROW_HEIGHT);
+                const first = Math.max(0, Math.floor(viewport.scrollTop / ROW_HEIGHT) - OVERSCAN);
+                const last = Math.min(view.length, first + visible + 2 * OVERSCAN);
+                let html = '<tr><td class="spacer" colspan="6" style="height: ' + first * ROW_HEIGHT + 'px"></td></tr>';
+                for (let position = first; position < last; position++) {
+                    html += rowHtml(view[position], position);
+                }
+                html += '<tr><td class="spacer" colspan="6" style="height: ' + (view.length - last) * ROW_HEIGHT + 'px"></td></tr>';
+                rows.innerHTML = html;
+            }
+
+            function applyFilter() {
+                const text = document.getElementById('search').value.trim();
+                const minKm = parseFloat(document.getElementById('min-km').value);
+                const maxKm = parseFloat(document.getElementById('max-km').value);
+                const route = routeSelect.value === '' ? null : Number(routeSelect.value);
+                view = order.filter(i =>
+                    (!text || String(runs.n[i]) === text || dates[i].includes(text)) &&
+                    (route === null || runs.r[i] === route) &&
+                    (!inArea || inArea.has(runs.n[i])) &&
+                    (isNaN(minKm) || runs.d[i] >= minKm * 1000) &&
+                    (isNaN(maxKm) || runs.d[i] <= maxKm * 1000));
+                document.getElementById('count').textContent = view.length + ' of ' + total + ' runs';
+                render();
+            }
+
+            document.querySelectorAll('th[data-key]').forEach(th => th.addEventListener('click', () => {
+                const key = keys[th.dataset.key];
+                const asc = !th.classList.contains('sort-asc');
+                order = order.slice().sort(asc ? (a, b) => key[a] - key[b] : (a, b) => key[b] - key[a]);
+                document.querySelectorAll('th[data-key]').forEach(other => other.classList.remove('sort-asc', 'sort-desc'));
+                th.classList.add(asc ? 'sort-asc' : 'sort-desc');
+                applyFilter();
+            }));
+            ['search', 'min-km', 'max-km', 'route'].forEach(id => document.getElementById(id).addEventListener('input', applyFilter));
+            document.querySelectorAll('tr.route').forEach(tr => tr.addEventListener('click', () => {
+                routeSelect.value = tr.dataset.route;
+                applyFilter();
+            }));
+            viewport.addEventListener('scroll', () => window.requestAnimationFrame(render));
+            applyFilter();
+        </script>
     </body>
     </html>
-    """
+    """.replace('__ROUTES__', routes_section).replace('__AREA__', AREA_FILTER_PLACEHOLDER).replace('__RUNS__', json.dumps(payload, separators=(',', ':')).replace('</', '<\\/'))
 
     # Save the generated HTML content to a file
-    with open('runs_list.html', 'w', encoding='utf-8') as file:
+    with writing('runs_list.html'), open('runs_list.html', 'w', encoding='utf-8') as file:
         file.write(html_content)
 
     print("Run list HTML file generated: runs_list.html")
 
-def generate_city_statistics_html(incremental=True):
-    """
-    Generate HTML file with statistics about running activities grouped by city and country.
-    
-    Parameters:
-    incremental (bool): If True, will only process new GPX files that haven't been processed before
+def update_run_locations(features, incremental=True):
     """
-    print("Starting to generate city statistics...")
-    
-    # Load the CSV file for activities
-    df = pd.read_csv(csv_file_path)
-    
-    # Ensure that only "Run" activities are processed
-    df_runs = df[df['type'] == 'Run']
-    
-    # Initialize geocoder for reverse geocoding
-    geolocator = Nominatim(user_agent="strava_city_stats")
-    
-    # Path to cache file for statistics
-    stats_cache_file = 'city_stats_cache.json'
-    
-    # Load existing statistics if incremental and file exists
-    if incremental and os.path.exists(stats_cache_file):
-        try:
-            with open(stats_cache_file, 'r') as f:
-                cache_data = json.load(f)
-                city_stats = defaultdict(lambda: {'distance': 0, 'count': 0})
-                country_stats = defaultdict(lambda: {'distance': 0, 'count': 0})
-                
-                # Restore city stats from cache
-                for city, stats in cache_data.get('cities', {}).items():
-                    city_stats[city]['distance'] = stats['distance']
-                    city_stats[city]['count'] = stats['count']
-                
-                # Restore country stats from cache
-                for country, stats in cache_data.get('countries', {}).items():
-                    country_stats[country]['distance'] = stats['distance']
-                    country_stats[country]['count'] = stats['count']
-                
-                # Get the list of already processed activities
-                processed_activities = set(cache_data.get('processed_activities', []))
-                print(f"Loaded cache with {len(processed_activities)} previously processed activities")
-        except Exception as e:
-            print(f"Error loading cache: {e}")
-            # If there's an error loading the cache, start fresh
-            city_stats = defaultdict(lambda: {'distance': 0, 'count': 0})
-            country_stats = defaultdict(lambda: {'distance': 0, 'count': 0})
-            processed_activities = set()
-    else:
-        # Start with empty stats
-        city_stats = defaultdict(lambda: {'distance': 0, 'count': 0})
-        country_stats = defaultdict(lambda: {'distance': 0, 'count': 0})
-        processed_activities = set()
-    
-    # Cache for geocoding results to avoid redundant API calls
-    geocoding_cache = {}
+    Store the city and country of every run in the activity database.
     
-    # List to track newly processed activities
-    newly_processed = []
+    Only runs without a location, or whose track changed, are geocoded. Runs that never
+    had a location take it from the exported locations (see locations_csv_path) first.
+    Runs whose location cannot be resolved, such as during an offline build, get no row
+    and are tried again on the next call.
     
-    # Count for tracking progress
-    gpx_files = [f for f in os.listdir(gpx_folder) if f.endswith('.gpx')]
-    total_files = len(gpx_files)
-    processed_files = 0
-    skipped_files = 0
+    Parameters:
+    features (ingest.TrackFeatures): Features of all stored tracks
+    incremental (bool): If False, the locations of all runs are resolved again
     
-    # Process GPX files to extract location data
-    for file_name in gpx_files:
-        activity_id = file_name.replace('.gpx', '')
+    Returns:
+    int: Number of runs still without a location
+    """
+    conn = connect_activity_db()
+    try:
+        # Bring the track metadata in the database up to date with the track store
+        sync_track_meta(conn, features)
+        if not incremental:
+            clear_locations(conn)
         
-        # Skip if already processed and we're doing incremental update
-        if incremental and activity_id in processed_activities:
-            skipped_files += 1
-            continue
-            
-        processed_files += 1
-        if processed_files % 10 == 0:
-            print(f"Processed {processed_files} new GPX files, skipped {skipped_files}...")
-            
-        try:
-            activity_id_int = int(activity_id)
-            activity_data = df_runs[df_runs['id'] == activity_id_int]
-            
-            if activity_data.empty:
-                continue
-                
-            file_path = os.path.join(gpx_folder, file_name)
-            
-            try:
-                with open(file_path, 'r') as gpx_file:
-                    gpx = gpxpy.parse(gpx_file)
-                    if gpx.tracks and gpx.tracks[0].segments and gpx.tracks[0].segments[0].points:
-                        # Get middle point of the track for location lookup
-                        points = gpx.tracks[0].segments[0].points
-                        mid_point = points[len(points) // 2]
-                        
-                        # Create a coordinate string for geocoding and caching
-                        coord_str = f"{mid_point.latitude:.5f},{mid_point.longitude:.5f}"
-                        
-                        # Check if we already have this location in our cache
-                        if coord_str in geocoding_cache:
-                            city, country = geocoding_cache[coord_str]
-                        else:
-                            try:
-                                # Add a delay to respect Nominatim's usage policy
-                                time.sleep(1)
-                                
-                                # Reverse geocode to get city and country
-                                location = geolocator.reverse(coord_str, exactly_one=True)
-                                city, country = get_city_and_country(location)
-                                
-                                # Cache the result
-                                geocoding_cache[coord_str] = (city, country)
-                                
-                            except Exception as e:
-                                print(f"Geocoding error for activity {activity_id}: {e}")
-                                continue
-                        
-                        # Get activity distance in km
-                        distance_km = activity_data['distance'].values[0] / 1000
-                        
-                        # Update city statistics if city is available
-                        if city:
-                            city_stats[city]['distance'] += distance_km
-                            city_stats[city]['count'] += 1
-                        
-                        # Update country statistics if country is available
-                        if country:
-                            country_stats[country]['distance'] += distance_km
-                            country_stats[country]['count'] += 1
-                        
-                        # Mark as processed
-                        newly_processed.append(activity_id)
-            except Exception as e:
-                print(f"Error parsing GPX file {file_name}: {e}")
-                continue
-        except Exception as e:
-            print(f"Error processing file {file_name}: {e}")
-            continue
-    
-    # Update processed activities list
-    processed_activities.update(newly_processed)
+        # Runs whose location still has to be looked up, by the middle point of the track
+        pending = runs_without_location(conn)
+        
+        # Runs without any location row, such as in a fresh checkout, reuse the exported
+        # ones; runs whose track changed are looked up again
+        if incremental and pending:
+            located = {activity_id for activity_id, in conn.execute('SELECT activity_id FROM activity_location')}
+            exported = read_exported_locations()
+            reused = [(activity_id, *exported[activity_id], fingerprint)
+                      for activity_id, _, _, fingerprint in pending
+                      if activity_id not in located and activity_id in exported]
+            upsert_locations(conn, reused)
+            reused_ids = {activity_id for activity_id, _, _, _ in reused}
+            pending = [run for run in pending if run[0] not in reused_ids]
+            print(f"Reused {len(reused)} exported locations.")
+        
+        # Resolve all middle points at once from the local boundary polygons, and reverse
+        # geocode only the points outside of them, one lookup per neighbourhood
+        lats = np.array([lat for _, lat, _, _ in pending], dtype=np.float64)
+        lons = np.array([lon for _, _, lon, _ in pending], dtype=np.float64)
+        with span('geocode.offline', points=len(pending)):
+            locations = OfflineGeocoder().resolve(lats, lons)
+        misses = [i for i, location in enumerate(locations) if location is None]
+        count('geocode.offline_resolved', len(locations) - len(misses))
+        print(f"Resolved {len(locations) - len(misses)} of {len(locations)} locations offline.")
+        if misses:
+            with span('geocode.online', points=len(misses)):
+                for i, location in zip(misses, reverse_geocode_points(lats[misses], lons[misses])):
+                    locations[i] = location
+        
+        # Runs whose geocoding failed get no row and are tried again on the next run
+        rows = [(activity_id, location[0] or None, location[1] or None, fingerprint)
+                for (activity_id, _, _, fingerprint), location in zip(pending, locations)
+                if location is not None]
+        upsert_locations(conn, rows)
+        print(f"Stored the locations of {len(rows)} of {len(pending)} runs.")
+        
+        # The database is not committed, the locations are kept in the CSV instead
+        if rows or not os.path.exists(locations_csv_path):
+            with writing(locations_csv_path):
+                export_locations(conn)
+        return len(pending) - len(rows)
+    finally:
+        conn.close()
+
+def generate_city_statistics_html():
+    """
+    Generate HTML file with statistics about running activities grouped by city and country.
     
-    print(f"Completed processing {processed_files} new GPX files, skipped {skipped_files} already processed files.")
+    The locations of the runs are stored by update_run_locations. The statistics are
+    aggregated by the database, which keeps them correct when activities are edited or
+    deleted.
+    """
+    print("Starting to generate city statistics...")
     
-    # Save the updated cache
+    conn = connect_activity_db()
     try:
-        cache_data = {
-            'cities': {city: stats for city, stats in city_stats.items()},
-            'countries': {country: stats for country, stats in country_stats.items()},
-            'processed_activities': list(processed_activities)
-        }
-        
-        with open(stats_cache_file, 'w') as f:
-            json.dump(cache_data, f)
-        print(f"Cache updated with {len(processed_activities)} total processed activities")
-    except Exception as e:
-        print(f"Error saving cache: {e}")
-    
-    # Sort cities and countries by total distance (descending)
-    sorted_cities = sorted(city_stats.items(), key=lambda x: x[1]['distance'], reverse=True)
-    sorted_countries = sorted(country_stats.items(), key=lambda x: x[1]['distance'], reverse=True)
+        # Cities and countries sorted by total distance (descending)
+        sorted_cities = location_stats(conn, 'city_stats')
+        sorted_countries = location_stats(conn, 'country_stats')
+    finally:
+        conn.close()
     
     # Generate HTML content
     html_content = """<div class='city-stats'>
@@ -379,48 +559,98 @@ def generate_city_statistics_html(incremental=True):
 """
     
     # Add city statistics
-    for i, (city, stats) in enumerate(sorted_cities, 1):
-        html_content += f"<p>{i}. <strong>{city}</strong>: {stats['distance']:.3f} km ({stats['count']} Runs)</p>\n"
+    for i, (city, distance_km, runs) in enumerate(sorted_cities, 1):
+        html_content += f"<p>{i}. <strong>{city}</strong>: {distance_km:.3f} km ({runs} Runs)</p>\n"
     
     # Add country statistics
     html_content += "<br><br><h2>Country Statistics</h2>\n"
-    for i, (country, stats) in enumerate(sorted_countries, 1):
-        html_content += f"<p>{i}. <strong>{country}</strong>: {stats['distance']:.3f} km ({stats['count']} Runs)</p>\n"
+    for i, (country, distance_km, runs) in enumerate(sorted_countries, 1):
+        html_content += f"<p>{i}. <strong>{country}</strong>: {distance_km:.3f} km ({runs} Runs)</p>\n"
     
     html_content += "</div>"
     
     print("Generating HTML file...")
     
     # Save the generated HTML content to a file
-    with open('generated_city_statistics_from_csv.html', 'w', encoding='utf-8') as file:
+    with writing('generated_city_statistics_from_csv.html'), \
+            open('generated_city_statistics_from_csv.html', 'w', encoding='utf-8') as file:
         file.write(html_content)
     
     print("City statistics HTML file generated: generated_city_statistics_from_csv.html")
 
-def generate_summary_html():
-    # Load the CSV file for activities
-    df = pd.read_csv(csv_file_path)
+# Number of weeks shown in the weekly volume chart of the summary
+SUMMARY_WEEKS = 52
+
+def svg_bar_chart(title, labels, values, label_every=1, width=720, height=220):
+    """
+    Render a bar chart as inline SVG, with the value of each bar as its tooltip.
 
-    # Ensure that only "Run" activities are processed
-    df_runs = df[df['type'] == 'Run']
+    Parameters:
+    title (str): Title shown above the bars
+    labels (list): Label of each bar
+    values (list): Height of each bar, in km
+    label_every (int): Only write every n-th label below the axis
+
+    Returns:
+    str: The SVG element
+    """
+    top, bottom, left = 30, 25, 10
+    plot_height = height - top - bottom
+    slot = (width - 2 * left) / max(len(values), 1)
+    highest = max(values, default=0) or 1
+    parts = [f'<svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg" font-size="11">',
+             f'<text x="{left}" y="16" font-weight="bold">{title}</text>']
+    for i, (label, value) in enumerate(zip(labels, values)):
+        bar_height = value / highest * plot_height
+        x = left + i * slot
+        parts.append(f'<rect x="{x + slot * 0.1:.1f}" y="{top + plot_height - bar_height:.1f}" '
+                     f'width="{slot * 0.8:.1f}" height="{bar_height:.1f}" fill="#fc4c02">'
+                     f'<title>{label}: {value:.1f} km</title></rect>')
+        if i % label_every == 0:
+            parts.append(f'<text x="{x + slot / 2:.1f}" y="{height - 8}" text-anchor="middle">{label}</text>')
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+def generate_summary_html():
+    """
+    Generate the summary HTML file from the rollups in the activity database.
     
-    # Basic statistics
-    total_runs = len(df_runs)
-    total_distance_km = df_runs['distance'].sum() / 1000  # Convert meters to kilometers
-    avg_distance_per_run_km = total_distance_km / total_runs if total_runs > 0 else 0
-
-    # Filter data for the current year
-    current_year = datetime.now().year
-    df_runs_current_year = df_runs[pd.to_datetime(df_runs['start_date_local']).dt.year == current_year]
-    total_runs_current_year = len(df_runs_current_year)
-    total_distance_current_year_km = df_runs_current_year['distance'].sum() / 1000  # Convert meters to kilometers
-    avg_distance_per_run_current_year_km = total_distance_current_year_km / total_runs_current_year if total_runs_current_year > 0 else 0
-
-    # Get the date of the last run
-    if not df_runs.empty:
-        last_run_date = pd.to_datetime(df_runs['start_date_local']).max().strftime('%d.%m.%Y')
-    else:
-        last_run_date = 'N/A'
+    Totals and charts are read from the yearly, monthly, weekly and daily buckets, so the
+    time it takes does not grow with the number of runs.
+    """
+    conn = connect_activity_db()
+    try:
+        # Only "Run" activities are counted. All-time totals are the sum of the yearly buckets.
+        years = rollup_series(conn, 'year', 'Run')
+        total_runs = sum(count for _, count, _, _, _ in years)
+        total_distance_km = sum(distance for _, _, distance, _, _ in years) / 1000  # Convert meters to kilometers
+        avg_distance_per_run_km = total_distance_km / total_runs if total_runs > 0 else 0
+
+        # Totals for the current year
+        today = datetime.now().date()
+        current_year = today.year
+        total_runs_current_year, total_distance_current_year, _, _ = rollup_window(
+            conn, 'Run', date(current_year, 1, 1), date(current_year + 1, 1, 1))
+        total_distance_current_year_km = total_distance_current_year / 1000  # Convert meters to kilometers
+        avg_distance_per_run_current_year_km = total_distance_current_year_km / total_runs_current_year if total_runs_current_year > 0 else 0
+
+        # Get the date of the last run
+        last_run = last_activity_date(conn, 'Run')
+        last_run_date = datetime.strptime(last_run, '%Y-%m-%d').strftime('%d.%m.%Y') if last_run else 'N/A'
+
+        # Distance of the last SUMMARY_WEEKS weeks, including weeks without runs
+        first_week = today - timedelta(days=today.weekday() + 7 * (SUMMARY_WEEKS - 1))
+        weekly = {start: distance for start, _, distance, _, _ in
+                  rollup_series(conn, 'week', 'Run', first_week, today + timedelta(days=1))}
+        weeks = [first_week + timedelta(weeks=i) for i in range(SUMMARY_WEEKS)]
+    finally:
+        conn.close()
+
+    year_chart = svg_bar_chart('Distance per Year (km)', [start[:4] for start, _, _, _, _ in years],
+                               [distance / 1000 for _, _, distance, _, _ in years])
+    week_chart = svg_bar_chart(f'Weekly Distance, Last {SUMMARY_WEEKS} Weeks (km)',
+                               [week.strftime('%d.%m.') for week in weeks],
+                               [weekly.get(str(week), 0) / 1000 for week in weeks], label_every=8)
 
     # Generate the HTML content
     summary_html_content = f"""
@@ -443,13 +673,17 @@ def generate_summary_html():
             <p><strong>Average Distance per Run, This Year (km):</strong> {avg_distance_per_run_current_year_km:.3f}</p>
             <br>
             <p><strong>Date of Last Run:</strong> {last_run_date}</p>
+            <br>
+            {year_chart}
+            <br>
+            {week_chart}
         </div>
     </body>
     </html>
     """
 
     # Save the generated HTML content to a file
-    with open('generated_summary.html', 'w', encoding='utf-8') as file:
+    with writing('generated_summary.html'), open('generated_summary.html', 'w', encoding='utf-8') as file:
         file.write(summary_html_content)
 
     print("Summary HTML file generated: generated_summary.html")
\ No newline at end of file
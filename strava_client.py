@@ -0,0 +1,278 @@
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+import streamlit as st
+
+from instrumentation import span, count
+
+# Strava endpoints
+api_base_url = 'https://www.strava.com/api/v3/'
+token_url = 'https://www.strava.com/oauth/token'
+
+# The access token is kept on disk so that it is reused until it expires
+token_cache_path = '.strava_token.json'
+
+# Strava's default read limits, used until the first response reports the real ones
+DEFAULT_SHORT_TERM_LIMIT = 100  # Requests per 15 minutes
+DEFAULT_DAILY_LIMIT = 1000  # Requests per day
+SHORT_TERM_WINDOW = 15 * 60
+DAILY_WINDOW = 24 * 60 * 60
+# Seconds to wait for a connection and for the server between two bytes of a response, so
+# that a stalled connection does not hold the update lock forever
+REQUEST_TIMEOUT = (10, 60)
+
+
+class StravaAPIError(Exception):
+    pass
+
+
+class RateLimitExceeded(StravaAPIError):
+    pass
+
+
+def _window_start(now, window):
+    # Strava resets its limits at natural boundaries: every quarter hour and at midnight UTC
+    return now - now % window
+
+
+class RateLimiter:
+    """
+    Token-bucket scheduler for Strava's 15-minute and daily request budgets.
+
+    Each bucket holds the requests left in the current window and is refilled when the
+    window resets. Usage reported by Strava in the X-RateLimit headers overrides the local
+    count, so requests made by other clients with the same app are taken into account.
+    """
+
+    def __init__(self, short_term_limit=DEFAULT_SHORT_TERM_LIMIT, daily_limit=DEFAULT_DAILY_LIMIT):
+        self.short_term_limit = short_term_limit
+        self.daily_limit = daily_limit
+        self.short_term_usage = 0
+        self.daily_usage = 0
+        now = time.time()
+        self._short_term_start = _window_start(now, SHORT_TERM_WINDOW)
+        self._daily_start = _window_start(now, DAILY_WINDOW)
+        self._lock = threading.Lock()
+
+    def _roll_windows(self, now):
+        if _window_start(now, SHORT_TERM_WINDOW) != self._short_term_start:
+            self._short_term_start = _window_start(now, SHORT_TERM_WINDOW)
+            self.short_term_usage = 0
+        if _window_start(now, DAILY_WINDOW) != self._daily_start:
+            self._daily_start = _window_start(now, DAILY_WINDOW)
+            self.daily_usage = 0
+
+    def acquire(self):
+        # Block until a request may be sent, raise if the daily budget is used up
+        while True:
+            with self._lock:
+                now = time.time()
+                self._roll_windows(now)
+                if self.daily_usage >= self.daily_limit:
+                    raise RateLimitExceeded("Daily Strava API limit reached, try again tomorrow.")
+                if self.short_term_usage < self.short_term_limit:
+                    self.short_term_usage += 1
+                    self.daily_usage += 1
+                    return
+                wait = self._short_term_start + SHORT_TERM_WINDOW - now + 1
+            print(f"15-minute Strava API limit reached, waiting {wait:.0f} seconds...")
+            with span('api.rate_limit_wait'):
+                time.sleep(wait)
+
+    def update(self, headers):
+        # Read limits take precedence because every request we make is a read
+        limit = headers.get('X-ReadRateLimit-Limit') or headers.get('X-RateLimit-Limit')
+        usage = headers.get('X-ReadRateLimit-Usage') or headers.get('X-RateLimit-Usage')
+        if not limit or not usage:
+            return
+        try:
+            short_term_limit, daily_limit = (int(value) for value in limit.split(','))
+            short_term_usage, daily_usage = (int(value) for value in usage.split(','))
+        except ValueError:
+            return
+        with self._lock:
+            self._roll_windows(time.time())
+            self.short_term_limit = short_term_limit
+            self.daily_limit = daily_limit
+            self.short_term_usage = max(self.short_term_usage, short_term_usage)
+            self.daily_usage = max(self.daily_usage, daily_usage)
+
+    def remaining(self):
+        # Requests left in the current 15-minute window and in the current day
+        with self._lock:
+            self._roll_windows(time.time())
+            return self.short_term_limit - self.short_term_usage, self.daily_limit - self.daily_usage
+
+    def exhaust_short_term(self):
+        # Called on a 429 response: nothing more is sent until the window resets
+        with self._lock:
+            self.short_term_usage = max(self.short_term_usage, self.short_term_limit)
+
+
+# Strava counts requests per app, so all clients of the process share one budget and what
+# one of them learned from the rate limit headers
+shared_rate_limiter = RateLimiter()
+
+
+class StravaClient:
+    """
+    Strava API client sharing one pooled session, access token and rate limiter.
+
+    Parameters:
+    client_id (str), client_secret (str), refresh_token (str): OAuth app credentials
+    max_workers (int): Number of requests that fetch_many() sends concurrently
+    """
+
+    def __init__(self, client_id, client_secret, refresh_token, max_workers=8):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_token = refresh_token
+        self.max_workers = max_workers
+        self.rate_limiter = shared_rate_limiter
+
+        # Keep-alive connections, one per worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._token = None
+        self._token_lock = threading.Lock()
+
+    @classmethod
+    def from_secrets(cls, **kwargs):
+        # Fetching secrets using Streamlit's secrets management
+        return cls(st.secrets["STRAVA_CLIENT_ID"], st.secrets["STRAVA_CLIENT_SECRET"],
+                   st.secrets["STRAVA_REFRESH_TOKEN"], **kwargs)
+
+    def _load_cached_token(self):
+        if not os.path.exists(token_cache_path):
+            return None
+        try:
+            with open(token_cache_path, 'r') as f:
+                token = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return token if token.get('client_id') == str(self.client_id) else None
+
+    def _refresh_access_token(self, refresh_token):
+        count('api.token_refreshes')
+        with span('api.token'):
+            try:
+                response = self.session.post(
+                    token_url,
+                    data={
+                        'client_id': self.client_id,
+                        'client_secret': self.client_secret,
+                        'refresh_token': refresh_token,
+                        'grant_type': 'refresh_token',
+                        'scope': 'activity:read_all'
+                    },
+                    timeout=REQUEST_TIMEOUT
+                )
+            except requests.RequestException as e:
+                raise StravaAPIError(f"Error fetching access token: {e}") from e
+        if response.status_code != 200:
+            raise StravaAPIError(f"Error fetching access token: {response.status_code}, response: {response.text}")
+
+        data = response.json()
+        if not data.get('access_token'):
+            raise StravaAPIError("Access token not found in the response.")
+
+        token = {
+            'client_id': str(self.client_id),
+            'access_token': data['access_token'],
+            'expires_at': data.get('expires_at', time.time() + 3600),
+            # Strava may rotate the refresh token, the latest one is kept for the next refresh
+            'refresh_token': data.get('refresh_token', refresh_token),
+        }
+        # The file holds the refresh token, so only the owner may read it
+        tmp_path = token_cache_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+            json.dump(token, f)
+        os.replace(tmp_path, token_cache_path)
+        return token
+
+    def access_token(self, force_refresh=False):
+        # Reuse the access token until it is about to expire
+        with self._token_lock:
+            if self._token is None:
+                self._token = self._load_cached_token()
+            if force_refresh or self._token is None or self._token['expires_at'] - time.time() < 60:
+                refresh_token = self._token['refresh_token'] if self._token else self.refresh_token
+                self._token = self._refresh_access_token(refresh_token)
+            return self._token['access_token']
+
+    def get(self, path, params=None):
+        """
+        Send a GET request to the API, waiting for the rate limit and retrying on 429.
+
+        Returns the response for any other status code, so callers decide how to handle errors.
+        """
+        refreshed = False
+        # Requests are timed per endpoint, with the activity ids and query left out
+        endpoint = re.sub(r'\d+', '{id}', path.split('?')[0])
+        while True:
+            self.rate_limiter.acquire()
+            headers = {'Authorization': f'Bearer {self.access_token()}'}
+            with span(f"api.{endpoint}"):
+                try:
+                    response = self.session.get(f"{api_base_url}{path}", headers=headers, params=params,
+                                                timeout=REQUEST_TIMEOUT)
+                except requests.RequestException as e:
+                    count('api.errors')
+                    raise StravaAPIError(f"Request to '{endpoint}' failed: {e}") from e
+            self.rate_limiter.update(response.headers)
+            count('api.requests')
+            count('api.bytes_received', len(response.content))
+
+            if response.status_code == 429:
+                count('api.rate_limited')
+                self.rate_limiter.exhaust_short_term()
+                continue
+            if response.status_code == 401 and not refreshed:
+                # The token was revoked or expired early
+                self.access_token(force_refresh=True)
+                refreshed = True
+                continue
+            return response
+
+    def list_activities(self, per_page=200, **params):
+        # Yield pages of 'athlete/activities' until an empty page is returned
+        page = 1
+        while True:
+            response = self.get('athlete/activities', params={'page': page, 'per_page': per_page, **params})
+            if response.status_code != 200:
+                raise StravaAPIError(f"Error fetching activities: {response.status_code}, response: {response.text}")
+
+            activities = response.json()
+            if not activities:
+                return
+            yield activities
+            page += 1
+
+    def fetch_many(self, paths):
+        """
+        Fetch several API paths concurrently.
+
+        Parameters:
+        paths (dict): Maps a caller chosen key to the API path to fetch
+
+        Yields:
+        (key, requests.Response): In completion order
+        """
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = {executor.submit(self.get, path): key for key, path in paths.items()}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # Drop queued requests when the caller stops early or the daily limit is hit
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,354 @@
+import json
+import os
+import time
+import gpxpy
+import polyline
+import pandas as pd
+
+from instrumentation import span, count, writing
+from strava_client import StravaClient, StravaAPIError
+from activity_db import (activity_db_path, csv_file_path, connect, activity_count, upsert_activities,
+                         replace_activities, export_csv, ACTIVITY_COLUMNS)
+from stream_store import StreamStore, STREAM_TYPES
+
+# Paths to files and folders
+gpx_folder = 'API_GPX_FILES'
+sync_state_path = 'sync_state.json'
+
+# How often a full pass over the history is made to pick up edited and deleted activities
+RECONCILE_INTERVAL = 7 * 24 * 60 * 60
+# The 'after' cursor is moved back a little so that activities sharing the last start
+# time are not missed; duplicates are dropped by id
+AFTER_OVERLAP = 60 * 60
+# Streams are fetched in batches, each appended to the stream store as soon as it is
+# complete, so an interrupted fetch only repeats the batch it was in
+STREAM_BATCH = 50
+# Requests the stream fetch leaves to the regular sync and other clients of the app, in the
+# current 15-minute window and in the day
+STREAM_RESERVE_SHORT_TERM = 10
+STREAM_RESERVE_DAILY = 200
+
+
+def write_polyline_gpx(activity_id, polyline_str, folder=gpx_folder):
+    # Decode an encoded polyline and save it as '<activity_id>.gpx'
+    coordinates = polyline.decode(polyline_str)
+
+    # Create GPX file
+    gpx = gpxpy.gpx.GPX()
+    gpx_track = gpxpy.gpx.GPXTrack()
+    gpx.tracks.append(gpx_track)
+    gpx_segment = gpxpy.gpx.GPXTrackSegment()
+    gpx_track.segments.append(gpx_segment)
+
+    for coord in coordinates:
+        lat, lon = coord
+        gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(lat, lon))
+
+    # Save the GPX file
+    gpx_file_path = os.path.join(folder, f'{activity_id}.gpx')
+    with writing(gpx_file_path, 'gpx.write'), open(gpx_file_path, 'w') as f:
+        f.write(gpx.to_xml())
+    count('gpx.files_written')
+    return gpx_file_path
+
+
+def load_sync_state():
+    if not os.path.exists(sync_state_path):
+        return {}
+    try:
+        with open(sync_state_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error loading sync state: {e}")
+        return {}
+
+
+def save_sync_state(state):
+    # Written to a temporary file first, so an interrupted write keeps the previous state
+    tmp_path = sync_state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, sync_state_path)
+
+
+def _activities_to_df(activities):
+    # Convert activities to DataFrame
+    df = pd.DataFrame([{
+        'id': activity['id'],
+        'name': activity['name'],
+        'type': activity['type'],
+        'start_date_local': activity['start_date_local'],
+        'distance': activity['distance'],
+        'moving_time': activity['moving_time'],
+        'elapsed_time': activity['elapsed_time'],
+        'total_elevation_gain': activity['total_elevation_gain']
+    } for activity in activities])
+
+    # Convert 'start_date_local' to datetime and sort by it
+    df['start_date_local'] = pd.to_datetime(df['start_date_local'])
+    return df.sort_values(by='start_date_local', kind='stable')
+
+
+def _high_water_mark(activities, state):
+    # Latest UTC start time and id seen so far, used as the 'after' cursor of the next sync
+    latest = max(activities, key=lambda activity: (activity['start_date'], activity['id']))
+    latest_start = int(pd.Timestamp(latest['start_date']).timestamp())
+    if latest_start >= state.get('last_start_date', 0):
+        state['last_start_date'] = latest_start
+        state['last_id'] = latest['id']
+
+
+def _save_full_history(conn, activities):
+    # Replace the stored activities with the complete list. Stored activities keep their
+    # numbers, only the new ones are numbered, by date. Activities deleted on Strava are
+    # removed together with their locations.
+    df = _activities_to_df(activities)
+    numbers = dict(conn.execute('SELECT id, run_number FROM activities'))
+    df['run_number'] = df['id'].map(numbers)
+    new = df['run_number'].isna()
+    last_run_number = conn.execute('SELECT COALESCE(MAX(run_number), 0) FROM activities').fetchone()[0]
+    df.loc[new, 'run_number'] = range(last_run_number + 1, last_run_number + 1 + int(new.sum()))
+    df['run_number'] = df['run_number'].astype(int)
+    deleted = replace_activities(conn, df[ACTIVITY_COLUMNS])
+    return len(df), deleted
+
+
+def _merge_new_activities(conn, activities):
+    # Insert the activities that are not stored yet, numbering only the new ones
+    existing = {activity_id for activity_id, in conn.execute('SELECT id FROM activities')}
+    new = _activities_to_df(activities)
+    new = new[~new['id'].isin(existing)]
+    if new.empty:
+        return 0
+
+    last_run_number = conn.execute('SELECT COALESCE(MAX(run_number), 0) FROM activities').fetchone()[0]
+    new['run_number'] = range(last_run_number + 1, last_run_number + 1 + len(new))
+    upsert_activities(conn, new[ACTIVITY_COLUMNS])
+    return len(new)
+
+
+def sync_activities(full_resolution=False, reconcile=False, write=print, warn=print, error=print):
+    """
+    Fetch new activities from Strava, store them in the activity database and create missing
+    GPX files.
+
+    Only activities that started after the stored high-water mark are requested. Every
+    RECONCILE_INTERVAL, or when reconcile is True, the full history is fetched instead and
+    the stored activities are replaced by it, which picks up edited and deleted activities.
+
+    Parameters:
+    full_resolution (bool): If True, fetch every new activity on its own to get the full
+        resolution polyline instead of the summary polyline from the activity list
+    reconcile (bool): If True, force a full pass over the history
+    write, warn, error (callable): Used to report progress, warnings and errors
+
+    Returns:
+    bool: True if the sync completed
+    """
+    state = load_sync_state()
+    conn = connect()
+    try:
+        with span('sync', profile=True):
+            return _sync(conn, state, full_resolution, reconcile, write, warn, error)
+    finally:
+        conn.close()
+
+
+def _sync(conn, state, full_resolution, reconcile, write, warn, error):
+    if activity_count(conn) == 0 or 'last_start_date' not in state:
+        reconcile = True
+    elif time.time() - state.get('last_reconcile', 0) > RECONCILE_INTERVAL:
+        reconcile = True
+
+    # Shared client with a pooled session, cached access token and rate limiting
+    client = StravaClient.from_secrets()
+
+    params = {} if reconcile else {'after': state['last_start_date'] - AFTER_OVERLAP}
+    all_activities = []
+    try:
+        with span('sync.list', reconcile=reconcile):
+            for activities in client.list_activities(per_page=200, **params):  # Fetch up to 200 activities per page
+                all_activities.extend(activities)
+        count('sync.activities_listed', len(all_activities))
+    except StravaAPIError as e:
+        # Do not replace the stored activities with a partial history
+        error(str(e))
+        return False
+
+    if reconcile:
+        # Check if activities were fetched
+        if not all_activities:
+            warn("No activities fetched from Strava. Stored activities will not be updated.")
+            return False
+        num_saved, num_deleted = _save_full_history(conn, all_activities)
+        state['last_reconcile'] = int(time.time())
+        write(f"Activities successfully saved to '{activity_db_path}' "
+              f"({num_saved} activities, {num_deleted} deleted, full reconcile).")
+    elif all_activities:
+        num_new = _merge_new_activities(conn, all_activities)
+        write(f"{num_new} new activities merged into '{activity_db_path}'.")
+    else:
+        write("No new activities on Strava.")
+        num_new = 0
+
+    # The database is not committed, the CSV it is seeded from is kept up to date instead
+    if reconcile or num_new or not os.path.exists(csv_file_path):
+        with writing(csv_file_path):
+            export_csv(conn)
+
+    if all_activities:
+        _high_water_mark(all_activities, state)
+
+    # Get existing GPX files in the folder
+    os.makedirs(gpx_folder, exist_ok=True)
+    existing_gpx_files = {f.replace('.gpx', '') for f in os.listdir(gpx_folder)}
+
+    # Create missing GPX files. The activity list already contains the summary polyline,
+    # so the per-activity request is only made when the list has none or when the
+    # full resolution polyline is requested.
+    detail_paths = {}
+    for activity in all_activities:
+        activity_id = str(activity['id'])
+
+        # Skip if the GPX file already exists
+        if activity_id in existing_gpx_files:
+            continue
+
+        # An empty polyline means the activity has no GPS track, a missing one means the
+        # list response did not include it
+        polyline_str = (activity.get('map') or {}).get('summary_polyline')
+        if full_resolution or polyline_str is None:
+            detail_paths[activity_id] = f"activities/{activity_id}"
+            continue
+
+        if not polyline_str:
+            warn(f"No polyline data for activity {activity_id}")
+            continue
+
+        gpx_file_path = write_polyline_gpx(activity_id, polyline_str)
+        write(f'Saved GPX file: {gpx_file_path}')
+
+    # Activities whose detail request did not finish in an earlier sync
+    for activity_id in state.get('pending_tracks', []):
+        if str(activity_id) not in existing_gpx_files:
+            detail_paths.setdefault(str(activity_id), f"activities/{activity_id}")
+
+    # Fetch the remaining activities concurrently. GPX files are written as responses
+    # arrive, and the activities still pending are kept in the sync state, so an
+    # interrupted sync resumes where it stopped even though the cursor already moved on.
+    pending = set(detail_paths)
+    state['pending_tracks'] = sorted(pending)
+    save_sync_state(state)
+    count('sync.detail_requests', len(detail_paths))
+    try:
+        for activity_id, response in client.fetch_many(detail_paths):
+            pending.discard(activity_id)
+            if response.status_code != 200:
+                error(f"Failed to get activity data for {activity_id}: {response.status_code}")
+                continue
+
+            activity_map = response.json().get('map') or {}
+            polyline_str = (activity_map.get('polyline') if full_resolution else None) or activity_map.get('summary_polyline')
+            if not polyline_str:
+                warn(f"No polyline data for activity {activity_id}")
+                continue
+
+            gpx_file_path = write_polyline_gpx(activity_id, polyline_str)
+            write(f'Saved GPX file: {gpx_file_path}')
+    except StravaAPIError as e:
+        error(str(e))
+        return False
+    finally:
+        state['pending_tracks'] = sorted(pending)
+        save_sync_state(state)
+
+    return True
+
+
+def _stream_budget(client, wait):
+    # Requests the stream fetch may still send without cutting into the reserves
+    short_term_left, daily_left = client.rate_limiter.remaining()
+    budget = daily_left - STREAM_RESERVE_DAILY
+    if not wait:
+        budget = min(budget, short_term_left - STREAM_RESERVE_SHORT_TERM)
+    return budget
+
+
+def sync_streams(max_activities=None, wait=False, write=print, warn=print, error=print):
+    """
+    Fetch the full resolution streams (position, time, distance, altitude, heart rate and
+    cadence) of the stored activities that have none yet, newest first, into the stream
+    store.
+
+    The fetch stays within the rate limits: it stops once only STREAM_RESERVE_SHORT_TERM
+    requests of the 15-minute window or STREAM_RESERVE_DAILY requests of the day are left,
+    and the next call continues with the activities still missing. The first request
+    alone reports the current usage, the rest are sent concurrently in batches. Activities
+    without streams, such as manual entries, are kept in the sync state and not requested
+    again.
+
+    Parameters:
+    max_activities (int): Fetch at most this many activities
+    wait (bool): If True, wait for the 15-minute window to reset instead of stopping
+    write, warn, error (callable): Used to report progress, warnings and errors
+
+    Returns:
+    int: Number of activities still without streams, or None if the fetch failed
+    """
+    state = load_sync_state()
+    conn = connect()
+    try:
+        activity_ids = [row[0] for row in conn.execute('SELECT id FROM activities ORDER BY start_date_local DESC')]
+    finally:
+        conn.close()
+    store = StreamStore()
+    no_streams = set(state.get('no_streams', []))
+    missing = [activity_id for activity_id in activity_ids if activity_id not in store and activity_id not in no_streams]
+    if not missing:
+        return 0
+
+    client = StravaClient.from_secrets()
+    queue = missing[:max_activities] if max_activities is not None else missing
+    fetched = 0
+    sent = 0
+    failed = False
+    with span('sync.streams', profile=True):
+        while queue and not failed:
+            budget = _stream_budget(client, wait)
+            if budget <= 0:
+                write("Stopped fetching streams to stay within the Strava API rate limits.")
+                break
+            batch = queue[:min(STREAM_BATCH, budget) if sent else 1]
+            queue = queue[len(batch):]
+            sent += len(batch)
+            paths = {activity_id: f"activities/{activity_id}/streams?keys={','.join(STREAM_TYPES)}&key_by_type=true"
+                     for activity_id in batch}
+            streams = {}
+            try:
+                for activity_id, response in client.fetch_many(paths):
+                    if response.status_code == 404:
+                        no_streams.add(activity_id)
+                        continue
+                    if response.status_code != 200:
+                        # Tried again on the next fetch
+                        error(f"Failed to get the streams of activity {activity_id}: {response.status_code}")
+                        continue
+                    activity_streams = response.json()
+                    if isinstance(activity_streams, dict) and activity_streams:
+                        streams[activity_id] = activity_streams
+                    else:
+                        no_streams.add(activity_id)
+            except StravaAPIError as e:
+                error(str(e))
+                failed = True
+            finally:
+                # Keep what arrived, whatever stopped the batch
+                store.append(streams)
+                fetched += len(streams)
+                state['no_streams'] = sorted(no_streams)
+                save_sync_state(state)
+    count('sync.streams_fetched', fetched)
+
+    left = sum(activity_id not in store and activity_id not in no_streams for activity_id in missing)
+    write(f"Fetched the streams of {fetched} activities, {left} activities still without streams.")
+    return None if failed else left
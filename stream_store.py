@@ -0,0 +1,220 @@
+import os
+import numpy as np
+
+from instrumentation import span, count
+from track_store import COORD_SCALE
+
+# Full resolution activity streams of the athlete, in one file
+stream_store_path = 'streams.bin'
+
+# Streams requested from Strava's 'activities/{id}/streams' endpoint. 'latlng' is stored as
+# the two channels 'lat' and 'lon'.
+STREAM_TYPES = ('latlng', 'time', 'distance', 'altitude', 'heartrate', 'cadence')
+CHANNELS = ('lat', 'lon', 'time', 'distance', 'altitude', 'heartrate', 'cadence')
+# Every channel is stored as integers in these units: 1e-7 degrees, seconds, decimeters,
+# decimeters, beats and steps per minute
+SCALES = {'lat': COORD_SCALE, 'lon': COORD_SCALE, 'time': 1, 'distance': 10, 'altitude': 10,
+          'heartrate': 1, 'cadence': 1}
+# Deltas are stored in the narrowest of these integer types that holds all of them
+DELTA_DTYPES = {1: '<i1', 2: '<i2', 4: '<i4', 8: '<i8'}
+
+# Every append writes one chunk: a 16 byte header (magic, activity count, payload size),
+# the index with one INDEX_DTYPE row per activity and the payload with the deltas of
+# every channel, each starting on an 8 byte boundary
+CHUNK_MAGIC = b'STM1'
+HEADER_DTYPE = np.dtype([('magic', 'S4'), ('n_activities', '<u4'), ('payload_size', '<u8')])
+# First value, delta width in bytes (0 for a missing channel) and payload offset per channel
+INDEX_DTYPE = np.dtype([('id', '<i8'), ('n_points', '<i8'), ('first', '<i8', (len(CHANNELS),)),
+                        ('width', 'u1', (len(CHANNELS),)), ('offset', '<i8', (len(CHANNELS),))])
+
+
+def _padding(size):
+    return (-size) % 8
+
+
+def _fixed_channels(streams):
+    # Integer values per channel of one activity, from Strava's streams keyed by type.
+    # Channels whose length does not match the others or that hold gaps are left out.
+    values = {}
+    for stream_type in STREAM_TYPES:
+        data = (streams.get(stream_type) or {}).get('data')
+        if not data:
+            continue
+        try:
+            data = np.asarray(data, dtype=np.float64)
+        except (TypeError, ValueError):
+            continue
+        if stream_type == 'latlng':
+            if data.ndim != 2 or data.shape[1] != 2:
+                continue
+            values['lat'], values['lon'] = data[:, 0], data[:, 1]
+        else:
+            values[stream_type] = data
+    n_points = max((len(data) for data in values.values()), default=0)
+    return n_points, {name: np.round(data * SCALES[name]).astype(np.int64) for name, data in values.items()
+                      if len(data) == n_points and np.isfinite(data).all()}
+
+
+def _encode(fixed):
+    # First value and the deltas in the narrowest type that holds them
+    deltas = np.diff(fixed)
+    largest = int(np.abs(deltas).max()) if len(deltas) else 0
+    width = next(width for width, bound in ((1, 1 << 7), (2, 1 << 15), (4, 1 << 31), (8, 1 << 63))
+                 if largest < bound)
+    return int(fixed[0]), width, deltas.astype(DELTA_DTYPES[width]).tobytes()
+
+
+class StreamStore:
+    """
+    Full resolution streams of all activities (position, time, distance, altitude, heart
+    rate and cadence) in a single file.
+
+    Like the TrackStore, the file is a sequence of chunks that are only ever appended, and
+    the most recent chunk of an activity wins. Each chunk starts with an index of its
+    activities, so opening the store reads the indexes only; the streams are read from
+    the memory-mapped file when they are asked for.
+
+    Every channel is stored as fixed-point integers, delta encoded in 1, 2, 4 or 8 bytes
+    per point, whichever is the narrowest that holds all deltas of the activity. Steady
+    channels such as time and heart rate take one byte per point, positions two.
+    """
+
+    def __init__(self, path=stream_store_path):
+        self.path = path
+        self._load()
+
+    def _load(self):
+        self._index = {}
+        self._mmap = None
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            self._valid_size = 0
+            return
+
+        self._mmap = np.memmap(self.path, dtype=np.uint8, mode='r')
+        file_size = len(self._mmap)
+        pos = 0
+        while pos + HEADER_DTYPE.itemsize <= file_size:
+            header = np.frombuffer(self._mmap, dtype=HEADER_DTYPE, count=1, offset=pos)[0]
+            if header['magic'] != CHUNK_MAGIC:
+                break
+            n_activities = int(header['n_activities'])
+            index_offset = pos + HEADER_DTYPE.itemsize
+            payload_offset = index_offset + INDEX_DTYPE.itemsize * n_activities
+            payload_offset += _padding(payload_offset)
+            end = payload_offset + int(header['payload_size'])
+            if end > file_size:
+                # Incomplete chunk left behind by an interrupted append
+                break
+
+            rows = np.frombuffer(self._mmap, dtype=INDEX_DTYPE, count=n_activities, offset=index_offset)
+            for row in rows:
+                self._index[int(row['id'])] = (row, payload_offset)
+            pos = end + _padding(end)
+        self._valid_size = min(pos, file_size)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, activity_id):
+        return int(activity_id) in self._index
+
+    def ids(self):
+        return np.fromiter(self._index.keys(), dtype=np.int64, count=len(self._index))
+
+    def num_points(self, activity_id):
+        return int(self._index[int(activity_id)][0]['n_points'])
+
+    def channels(self, activity_id):
+        # Names of the channels stored for an activity
+        row, _ = self._index[int(activity_id)]
+        return [name for name, width in zip(CHANNELS, row['width'].tolist()) if width]
+
+    def raw(self, activity_id, channel):
+        """
+        Fixed-point values of one channel, in the units of SCALES.
+
+        Returns:
+        np.ndarray: int64 values, or None if the activity has no such channel
+        """
+        row, payload_offset = self._index[int(activity_id)]
+        i = CHANNELS.index(channel)
+        width = int(row['width'][i])
+        if not width:
+            return None
+        n_points = int(row['n_points'])
+        values = np.empty(n_points, dtype=np.int64)
+        values[0] = row['first'][i]
+        # The deltas are a zero-copy view into the file, summed up into the values
+        deltas = np.frombuffer(self._mmap, dtype=DELTA_DTYPES[width], count=n_points - 1,
+                               offset=payload_offset + int(row['offset'][i]))
+        np.cumsum(deltas, out=values[1:])
+        values[1:] += values[0]
+        return values
+
+    def channel(self, activity_id, channel):
+        # Values of one channel in degrees, seconds, meters, bpm or rpm, or None if missing
+        values = self.raw(activity_id, channel)
+        return values / SCALES[channel] if values is not None else None
+
+    def streams(self, activity_id, channels=CHANNELS):
+        # Dict of the requested channels that are stored for an activity
+        stored = self.channels(activity_id)
+        return {name: self.channel(activity_id, name) for name in channels if name in stored}
+
+    def append(self, streams):
+        """
+        Append the streams of several activities to the end of the store as a single chunk.
+
+        Parameters:
+        streams (dict): Maps activity id to the response of 'activities/{id}/streams' with
+            key_by_type, a dict of stream type to {'data': [...]}
+
+        Returns:
+        int: Number of bytes written
+        """
+        if not streams:
+            return 0
+
+        rows = np.zeros(len(streams), dtype=INDEX_DTYPE)
+        parts = []
+        payload_size = 0
+        for row, (activity_id, activity_streams) in zip(rows, streams.items()):
+            n_points, fixed = _fixed_channels(activity_streams)
+            row['id'] = int(activity_id)
+            row['n_points'] = n_points
+            for i, name in enumerate(CHANNELS):
+                if name not in fixed:
+                    continue
+                row['first'][i], row['width'][i], data = _encode(fixed[name])
+                row['offset'][i] = payload_size
+                data += b'\0' * _padding(len(data))
+                parts.append(data)
+                payload_size += len(data)
+
+        header = np.array([(CHUNK_MAGIC, len(rows), payload_size)], dtype=HEADER_DTYPE)
+        index = header.tobytes() + rows.tobytes()
+        chunk = b''.join([index, b'\0' * _padding(len(index))] + parts)
+        chunk += b'\0' * _padding(len(chunk))
+
+        # Release the mapping before writing and drop any incomplete tail from an earlier crash
+        valid_size = self._valid_size
+        self._mmap = None
+        self._index = {}
+        mode = 'r+b' if os.path.exists(self.path) else 'wb'
+        with span('write.streams.bin'), open(self.path, mode) as f:
+            f.truncate(valid_size)
+            f.seek(valid_size)
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        count('bytes_written', len(chunk))
+        self._load()
+        return len(chunk)
+
+
+if __name__ == "__main__":
+    store = StreamStore()
+    num_points = sum(store.num_points(activity_id) for activity_id in store.ids().tolist())
+    size = os.path.getsize(store.path) if os.path.exists(store.path) else 0
+    print(f"Stream store holds {len(store)} activities with {num_points} points "
+          f"({size / max(num_points, 1):.1f} bytes per point).")
@@ -1,39 +1,145 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import os
-from stravaAPI import fetch_activities_and_gpx  # Function to fetch activities and generate GPX files
+import json
+from datetime import datetime
 from stravaDash import *  # Import the new function
+from update_worker import start_update, current_update, PROFILE_TARGETS
+from artifact_store import ArtifactStore
+from instrumentation import run_report_path, PROFILERS
+from spatial_index import SpatialIndex, spatial_index_path
+from track_store import TrackStore, COORD_SCALE
 
 # Set paths for data
 gpx_folder = 'API_GPX_FILES'
-csv_file_path = 'strava_activities.csv'
 
-# Ensure the GPX folder exists
-if not os.path.exists(gpx_folder):
-    os.makedirs(gpx_folder)
+# Set the page configuration, it has to be the first Streamlit command
+st.set_page_config(layout="wide", page_title="Strava Activity Analysis")
+
+# Generated files, shared by all sessions and only read again when they changed
+@st.cache_resource
+def get_artifact_store():
+    return ArtifactStore()
+
+artifacts = get_artifact_store()
 
-# Helper function to load data
+# Helper function to load the activities. The mtime and size of the database are part of the
+# cache key, so updated activities are read again while unchanged ones come from the cache.
+# Opening the database imports the CSV the first time.
 @st.cache_data
-def load_data(file_path):
-    if os.path.exists(file_path):
-        return pd.read_csv(file_path)
-    else:
+def load_data(db_path, version):
+    df = ActivityCatalog(db_path).df
+    return df if len(df) else None
+
+# The spatial index and the tracks it refines queries with, opened again whenever a build
+# updated the index. The index is written after the tracks, so its version covers both.
+@st.cache_resource(max_entries=1)
+def load_spatial_index(version):
+    return SpatialIndex.load(), TrackStore()
+
+# Run numbers of the activities selected by the area filter in the sidebar, or None to show
+# all of them
+def area_filter(df):
+    st.sidebar.header("Area Filter")
+    mode = st.sidebar.radio("Show runs", ["All", "Near a point", "Inside a box", "Along a run"])
+    if mode == "All":
         return None
+    index, store = load_spatial_index(artifacts.version(spatial_index_path))
+
+    if mode == "Near a point":
+        lat = st.sidebar.number_input("Latitude", value=55.6761, format="%.5f")
+        lon = st.sidebar.number_input("Longitude", value=12.5683, format="%.5f")
+        radius = st.sidebar.slider("Radius (km)", min_value=0.1, max_value=20.0, value=1.0, step=0.1)
+        ids = index.query_radius(lat, lon, radius * 1000, store=store)
+    elif mode == "Inside a box":
+        south, north = st.sidebar.slider("Latitude range", min_value=-85.0, max_value=85.0, value=(55.6, 55.75), step=0.01)
+        west, east = st.sidebar.slider("Longitude range", min_value=-180.0, max_value=180.0, value=(12.45, 12.65), step=0.01)
+        ids = index.query_bbox(south, west, north, east, store=store)
+    else:
+        # Runs that follow most of the track of another run
+        run_number = st.sidebar.number_input("Run number", min_value=1, value=int(df['run_number'].max()), step=1)
+        activity = df[df['run_number'] == run_number]
+        if len(activity) and int(activity.index[0]) in store:
+            ids = index.query_polyline(*(np.asarray(x) / COORD_SCALE for x in store.raw(int(activity.index[0]))))
+        else:
+            ids = []
+    run_numbers = df['run_number'].reindex(ids).dropna().astype(int).tolist()
+    st.sidebar.caption(f"{len(run_numbers)} activities found.")
+    return run_numbers
 
-# Function to update data from Strava and regenerate files
+# Pages built before the area filter existed show everything until they are rebuilt
+def filtered_page(content, run_numbers):
+    if run_numbers is None:
+        return content
+    if AREA_FILTER_PLACEHOLDER not in content:
+        st.info("Run a forced update to filter this page by area.")
+    return apply_area_filter(content, run_numbers)
+
+# Start an update in the background; the page stays usable while it runs
 def update_data(incremental=True):
-    st.write("Fetching data from Strava and creating missing GPX files...")
-    fetch_activities_and_gpx()
-    st.success('Data fetched and GPX files updated. Regenerating statistics...')
-    generate_map_and_statistics(incremental=incremental)  # Pass the incremental flag
-    generate_runs_list_html()  # This function can be optimized similarly
-    generate_summary_html()
-    generate_city_statistics_html(incremental=incremental)  # Added the new function
-    st.success('All files have been updated!')
-    st.session_state['data_updated'] = True
-
-# Set the page configuration
-st.set_page_config(layout="wide", page_title="Strava Activity Analysis")
+    # Ensure the GPX folder exists
+    os.makedirs(gpx_folder, exist_ok=True)
+    # Every finished stage is published to all sessions right away
+    job = start_update(incremental=incremental, streams=st.session_state.get('fetch_streams', False),
+                       on_publish=artifacts.invalidate, profile=st.session_state.get('profile_targets') or (),
+                       profiler=st.session_state.get('profiler'))
+    if job is None:
+        st.warning("An update is already running, its progress is shown below.")
+    else:
+        st.session_state['data_updated'] = False
+
+# Where the last update spent its time, from the report the update worker or the command line
+# wrote, and which steps to profile in the next one
+def run_report_panel():
+    st.sidebar.header("Last Update")
+    content = artifacts.read(run_report_path)
+    report = json.loads(content) if content else None
+    if report is None:
+        st.sidebar.caption("No update has written a report yet.")
+    else:
+        finished = datetime.fromtimestamp(report['finished']).strftime('%d.%m.%Y %H:%M') if report['finished'] else 'unfinished'
+        with st.sidebar.expander(f"{report['name'].capitalize()} {report['status']} in {report['seconds']:.1f} s ({finished})"):
+            st.write("Time per step, summed over all calls")
+            spans = pd.DataFrame.from_dict(report['spans'], orient='index', columns=['count', 'seconds', 'max'])
+            st.dataframe(spans.rename(columns={'seconds': 'total (s)', 'max': 'slowest (s)'}))
+            st.write("Counters")
+            st.dataframe(pd.Series(report['counters'], name='value', dtype='int64'))
+            for profile in report['profiles']:
+                st.write(f"Profile of {profile['name']} ({profile['profiler']}, {profile['seconds']:.1f} s)")
+                st.caption(profile['path'])
+                st.dataframe(pd.DataFrame(profile['top']), hide_index=True)
+            st.download_button("Download report", content, file_name=run_report_path, mime='application/json')
+    st.sidebar.multiselect("Profile in the next update", PROFILE_TARGETS, key='profile_targets')
+    st.sidebar.radio("Profiler", PROFILERS, key='profiler', horizontal=True)
+
+# Progress of the running update, refreshed every few seconds without rerunning the page.
+# When a stage published new files, the whole page reruns to show them.
+@st.fragment(run_every=2)
+def update_progress():
+    job = current_update()
+    if job is None:
+        return
+    progress = job.snapshot()
+    finished_stages = sum(status in ('built', 'up to date', 'failed') for status in progress['stages'].values())
+
+    if progress['status'] == 'running':
+        st.progress(finished_stages / len(progress['stages']),
+                    text=f"Updating... {finished_stages} of {len(progress['stages'])} steps done")
+    elif progress['status'] == 'failed':
+        st.error('The update finished with errors.')
+    else:
+        st.success('All files have been updated!')
+    with st.expander("Update details", expanded=False):
+        for name, status in progress['stages'].items():
+            st.text(f"{name}: {status}")
+        st.text("\n".join(progress['messages'][-20:]))
+
+    if st.session_state.get('published') != (progress['started'], progress['published'], progress['status']):
+        st.session_state['published'] = (progress['started'], progress['published'], progress['status'])
+        if progress['published'] or progress['status'] != 'running':
+            st.session_state['data_updated'] = progress['status'] == 'finished'
+            st.rerun()
 
 # Initialize session state for managing update process
 if 'data_updated' not in st.session_state:
@@ -43,41 +149,51 @@ if 'data_updated' not in st.session_state:
 st.title("My Strava Activities")
 
 # Load existing data on page load
-df = load_data(csv_file_path)
+df = load_data(activity_db_path, artifacts.version(activity_db_path))
 
-# Show the most up-to-date statistics if data is present
+# Show the most up-to-date statistics if data is present. Only the selected section is
+# rendered, so the large map and runs list are not sent to the browser unless viewed.
 if df is not None:
-    if os.path.exists('generated_summary.html'):
-        with open('generated_summary.html', 'r', encoding='utf-8') as file:
-            summary_content = file.read()
+    run_numbers = area_filter(df)
+    section = st.radio("Section", ["General Stats", "Location Stats", "Spatial Distribution Map", "List of All Runs"],
+                       horizontal=True, label_visibility="collapsed")
+
+    if section == "General Stats":
+        summary_content = artifacts.read('generated_summary.html')
+        if summary_content is not None:
             st.write("### General Stats")
-            st.components.v1.html(summary_content, height=300, scrolling=True)  # Adjust height as needed
-        # Display city and country statistics
-    if os.path.exists('generated_city_statistics_from_csv.html'):
-        with open('generated_city_statistics_from_csv.html', 'r', encoding='utf-8') as file:
-            stats_content = file.read()
+            st.components.v1.html(summary_content, height=800, scrolling=True)  # Adjust height as needed
+
+    # Display city and country statistics
+    elif section == "Location Stats":
+        stats_content = artifacts.read('generated_city_statistics_from_csv.html')
+        if stats_content is not None:
             st.write("### Location Stats")
             st.components.v1.html(stats_content, height=800, scrolling=True)
 
-    # Display the map
-    if os.path.exists('activity_map.html'):
-        with open('activity_map.html', 'r', encoding='utf-8') as file:
-            map_content = file.read()
-            st.write("### Spatial Distribution Map")
-            st.text("This distribution map shows on which routes I have already been running around the world (zoomed into Copenhagen).")
-            st.components.v1.html(map_content, height=600, scrolling=True)
+    # Display the map. The heatmap loads the same amount of data however many activities
+    # there are, the map with the individual tracks is only loaded on request.
+    elif section == "Spatial Distribution Map":
+        heatmap_content = artifacts.read('heatmap_map.html')
+        st.write("### Spatial Distribution Map")
+        st.text("This distribution map shows on which routes I have already been running around the world (zoomed into Copenhagen).")
+        # The heatmap always shows all runs, a filtered map shows the individual ones
+        show_tracks = heatmap_content is None or run_numbers is not None or st.checkbox("Show individual runs")
+        map_content = artifacts.read('activity_map.html') if show_tracks else heatmap_content
+        if map_content is not None:
+            st.components.v1.html(filtered_page(map_content, run_numbers), height=600, scrolling=True)
 
     # Display the runs list
-    if os.path.exists('runs_list.html'):
-        with open('runs_list.html', 'r', encoding='utf-8') as file:
-            runs_list_content = file.read()
+    elif section == "List of All Runs":
+        runs_list_content = artifacts.read('runs_list.html')
+        if runs_list_content is not None:
             st.write("### List of All Runs")
-            st.components.v1.html(runs_list_content, height=800, scrolling=True)
+            st.components.v1.html(filtered_page(runs_list_content, run_numbers), height=800, scrolling=True)
 
 # Button to update the data
 if st.button('Update Data'):
     update_data()
-    st.experimental_set_query_params(updated=True)  # Reload the app to show updated files
+update_progress()
 
 # Handle the case where there is no existing data
 if df is None:
@@ -85,6 +201,8 @@ if df is None:
 
 # Sidebar for manual update
 st.sidebar.header("Data Management")
+st.sidebar.checkbox("Fetch full-resolution streams", key='fetch_streams',
+                    help="Time, altitude, heart rate and cadence of every activity, as many as the Strava rate limits allow per update")
 if st.sidebar.button('Force Update Data from Strava'):
-    update_data()
-    st.experimental_set_query_params(updated=True)  # Reload the app to show updated files
\ No newline at end of file
+    update_data(incremental=False)
+run_report_panel()
\ No newline at end of file
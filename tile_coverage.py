@@ -0,0 +1,400 @@
+import os
+import numpy as np
+
+from instrumentation import count_written
+from spatial_index import track_cells
+from track_store import COORD_SCALE
+from activity_db import connect
+
+# Visited tiles, the tiles every activity added and the largest explored squares
+coverage_state_path = 'coverage_state.npz'
+
+# Web Mercator zoom levels of the explored tiles, about 2.4 km and 300 m at the equator
+COVERAGE_ZOOMS = (14, 17)
+# Tiles drawn on the activity map
+OVERLAY_ZOOM = 14
+# Tile ids are split into chunks by their high bits. A chunk keeps the low bits of its
+# tiles as a sorted uint16 array up to ARRAY_LIMIT tiles and as a bitset of 2**CHUNK_BITS
+# bits above, whichever is smaller (8 KB either way at the limit).
+CHUNK_BITS = 16
+ARRAY_LIMIT = 4096
+# Bump whenever the stored tiles change meaning, to rebuild them from all activities
+COVERAGE_VERSION = 1
+
+_LOW_MASK = (1 << CHUNK_BITS) - 1
+_BITSET_WORDS = (1 << CHUNK_BITS) // 64
+
+
+def _spread_bits(v):
+    # Move bit i of a 32-bit value to bit 2i
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def _compact_bits(v):
+    # Inverse of _spread_bits, keeps the even bits
+    v = v & np.uint64(0x5555555555555555)
+    for shift, mask in ((1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F), (4, 0x00FF00FF00FF00FF),
+                        (8, 0x0000FFFF0000FFFF), (16, 0x00000000FFFFFFFF)):
+        v = (v | (v >> np.uint64(shift))) & np.uint64(mask)
+    return v.astype(np.int64)
+
+
+def tile_ids(x, y):
+    # Morton (Z-order) code of tile coordinates, so a chunk covers a square block of
+    # 256 x 256 tiles instead of a thin column
+    return (_spread_bits(np.asarray(x)) | (_spread_bits(np.asarray(y)) << np.uint64(1))).astype(np.int64)
+
+
+def tile_coords(ids):
+    ids = np.asarray(ids, dtype=np.int64).astype(np.uint64)
+    return _compact_bits(ids), _compact_bits(ids >> np.uint64(1))
+
+
+def track_tiles(lat, lon, zoom):
+    # Ids of the tiles a track passes through, sorted
+    cells = track_cells(lat, lon, zoom)
+    return np.sort(tile_ids(cells >> zoom, cells & ((1 << zoom) - 1)))
+
+
+def _bitset(low):
+    words = np.zeros(_BITSET_WORDS, dtype=np.uint64)
+    np.bitwise_or.at(words, (low >> 6).astype(np.intp), np.uint64(1) << (low & 63).astype(np.uint64))
+    return words
+
+
+def _bitset_values(words):
+    return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder='little')).astype(np.uint16)
+
+
+class TileBitmap:
+    """
+    Set of tile ids as a roaring-style compressed bitmap.
+
+    Sparse chunks take 2 bytes per tile and dense ones at most 8 KB, so millions of
+    visited tiles fit in a few MB. Adding the tiles of one activity only touches the few
+    chunks they fall into.
+    """
+
+    def __init__(self, chunks=None):
+        # Chunk key (id >> CHUNK_BITS) to a sorted uint16 array or a uint64 bitset
+        self.chunks = chunks if chunks is not None else {}
+        self.count = sum(self._chunk_size(container) for container in self.chunks.values())
+
+    @staticmethod
+    def _chunk_size(container):
+        if container.dtype == np.uint16:
+            return len(container)
+        return int(np.unpackbits(container.view(np.uint8)).sum())
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return sum(container.nbytes for container in self.chunks.values())
+
+    def add(self, ids):
+        """
+        Add tiles to the set.
+
+        Parameters:
+        ids (array-like): Tile ids
+
+        Returns:
+        np.ndarray: Sorted ids of the tiles that were not in the set before
+        """
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        if not len(ids):
+            return ids
+        high = ids >> CHUNK_BITS
+        low = (ids & _LOW_MASK).astype(np.uint16)
+        bounds = np.flatnonzero(np.diff(high)) + 1
+        added = []
+        for key, chunk_low in zip(high[np.append(0, bounds)].tolist(), np.split(low, bounds)):
+            container = self.chunks.get(key)
+            if container is None:
+                new, container = chunk_low, chunk_low.copy()
+            elif container.dtype == np.uint16:
+                new = np.setdiff1d(chunk_low, container, assume_unique=True)
+                container = np.union1d(container, new)
+            else:
+                words = (chunk_low >> 6).astype(np.intp)
+                bits = np.uint64(1) << (chunk_low & 63).astype(np.uint64)
+                new = chunk_low[(container[words] & bits) == 0]
+                np.bitwise_or.at(container, words, bits)
+            if container.dtype == np.uint16 and len(container) > ARRAY_LIMIT:
+                container = _bitset(container)
+            self.chunks[key] = container
+            added.append((key << CHUNK_BITS) | new.astype(np.int64))
+        added = np.concatenate(added)
+        self.count += len(added)
+        return added
+
+    def ids(self):
+        # All tile ids, sorted
+        parts = [(key << CHUNK_BITS) | (container if container.dtype == np.uint16
+                                         else _bitset_values(container)).astype(np.int64)
+                 for key, container in sorted(self.chunks.items())]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def to_arrays(self, prefix):
+        keys = sorted(self.chunks)
+        arrays = [self.chunks[key] for key in keys if self.chunks[key].dtype == np.uint16]
+        bitsets = [self.chunks[key] for key in keys if self.chunks[key].dtype != np.uint16]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(values) for values in arrays], out=offsets[1:])
+        return {
+            f'{prefix}keys': np.array(keys, dtype=np.int64),
+            f'{prefix}is_bitset': np.array([self.chunks[key].dtype != np.uint16 for key in keys], dtype=bool),
+            f'{prefix}array_values': np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.uint16),
+            f'{prefix}array_offsets': offsets,
+            f'{prefix}bitset_words': np.concatenate(bitsets) if bitsets else np.zeros(0, dtype=np.uint64),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        keys = arrays[f'{prefix}keys'].tolist()
+        is_bitset = arrays[f'{prefix}is_bitset']
+        offsets = arrays[f'{prefix}array_offsets']
+        values = arrays[f'{prefix}array_values']
+        words = arrays[f'{prefix}bitset_words'].reshape(-1, _BITSET_WORDS)
+        chunks = {}
+        array_i = bitset_i = 0
+        for key, bitset in zip(keys, is_bitset.tolist()):
+            if bitset:
+                chunks[key] = words[bitset_i].copy()
+                bitset_i += 1
+            else:
+                chunks[key] = values[offsets[array_i]:offsets[array_i + 1]].copy()
+                array_i += 1
+        return cls(chunks)
+
+
+def _clusters(x, y):
+    # Split tiles into groups separated by empty rows or columns; a fully explored square
+    # never crosses such a gap
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        for a in (x, y):
+            order = np.argsort(a, kind='stable')
+            gaps = np.flatnonzero(np.diff(a[order]) > 1) + 1
+            if len(gaps):
+                stack.extend((x[part], y[part]) for part in np.split(order, gaps))
+                break
+        else:
+            yield x, y
+
+
+def _grow(corners, step):
+    # Top left tiles of squares step tiles larger, from those of squares of size s >= step:
+    # four overlapping squares of size s cover one of size s + step
+    return corners[:-step, :-step] & corners[step:, :-step] & corners[:-step, step:] & corners[step:, step:]
+
+
+def max_square(ids):
+    """
+    Largest square of tiles that are all visited.
+
+    The top left tiles of 2 x 2 squares are found on the sorted tile keys first, which
+    drops scattered tiles and lines. Every group of them is drawn on a boolean grid, where
+    the squares are grown by doubling their size and then narrowed down by halving steps,
+    so a square of size k takes about 2 log2(k) passes over the grid.
+
+    Parameters:
+    ids (np.ndarray): Tile ids
+
+    Returns:
+    (int, int, int): Size of the square in tiles and the x and y of its top left tile
+    """
+    x, y = tile_coords(ids)
+    if not len(x):
+        return (0, 0, 0)
+    best = (1, int(x[0]), int(y[0]))
+    # In key order the neighbours looked up below are sorted as well, which keeps the
+    # binary searches cache friendly
+    keys = np.sort((x << 32) | y)
+    x, y = keys >> 32, keys & 0xFFFFFFFF
+
+    def visited(tx, ty):
+        wanted = (tx << 32) | ty
+        return keys[np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)] == wanted
+
+    corner = visited(x + 1, y) & visited(x, y + 1) & visited(x + 1, y + 1)
+    for x, y in _clusters(x[corner], y[corner]):
+        x0, y0 = int(x.min()), int(y.min())
+        if min(int(x.max()) - x0, int(y.max()) - y0) + 2 <= best[0]:
+            continue
+        corners = np.zeros((int(y.max()) - y0 + 1, int(x.max()) - x0 + 1), dtype=bool)
+        corners[y - y0, x - x0] = True
+        size = 2
+        while True:
+            grown = _grow(corners, size)
+            if not grown.any():
+                break
+            corners, size = grown, 2 * size
+        step = size // 2
+        while step:
+            grown = _grow(corners, step)
+            if grown.any():
+                corners, size = grown, size + step
+            step //= 2
+        if size > best[0]:
+            top, left = np.argwhere(corners)[0]
+            best = (size, x0 + int(left), y0 + int(top))
+    return best
+
+
+def tile_bounds(x, y, zoom):
+    # (south, west, north, east) of tiles in degrees
+    n = 2 ** zoom
+    west, east = np.asarray(x) / n * 360 - 180, (np.asarray(x) + 1) / n * 360 - 180
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y) / n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (np.asarray(y) + 1) / n))))
+    return south, west, north, east
+
+
+class Coverage:
+    """
+    The tiles visited at every zoom level of COVERAGE_ZOOMS, the number of tiles each
+    activity visited first and the largest fully explored square.
+
+    Activities are added in the order of their start date, so the tiles an activity added
+    stay the same when later activities arrive.
+    """
+
+    def __init__(self, arrays=None):
+        if arrays is None:
+            arrays = {'ids': np.zeros(0, dtype=np.int64), 'fingerprint': np.zeros(0, dtype=np.uint32)}
+            for zoom in COVERAGE_ZOOMS:
+                arrays.update(TileBitmap().to_arrays(f'z{zoom}_'))
+                arrays[f'z{zoom}_new'] = np.zeros(0, dtype=np.int64)
+                arrays[f'z{zoom}_square'] = np.zeros(3, dtype=np.int64)
+        self.ids = arrays['ids']
+        self.fingerprint = arrays['fingerprint']
+        self.bitmaps = {zoom: TileBitmap.from_arrays(arrays, f'z{zoom}_') for zoom in COVERAGE_ZOOMS}
+        self.new_tiles = {zoom: arrays[f'z{zoom}_new'] for zoom in COVERAGE_ZOOMS}
+        self.squares = {zoom: tuple(arrays[f'z{zoom}_square'].tolist()) for zoom in COVERAGE_ZOOMS}
+        self._index = {activity_id: i for i, activity_id in enumerate(self.ids.tolist())}
+
+    @classmethod
+    def load(cls, path=coverage_state_path):
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError) as e:
+            print(f"Error loading coverage: {e}")
+            return cls()
+        if int(arrays.pop('version', -1)) != COVERAGE_VERSION:
+            return cls()
+        return cls(arrays)
+
+    def save(self, path=coverage_state_path):
+        arrays = {'ids': self.ids, 'fingerprint': self.fingerprint}
+        for zoom in COVERAGE_ZOOMS:
+            arrays.update(self.bitmaps[zoom].to_arrays(f'z{zoom}_'))
+            arrays[f'z{zoom}_new'] = self.new_tiles[zoom]
+            arrays[f'z{zoom}_square'] = np.array(self.squares[zoom], dtype=np.int64)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, version=COVERAGE_VERSION, **arrays)
+        os.replace(tmp_path, path)
+        count_written(path)
+
+    def added_by(self, activity_id):
+        # Number of tiles per zoom level the activity visited first, or None if not covered
+        i = self._index.get(int(activity_id))
+        return None if i is None else tuple(int(self.new_tiles[zoom][i]) for zoom in COVERAGE_ZOOMS)
+
+    def overlay_geojson(self, zoom=OVERLAY_ZOOM):
+        """
+        The visited tiles as GeoJSON rectangles, with neighbouring tiles of a row merged,
+        and the largest explored square.
+
+        Returns:
+        dict: A FeatureCollection; the square has the property 'square' set to True
+        """
+        x, y = tile_coords(self.bitmaps[zoom].ids())
+        order = np.lexsort((x, y))
+        x, y = x[order], y[order]
+        # Rows of consecutive tiles
+        starts = np.flatnonzero((np.diff(x, prepend=-2) != 1) | (np.diff(y, prepend=-1) != 0))
+        ends = np.append(starts[1:], len(x)) - 1
+        south, west, north, _ = tile_bounds(x[starts], y[starts], zoom)
+        east = tile_bounds(x[ends], y[ends], zoom)[3]
+        rectangles = [(bounds, False) for bounds in zip(south, west, north, east)]
+        size, square_x, square_y = self.squares[zoom]
+        if size:
+            south = tile_bounds(square_x, square_y + size - 1, zoom)[0]
+            _, west, north, _ = tile_bounds(square_x, square_y, zoom)
+            east = tile_bounds(square_x + size - 1, square_y, zoom)[3]
+            rectangles.append(((south, west, north, east), True))
+        return {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'square': square}, 'geometry': _rectangle(*bounds)}
+            for bounds, square in rectangles]}
+
+
+def _rectangle(south, west, north, east):
+    south, west, north, east = (round(float(v), 5) for v in (south, west, north, east))
+    return {'type': 'Polygon',
+            'coordinates': [[[west, south], [east, south], [east, north], [west, north], [west, south]]]}
+
+
+def update_coverage(store, features, path=coverage_state_path):
+    """
+    Bring the explored tiles up to date with the track store.
+
+    New activities that started after all covered ones are added to the stored bitmaps,
+    which only touches the chunks their tiles fall into. When an activity was removed or
+    changed, or one from before the latest covered activity was added, all activities are
+    added again in date order.
+
+    Parameters:
+    store (TrackStore): Tracks of all activities
+    features (ingest.TrackFeatures): Track features, for the fingerprints
+
+    Returns:
+    Coverage: The updated coverage
+    """
+    conn = connect()
+    try:
+        dates = dict(conn.execute('SELECT id, start_date_local FROM activities'))
+    finally:
+        conn.close()
+    # Activities without a start date, such as GPX files not synced yet, go last
+    ids = sorted((activity_id for activity_id in store.ids().tolist() if store.num_points(activity_id)),
+                 key=lambda activity_id: (dates.get(activity_id) or '9999', activity_id))
+    ids = np.array(ids, dtype=np.int64)
+    fingerprints = features.arrays['fingerprint'][[features.row(activity_id) for activity_id in ids.tolist()]] \
+        if len(ids) else np.zeros(0, dtype=np.uint32)
+
+    coverage = Coverage.load(path)
+    done = len(coverage.ids)
+    if not (np.array_equal(ids[:done], coverage.ids) and np.array_equal(fingerprints[:done], coverage.fingerprint)):
+        coverage, done = Coverage(), 0
+    if done == len(ids) and os.path.exists(path):
+        return coverage
+
+    new_tiles = {zoom: [coverage.new_tiles[zoom]] for zoom in COVERAGE_ZOOMS}
+    for activity_id in ids[done:].tolist():
+        lat, lon = (np.asarray(x) / COORD_SCALE for x in store.raw(activity_id))
+        for zoom in COVERAGE_ZOOMS:
+            added = coverage.bitmaps[zoom].add(track_tiles(lat, lon, zoom))
+            new_tiles[zoom].append([len(added)])
+    coverage.ids, coverage.fingerprint = ids, fingerprints
+    coverage._index = {activity_id: i for i, activity_id in enumerate(ids.tolist())}
+    for zoom in COVERAGE_ZOOMS:
+        coverage.new_tiles[zoom] = np.concatenate(new_tiles[zoom]).astype(np.int64)
+        # The square can only grow where new tiles were visited
+        if coverage.new_tiles[zoom][done:].any():
+            coverage.squares[zoom] = max_square(coverage.bitmaps[zoom].ids())
+    coverage.save(path)
+    print(f"Coverage updated with {len(ids) - done} activities: " + ', '.join(
+        f"{len(coverage.bitmaps[zoom])} tiles at zoom {zoom} (max square {coverage.squares[zoom][0]})"
+        for zoom in COVERAGE_ZOOMS) + '.')
+    return coverage
@@ -0,0 +1,99 @@
+import numpy as np
+
+EARTH_RADIUS = 6371008.8  # Meters
+
+# A track that ends within this distance of where it started is a loop, unless it is too
+# short to have gone anywhere
+LOOP_DISTANCE = 200  # Meters
+
+# Per-activity metrics returned by track_metrics
+METRIC_NAMES = ('length', 'bbox', 'centroid', 'start', 'end', 'midpoint', 'is_loop')
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Great-circle distance in meters between points given in degrees, elementwise
+    lat1, lon1, lat2, lon2 = (np.radians(x) for x in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def concatenate_tracks(tracks):
+    """
+    Concatenate tracks into flat coordinate columns.
+
+    Parameters:
+    tracks (list): (lat, lon) array pairs per activity
+
+    Returns:
+    (np.ndarray, np.ndarray, np.ndarray): lat and lon of all points, and the offset of
+        the first point of every activity with the total point count appended
+    """
+    offsets = np.zeros(len(tracks) + 1, dtype=np.int64)
+    np.cumsum([len(lat) for lat, _ in tracks], out=offsets[1:])
+    if offsets[-1] == 0:
+        return np.zeros(0), np.zeros(0), offsets
+    lat = np.concatenate([np.asarray(lat, dtype=np.float64) for lat, _ in tracks])
+    lon = np.concatenate([np.asarray(lon, dtype=np.float64) for _, lon in tracks])
+    return lat, lon, offsets
+
+
+def track_metrics(lat, lon, offsets):
+    """
+    Compute the geometry metrics of many tracks in one vectorized pass.
+
+    The points of all tracks are concatenated; every metric is a reduction over the
+    ranges given by the offsets (np.ufunc.reduceat), so the cost is a handful of array
+    operations over all points instead of Python work per track.
+
+    Parameters:
+    lat, lon (np.ndarray): Coordinates of all points in degrees
+    offsets (np.ndarray): Offset of the first point of every track, followed by the
+        total number of points
+
+    Returns:
+    dict: Per track: length in meters, bbox (lat_min, lon_min, lat_max, lon_max),
+        centroid, start, end and midpoint as (lat, lon), and is_loop. Tracks without
+        points get NaN coordinates, length 0 and is_loop False.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n = len(offsets) - 1
+    counts = np.diff(offsets)
+    metrics = {
+        'length': np.zeros(n),
+        'bbox': np.full((n, 4), np.nan),
+        'centroid': np.full((n, 2), np.nan),
+        'start': np.full((n, 2), np.nan),
+        'end': np.full((n, 2), np.nan),
+        'midpoint': np.full((n, 2), np.nan),
+        'is_loop': np.zeros(n, dtype=bool),
+    }
+    has_points = counts > 0
+    if not has_points.any():
+        return metrics
+
+    # reduceat needs strictly increasing start indices, so empty tracks are left out
+    starts = offsets[:-1][has_points]
+    ends = offsets[1:][has_points] - 1
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    # Length of every segment, with the ones joining the last point of a track to the
+    # first point of the next one zeroed out
+    segments = np.zeros(len(lat))
+    segments[:-1] = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    segments[ends] = 0
+    metrics['length'][has_points] = np.add.reduceat(segments, starts)
+
+    metrics['bbox'][has_points] = np.column_stack((np.minimum.reduceat(lat, starts), np.minimum.reduceat(lon, starts),
+                                                   np.maximum.reduceat(lat, starts), np.maximum.reduceat(lon, starts)))
+    metrics['centroid'][has_points] = np.column_stack((np.add.reduceat(lat, starts), np.add.reduceat(lon, starts))) \
+        / counts[has_points, None]
+    metrics['start'][has_points] = np.column_stack((lat[starts], lon[starts]))
+    metrics['end'][has_points] = np.column_stack((lat[ends], lon[ends]))
+    middle = starts + counts[has_points] // 2
+    metrics['midpoint'][has_points] = np.column_stack((lat[middle], lon[middle]))
+
+    closing = haversine(lat[starts], lon[starts], lat[ends], lon[ends])
+    metrics['is_loop'][has_points] = (closing <= LOOP_DISTANCE) & (metrics['length'][has_points] > 2 * LOOP_DISTANCE)
+    return metrics
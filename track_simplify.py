@@ -0,0 +1,123 @@
+import numpy as np
+
+from track_metrics import EARTH_RADIUS
+
+# Web Mercator ground resolution at zoom 0 on the equator, in meters per pixel
+METERS_PER_PIXEL_ZOOM_0 = 156543.03392
+
+# Zoom levels covered by the simplification. A vertex is drawn from its minimum zoom on,
+# vertices not needed even at MAX_ZOOM are dropped.
+MIN_ZOOM = 0
+MAX_ZOOM = 18
+# Allowed deviation of the simplified line from the track, in screen pixels
+TOLERANCE_PIXELS = 1.0
+
+
+def douglas_peucker_significance(lat, lon):
+    """
+    Rank the vertices of a track by how much they matter to its shape.
+
+    Runs Douglas-Peucker without a tolerance. All open ranges are split in the same
+    vectorized pass, so the number of passes is the depth of the recursion, not the number
+    of vertices. The significance of a vertex is its distance to the chord of the range it
+    split, capped by the significance of the vertex that split the enclosing range.
+    Simplifying with tolerance t keeps exactly the vertices with significance > t.
+
+    Parameters:
+    lat, lon (np.ndarray): Track coordinates in degrees
+
+    Returns:
+    np.ndarray: Significance in meters per vertex, infinite for the two end points
+    """
+    num_points = len(lat)
+    significance = np.zeros(num_points)
+    if num_points == 0:
+        return significance
+    significance[[0, -1]] = np.inf
+    if num_points < 3:
+        return significance
+
+    # Local equirectangular projection in meters, accurate enough at track scale
+    lat0 = np.radians(np.mean(lat))
+    x = np.radians(lon) * np.cos(lat0) * EARTH_RADIUS
+    y = np.radians(lat) * EARTH_RADIUS
+
+    # Open ranges as (start, end, significance of the vertex that created them)
+    starts = np.array([0])
+    ends = np.array([num_points - 1])
+    caps = np.array([np.inf])
+    while len(starts):
+        lengths = ends - starts - 1
+        keep = lengths > 0
+        starts, ends, caps, lengths = starts[keep], ends[keep], caps[keep], lengths[keep]
+        if not len(starts):
+            break
+
+        # Interior vertices of all ranges, flattened, with the range each belongs to
+        ranges = np.repeat(np.arange(len(starts)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        points = starts[ranges] + 1 + offsets
+
+        # Perpendicular distance to the chord of the range
+        ax, ay = x[starts][ranges], y[starts][ranges]
+        bx, by = x[ends][ranges], y[ends][ranges]
+        dx, dy = bx - ax, by - ay
+        chord = np.hypot(dx, dy)
+        px, py = x[points] - ax, y[points] - ay
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance = np.where(chord > 0, np.abs(dx * py - dy * px) / chord, np.hypot(px, py))
+
+        # Farthest vertex of every range splits it in two
+        group_starts = np.cumsum(lengths) - lengths
+        max_distance = np.maximum.reduceat(distance, group_starts)
+        is_max = distance == max_distance[ranges]
+        split = _first_true_per_group(is_max, ranges, len(starts))
+        split_points = points[split]
+        split_significance = np.minimum(max_distance, caps)
+        significance[split_points] = split_significance
+
+        starts, ends, caps = (np.concatenate((starts, split_points)),
+                              np.concatenate((split_points, ends)),
+                              np.concatenate((split_significance, split_significance)))
+    return significance
+
+
+def _first_true_per_group(mask, groups, num_groups):
+    # Index of the first True entry of every group; groups are sorted and each has one
+    first = np.full(num_groups, len(mask))
+    np.minimum.at(first, groups[mask], np.flatnonzero(mask))
+    return first
+
+
+def min_zoom_levels(lat, significance):
+    """
+    Convert vertex significance to the lowest zoom level at which the vertex is drawn.
+
+    At zoom z one pixel covers METERS_PER_PIXEL_ZOOM_0 * cos(lat) / 2**z meters, and a
+    vertex is needed once its significance exceeds TOLERANCE_PIXELS at that resolution.
+
+    Returns:
+    np.ndarray: uint8 minimum zoom per vertex, MAX_ZOOM + 1 for vertices never drawn
+    """
+    if len(lat) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    meters_per_pixel = METERS_PER_PIXEL_ZOOM_0 * np.cos(np.radians(np.mean(lat))) * TOLERANCE_PIXELS
+    with np.errstate(divide='ignore'):
+        zoom = np.floor(np.log2(meters_per_pixel / significance)) + 1
+    return np.clip(zoom, MIN_ZOOM, MAX_ZOOM + 1).astype(np.uint8)
+
+
+def simplify_for_zoom(coords):
+    """
+    Simplify a track for all zoom levels at once.
+
+    Parameters:
+    coords (np.ndarray): (N, 2) array of (lat, lon)
+
+    Returns:
+    (np.ndarray, np.ndarray): The vertices needed at MAX_ZOOM and their minimum zoom levels
+    """
+    lat, lon = coords[:, 0], coords[:, 1]
+    zoom = min_zoom_levels(lat, douglas_peucker_significance(lat, lon))
+    keep = zoom <= MAX_ZOOM
+    return coords[keep], zoom[keep]
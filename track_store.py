@@ -0,0 +1,290 @@
+import os
+import numpy as np
+from gpx_reader import read_points
+
+# Paths to files and folders
+gpx_folder = 'API_GPX_FILES'
+track_store_path = 'tracks.bin'
+# Size and mtime of the GPX file every stored track was imported from, and of the files
+# that failed to parse
+track_sources_path = 'track_sources.npz'
+
+# Coordinates are stored as int32 fixed-point values in units of 1e-7 degrees
+COORD_SCALE = 10_000_000
+
+# Every append writes one chunk: a 16 byte header (magic, activity count, point count),
+# the activity ids, the point offsets per activity and the lat and lon columns
+CHUNK_MAGIC = b'TRK1'
+HEADER_DTYPE = np.dtype([('magic', 'S4'), ('n_activities', '<u4'), ('n_points', '<u8')])
+
+
+def _padding(size):
+    # Chunks start on 8 byte boundaries so that all columns stay aligned
+    return (-size) % 8
+
+
+class TrackStore:
+    """
+    Columnar store holding the lat/lon points of all activities in a single file.
+
+    The file is a sequence of chunks. New activities are appended as a new chunk at the
+    end of the file, so existing data is never rewritten. When the same activity id shows
+    up in several chunks, the most recent one wins; the older versions stay readable
+    through versions() until the store is compacted. Readers memory-map the file and get
+    zero-copy NumPy slices per activity.
+    """
+
+    def __init__(self, path=track_store_path):
+        self.path = path
+        self._load()
+
+    def _load(self):
+        self._index = {}
+        self._superseded = {}
+        self._mmap = None
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            self._valid_size = 0
+            return
+
+        self._mmap = np.memmap(self.path, dtype=np.uint8, mode='r')
+        file_size = len(self._mmap)
+        pos = 0
+        while pos + HEADER_DTYPE.itemsize <= file_size:
+            header = np.frombuffer(self._mmap, dtype=HEADER_DTYPE, count=1, offset=pos)[0]
+            if header['magic'] != CHUNK_MAGIC:
+                break
+            n_activities = int(header['n_activities'])
+            n_points = int(header['n_points'])
+            ids_offset = pos + HEADER_DTYPE.itemsize
+            offsets_offset = ids_offset + 8 * n_activities
+            lat_offset = offsets_offset + 8 * (n_activities + 1)
+            lon_offset = lat_offset + 4 * n_points
+            end = lon_offset + 4 * n_points
+            if end > file_size:
+                # Incomplete chunk left behind by an interrupted append
+                break
+
+            ids = np.frombuffer(self._mmap, dtype='<i8', count=n_activities, offset=ids_offset)
+            offsets = np.frombuffer(self._mmap, dtype='<i8', count=n_activities + 1, offset=offsets_offset)
+            lat = np.frombuffer(self._mmap, dtype='<i4', count=n_points, offset=lat_offset)
+            lon = np.frombuffer(self._mmap, dtype='<i4', count=n_points, offset=lon_offset)
+            for i, activity_id in enumerate(ids.tolist()):
+                if activity_id in self._index:
+                    self._superseded.setdefault(activity_id, []).append(self._index[activity_id])
+                self._index[activity_id] = (lat, lon, int(offsets[i]), int(offsets[i + 1]))
+
+            pos = end + _padding(end)
+        self._valid_size = min(pos, file_size)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, activity_id):
+        return int(activity_id) in self._index
+
+    def ids(self):
+        return np.fromiter(self._index.keys(), dtype=np.int64, count=len(self._index))
+
+    def raw(self, activity_id):
+        # Zero-copy int32 views into the memory-mapped file
+        lat, lon, start, end = self._index[int(activity_id)]
+        return lat[start:end], lon[start:end]
+
+    def versions(self, activity_id):
+        # Raw views of every stored version of a track, oldest first and the current one last
+        entries = self._superseded.get(int(activity_id), []) + [self._index[int(activity_id)]]
+        return [(lat[start:end], lon[start:end]) for lat, lon, start, end in entries]
+
+    def superseded_bytes(self):
+        # Bytes taken by older versions of tracks, dropped by compact()
+        return 8 * sum(end - start for versions in self._superseded.values() for _, _, start, end in versions)
+
+    def coords(self, activity_id):
+        # (N, 2) float array of (lat, lon) in degrees
+        lat, lon = self.raw(activity_id)
+        return np.column_stack((lat, lon)) / COORD_SCALE
+
+    def num_points(self, activity_id):
+        _, _, start, end = self._index[int(activity_id)]
+        return end - start
+
+    def append(self, tracks):
+        """
+        Append tracks to the end of the store as a single chunk.
+
+        Parameters:
+        tracks (dict): Maps activity id to an (N, 2) array-like of (lat, lon) in degrees
+        """
+        if not tracks:
+            return
+
+        ids = np.fromiter((int(activity_id) for activity_id in tracks), dtype='<i8', count=len(tracks))
+        arrays = [np.asarray(points, dtype=np.float64).reshape(-1, 2) for points in tracks.values()]
+        offsets = np.zeros(len(arrays) + 1, dtype='<i8')
+        np.cumsum([len(points) for points in arrays], out=offsets[1:])
+
+        if arrays and offsets[-1] > 0:
+            points = np.concatenate(arrays)
+        else:
+            points = np.zeros((0, 2))
+        fixed = np.round(points * COORD_SCALE).astype('<i4')
+
+        header = np.array([(CHUNK_MAGIC, len(ids), int(offsets[-1]))], dtype=HEADER_DTYPE)
+        chunk = b''.join([
+            header.tobytes(),
+            ids.tobytes(),
+            offsets.tobytes(),
+            np.ascontiguousarray(fixed[:, 0]).tobytes(),
+            np.ascontiguousarray(fixed[:, 1]).tobytes(),
+        ])
+        chunk += b'\0' * _padding(len(chunk))
+
+        # Release the mapping before writing and drop any incomplete tail from an earlier crash
+        valid_size = self._valid_size
+        self._mmap = None
+        self._index = {}
+        self._superseded = {}
+        mode = 'r+b' if os.path.exists(self.path) else 'wb'
+        with open(self.path, mode) as f:
+            f.truncate(valid_size)
+            f.seek(valid_size)
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        self._load()
+
+    def compact(self):
+        # Rewrite the store as a single chunk, dropping activities that were superseded
+        tracks = {activity_id: self.coords(activity_id) for activity_id in self._index}
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        TrackStore(tmp_path).append(tracks)
+        self._mmap = None
+        self._index = {}
+        self._superseded = {}
+        os.replace(tmp_path, self.path)
+        self._load()
+
+
+class TrackSources:
+    """
+    Size and mtime of the GPX file every stored track was imported from.
+
+    A file whose size or mtime no longer matches was edited since, and its track is
+    imported again. The store then holds the new version after the old one. Files that
+    failed to parse are recorded the same way and skipped until they change.
+
+    Parameters:
+    path (str): Path of the npz file the stats are kept in
+    """
+
+    def __init__(self, path=track_sources_path):
+        self.path = path
+        self.stats = {}
+        self.failed = {}
+        self._changed = False
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path) as data:
+                self.stats = dict(zip(data['ids'].tolist(), zip(data['size'].tolist(), data['mtime_ns'].tolist())))
+                if 'failed_ids' in data.files:
+                    self.failed = dict(zip(data['failed_ids'].tolist(),
+                                           zip(data['failed_size'].tolist(), data['failed_mtime_ns'].tolist())))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading track sources: {e}")
+
+    def changed_files(self, folder, store):
+        """
+        GPX files whose track is not in the store yet or changed since it was imported,
+        leaving out files that failed to parse and did not change since.
+
+        Stored tracks without a recorded file, imported before files were recorded, take
+        the current size and mtime of their file.
+
+        Returns:
+        list: (activity_id, path, (size, mtime_ns)) per file, by file name
+        """
+        if not os.path.isdir(folder):
+            return []
+        changed = []
+        for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+            activity_id = entry.name[:-4]
+            if not entry.name.endswith('.gpx') or not activity_id.isdigit():
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            activity_id, stat = int(activity_id), (stat.st_size, stat.st_mtime_ns)
+            if activity_id in store:
+                if activity_id not in self.stats:
+                    self.record(activity_id, stat)
+                if self.stats[activity_id] == stat:
+                    continue
+            if self.failed.get(activity_id) == stat:
+                continue
+            changed.append((activity_id, entry.path, stat))
+        return changed
+
+    def record(self, activity_id, stat):
+        self.stats[int(activity_id)] = tuple(stat)
+        self.failed.pop(int(activity_id), None)
+        self._changed = True
+
+    def record_failed(self, activity_id, stat):
+        self.failed[int(activity_id)] = tuple(stat)
+        self._changed = True
+
+    def save(self):
+        if not self._changed:
+            return
+        values = np.array(list(self.stats.values()), dtype=np.int64).reshape(-1, 2)
+        failed = np.array(list(self.failed.values()), dtype=np.int64).reshape(-1, 2)
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, ids=np.fromiter(self.stats, dtype=np.int64, count=len(self.stats)),
+                 size=values[:, 0], mtime_ns=values[:, 1],
+                 failed_ids=np.fromiter(self.failed, dtype=np.int64, count=len(self.failed)),
+                 failed_size=failed[:, 0], failed_mtime_ns=failed[:, 1])
+        os.replace(tmp_path, self.path)
+        self._changed = False
+
+
+def import_gpx_folder(folder=gpx_folder, store_path=track_store_path, sources_path=track_sources_path):
+    """
+    Import the GPX files from a folder that are not part of the track store yet, or that
+    changed since they were imported.
+
+    Parameters:
+    folder (str): Folder containing one '<activity_id>.gpx' file per activity
+    store_path (str): Path of the track store file
+    sources_path (str): Path of the file stats of the imported GPX files
+
+    Returns:
+    (TrackStore, int): The opened store and the number of imported activities
+    """
+    store = TrackStore(store_path)
+    sources = TrackSources(sources_path)
+    new_tracks = {}
+    stats = {}
+    for activity_id, path, stat in sources.changed_files(folder, store):
+        try:
+            new_tracks[activity_id] = read_points(path)
+        except Exception as e:
+            print(f"Error parsing GPX file {path}: {e}")
+            sources.record_failed(activity_id, stat)
+            continue
+        stats[activity_id] = stat
+
+    # The stats are recorded once the tracks are stored, an interrupted import is repeated
+    store.append(new_tracks)
+    for activity_id, stat in stats.items():
+        sources.record(activity_id, stat)
+    sources.save()
+    return store, len(new_tracks)
+
+
+if __name__ == "__main__":
+    store, imported = import_gpx_folder()
+    print(f"Imported {imported} GPX files, track store now holds {len(store)} activities.")
@@ -1,166 +1,76 @@
-import requests
+import argparse
 import os
-import gpxpy
-import polyline
-import pandas as pd
-import streamlit as st
 
-from stravaDash import generate_map_and_statistics, generate_runs_list_html, generate_summary_html, generate_city_statistics_html
+from strava_sync import sync_activities, sync_streams
+from build import run_build, STAGE_NAMES
+from update_worker import update_lock, UpdateInProgress, PROFILE_TARGETS
+from instrumentation import start_run, finish_run, run_report_path, PROFILERS
 
 # Paths to files and folders
-csv_file_path = 'strava_activities.csv'
 gpx_folder = 'API_GPX_FILES'
 os.makedirs(gpx_folder, exist_ok=True)  # Ensure the GPX folder exists
 
-def update_strava_data():
-    # Fetching secrets using Streamlit's secrets management
-    client_id = st.secrets["STRAVA_CLIENT_ID"]
-    client_secret = st.secrets["STRAVA_CLIENT_SECRET"]
-    refresh_token = st.secrets["STRAVA_REFRESH_TOKEN"]
-
-    # Step 1: Obtain an access token using the refresh token
-    token_url = 'https://www.strava.com/oauth/token'
-    response = requests.post(
-        token_url,
-        data={
-            'client_id': client_id,
-            'client_secret': client_secret,
-            'refresh_token': refresh_token,
-            'grant_type': 'refresh_token',
-            'scope': 'activity:read_all'
-        }
-    )
-
-    if response.status_code != 200:
-        print(f"Error fetching access token: {response.status_code}")
-        print(f"Response: {response.json()}")
-        return
-
-    # Extract access token from the response
-    access_token = response.json().get('access_token')
-
-    if not access_token:
-        print("Access token not found in the response.")
-        return
-
-    # Strava API base URL
-    api_base_url = 'https://www.strava.com/api/v3/'
-
-    # Headers for API requests
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-
-    # Pagination parameters
-    page = 1
-    per_page = 200  # Fetch up to 200 activities per page
-    all_activities = []
-
-    # Fetch activities with pagination
-    while True:
-        response = requests.get(
-            f"{api_base_url}athlete/activities",
-            headers=headers,
-            params={'page': page, 'per_page': per_page}
-        )
-
-        if response.status_code != 200:
-            print(f"Error fetching activities: {response.status_code}")
-            print(f"Response: {response.text}")
-            break
-
-        activities = response.json()
-        if not activities:
-            break  # No more activities to fetch
-
-        all_activities.extend(activities)
-        page += 1
-
-    # Check if activities were fetched
-    if not all_activities:
-        print("No activities fetched from Strava. CSV will not be updated.")
-        return
-
-    # Convert activities to DataFrame
-    activities_data = []
-    for activity in all_activities:
-        activities_data.append({
-            'id': activity['id'],
-            'name': activity['name'],
-            'type': activity['type'],
-            'start_date_local': activity['start_date_local'],
-            'distance': activity['distance'],
-            'moving_time': activity['moving_time'],
-            'elapsed_time': activity['elapsed_time'],
-            'total_elevation_gain': activity['total_elevation_gain']
-        })
-
-    df = pd.DataFrame(activities_data)
-    if df.empty:
-        print("Warning: DataFrame is empty. No data to write to CSV.")
-        return
-    
-    # Convert 'start_date_local' to datetime
-    df['start_date_local'] = pd.to_datetime(df['start_date_local'])
-
-    # Sort by 'start_date_local'
-    df = df.sort_values(by='start_date_local')
-
-    # Add 'run_number' column
-    df['run_number'] = range(1, len(df) + 1)
-
-    # Save DataFrame to CSV
-    df.to_csv(csv_file_path, index=False)
-    print(f"Activities successfully saved to '{csv_file_path}'.")
-
-    # Get existing GPX files in the folder
-    existing_gpx_files = {f.replace('.gpx', '') for f in os.listdir(gpx_folder)}
-
-    # Download missing GPX files
-    for activity in all_activities:
-        activity_id = str(activity['id'])
-
-        # Skip if the GPX file already exists
-        if activity_id in existing_gpx_files:
-            continue
-
-        # Fetch GPX data using Strava's API
-        response = requests.get(f"{api_base_url}activities/{activity_id}", headers=headers)
-        if response.status_code != 200:
-            print(f"Failed to get activity data for {activity_id}: {response.status_code}")
-            continue
-
-        activity_data = response.json()
-        if 'map' not in activity_data or 'summary_polyline' not in activity_data['map']:
-            print(f"No polyline data for activity {activity_id}")
-            continue
-
-        polyline_str = activity_data['map']['summary_polyline']
-        coordinates = polyline.decode(polyline_str)
-
-        # Create GPX file
-        gpx = gpxpy.gpx.GPX()
-        gpx_track = gpxpy.gpx.GPXTrack()
-        gpx.tracks.append(gpx_track)
-        gpx_segment = gpxpy.gpx.GPXTrackSegment()
-        gpx_track.segments.append(gpx_segment)
-
-        for coord in coordinates:
-            lat, lon = coord
-            gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(lat, lon))
-
-        # Save the GPX file
-        gpx_file_path = os.path.join(gpx_folder, f'{activity_id}.gpx')
-        with open(gpx_file_path, 'w') as f:
-            f.write(gpx.to_xml())
-
-        print(f'Saved GPX file: {gpx_file_path}')
-
+def update_strava_data(full_resolution=False, reconcile=False, streams=False, wait_for_streams=False):
+    """
+    Fetch new activities from Strava, store them in the activity database and create missing
+    GPX files.
+
+    Parameters:
+    full_resolution (bool): If True, fetch every new activity on its own to get the full
+        resolution polyline instead of the summary polyline from the activity list
+    reconcile (bool): If True, fetch the full history to pick up edited and deleted activities
+    streams (bool): If True, also fetch the full resolution streams of activities that have
+        none yet, as far as the rate limits allow
+    wait_for_streams (bool): If True, wait for the 15-minute rate limit window to reset
+        until all streams are fetched or the daily limit is reached
+
+    Returns:
+    bool: True if the sync, and the stream fetch if asked for, succeeded
+    """
+    if not sync_activities(full_resolution=full_resolution, reconcile=reconcile):
+        return False
     print("Successfully fetched the latest activities and created missing GPX files.")
+    if streams:
+        return sync_streams(wait=wait_for_streams) is not None
+    return True
 
 if __name__ == "__main__":
-    update_strava_data()
-    generate_map_and_statistics(incremental=True)
-    generate_runs_list_html()
-    generate_summary_html()
-    generate_city_statistics_html(incremental=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Sync activities from Strava and regenerate all files.")
+    parser.add_argument('--full-resolution', action='store_true',
+                        help="Fetch each new activity on its own to get the full resolution polyline")
+    parser.add_argument('--reconcile', action='store_true',
+                        help="Fetch the full history to pick up edited and deleted activities")
+    parser.add_argument('--streams', action='store_true',
+                        help="Also fetch the full resolution streams of activities that have none yet")
+    parser.add_argument('--wait-for-streams', action='store_true',
+                        help="Wait for the 15-minute rate limit window instead of leaving streams for the next run")
+    parser.add_argument('--force', action='store_true', help="Regenerate all pages even if they are up to date")
+    parser.add_argument('--only', nargs='+', choices=STAGE_NAMES, help="Only regenerate these pages")
+    parser.add_argument('--profile', nargs='*', choices=PROFILE_TARGETS,
+                        help="Profile these steps and stages, all of them if none are given")
+    parser.add_argument('--profiler', choices=PROFILERS, help="Profiler used with --profile, cProfile by default")
+    args = parser.parse_args()
+
+    # Never run at the same time as an update started from the app
+    try:
+        with update_lock():
+            # Without --profile, the STRAVA_PROFILE environment variable decides what is profiled
+            start_run('update', profile=(args.profile or ['all']) if args.profile is not None else None,
+                      profiler=args.profiler)
+            status = 'failed'
+            try:
+                synced = update_strava_data(full_resolution=args.full_resolution, reconcile=args.reconcile,
+                                            streams=args.streams or args.wait_for_streams,
+                                            wait_for_streams=args.wait_for_streams)
+
+                # Regenerate only the pages whose inputs changed, from the stored data if the sync failed
+                results = run_build(only=args.only, force=args.force)
+                status = 'failed' if not synced or 'failed' in results.values() else 'finished'
+            finally:
+                finish_run(status)
+                print(f"Run report written to {run_report_path}.")
+    except UpdateInProgress as e:
+        print(e)
+        raise SystemExit(1)
+    if status == 'failed':
+        raise SystemExit(1)
\ No newline at end of file
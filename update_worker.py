@@ -0,0 +1,244 @@
+import json
+import os
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where taking over a stale lock is not guarded
+    fcntl = None
+import threading
+import time
+from contextlib import contextmanager
+
+from build import run_build, STAGE_NAMES, PREPARE_STEPS
+from instrumentation import start_run, finish_run
+from strava_sync import sync_activities, sync_streams
+
+# Held while an update runs, by the app or by update_strava_data.py
+update_lock_path = '.update.lock'
+# Held for the moment it takes to check and take the update lock
+update_guard_path = '.update.lock.guard'
+
+# A lock whose process is gone is taken over right away; one older than this is assumed to
+# be left behind by a process on another machine sharing the folder
+STALE_LOCK_AGE = 6 * 60 * 60
+# Number of log messages kept per job
+MAX_MESSAGES = 200
+# Everything an update can profile, in the order it runs
+PROFILE_TARGETS = ['sync', 'streams'] + PREPARE_STEPS + STAGE_NAMES
+
+
+class UpdateInProgress(Exception):
+    pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _lock_is_stale():
+    try:
+        with open(update_lock_path, 'r') as f:
+            owner = json.load(f)
+        age = time.time() - os.path.getmtime(update_lock_path)
+    except (OSError, ValueError):
+        # Unreadable or half-written lock, only stale once it is old
+        try:
+            return time.time() - os.path.getmtime(update_lock_path) > STALE_LOCK_AGE
+        except OSError:
+            return True
+    return age > STALE_LOCK_AGE or not _pid_alive(int(owner.get('pid', 0)))
+
+
+@contextmanager
+def _lock_guard():
+    # Only one process at a time checks and takes the lock, otherwise two processes could
+    # both find the same stale lock, and the second would remove the lock the first just took
+    with open(update_guard_path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def acquire_update_lock():
+    """
+    Take the update lock, replacing it if the process holding it is gone.
+
+    Raises:
+    UpdateInProgress: If another update is running
+    """
+    with _lock_guard():
+        for _ in range(2):
+            try:
+                fd = os.open(update_lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not _lock_is_stale():
+                    raise UpdateInProgress("Another update is already running.")
+                print("Removing stale update lock.")
+                try:
+                    os.remove(update_lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'pid': os.getpid(), 'started': time.time()}, f)
+            return
+    raise UpdateInProgress("Another update is already running.")
+
+
+def release_update_lock():
+    try:
+        os.remove(update_lock_path)
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def update_lock():
+    acquire_update_lock()
+    try:
+        yield
+    finally:
+        release_update_lock()
+
+
+class UpdateJob:
+    """
+    Progress of one update: the Strava sync, the activity streams if asked for, and the
+    build stages.
+
+    Written by the worker thread and read by any number of sessions, so every access
+    goes through a lock and readers get copies via snapshot().
+    """
+
+    def __init__(self, incremental=True, full_resolution=False, reconcile=False, streams=False, profile=None,
+                 profiler=None):
+        self.incremental = incremental
+        self.full_resolution = full_resolution
+        self.reconcile = reconcile
+        self.streams = streams
+        self.profile = profile
+        self.profiler = profiler
+        self.stages = {'sync': 'pending', **({'streams': 'pending'} if streams else {}),
+                       **{name: 'pending' for name in STAGE_NAMES}}
+        self.messages = []
+        self.status = 'running'
+        self.started = time.time()
+        self.finished = None
+        # Incremented whenever a stage wrote new files, sessions rerun to show them
+        self.published = 0
+        self._lock = threading.Lock()
+
+    def log(self, message):
+        with self._lock:
+            self.messages.append(str(message))
+            del self.messages[:-MAX_MESSAGES]
+
+    def set_stage(self, name, status):
+        with self._lock:
+            self.stages[name] = status
+            if status == 'built':
+                self.published += 1
+
+    def finish(self, status):
+        with self._lock:
+            self.status = status
+            self.finished = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'stages': dict(self.stages),
+                'messages': list(self.messages),
+                'status': self.status,
+                'started': self.started,
+                'finished': self.finished,
+                'published': self.published,
+            }
+
+
+_current_job = None
+_current_job_lock = threading.Lock()
+
+
+def current_update():
+    # The running or most recently finished update of this process, if any
+    with _current_job_lock:
+        return _current_job
+
+
+def _run(job, on_publish):
+    try:
+        # Timings and counters of the whole update, written to the run report at the end
+        start_run('update', profile=job.profile, profiler=job.profiler)
+        job.set_stage('sync', 'running')
+        synced = sync_activities(full_resolution=job.full_resolution, reconcile=job.reconcile,
+                                 write=job.log, warn=job.log, error=job.log)
+        job.set_stage('sync', 'built' if synced else 'failed')
+        if synced and on_publish is not None:
+            on_publish()
+        if job.streams:
+            # Fetches as many streams as the rate limits allow, later updates fetch the rest
+            job.set_stage('streams', 'running')
+            streams_left = sync_streams(write=job.log, warn=job.log, error=job.log) if synced else None
+            job.set_stage('streams', 'failed' if streams_left is None else 'built')
+            synced = synced and streams_left is not None
+
+        def on_stage(name, status):
+            job.set_stage(name, status)
+            if status == 'built' and on_publish is not None:
+                on_publish()
+
+        results = run_build(force=not job.incremental, incremental=job.incremental, write=job.log, on_stage=on_stage)
+        failed = not synced or 'failed' in results.values()
+        job.finish('failed' if failed else 'finished')
+    except Exception as e:
+        job.log(f"Update failed: {e}")
+        job.finish('failed')
+    finally:
+        try:
+            finish_run(job.status)
+            if on_publish is not None:
+                on_publish()
+        except OSError as e:
+            job.log(f"Error writing run report: {e}")
+        release_update_lock()
+
+
+def start_update(incremental=True, full_resolution=False, reconcile=False, streams=False, on_publish=None,
+                 profile=None, profiler=None):
+    """
+    Start an update in a background thread unless one is already running.
+
+    Only one update runs at a time across all sessions and processes, guarded by a lock
+    file. The job reports the status of every stage as it goes.
+
+    Parameters:
+    incremental (bool): If False, every page is rebuilt from scratch
+    full_resolution (bool), reconcile (bool): Passed to the Strava sync
+    streams (bool): If True, also fetch the full resolution streams of activities that
+        have none yet, as far as the rate limits allow
+    on_publish (callable): Called from the worker whenever a stage has written new files,
+        and once more when the run report is written
+    profile (list), profiler (str): Steps and stages to profile and the profiler to use,
+        see instrumentation.RunReport
+
+    Returns:
+    UpdateJob: The started job, or None if another update is running
+    """
+    global _current_job
+    with _current_job_lock:
+        try:
+            acquire_update_lock()
+        except UpdateInProgress:
+            return None
+        job = UpdateJob(incremental=incremental, full_resolution=full_resolution, reconcile=reconcile,
+                        streams=streams, profile=profile, profiler=profiler)
+        _current_job = job
+    threading.Thread(target=_run, args=(job, on_publish), name='strava-update', daemon=True).start()
+    return job